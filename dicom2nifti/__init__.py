@@ -10,11 +10,15 @@ from dicom2nifti.settings import disable_validate_sliceincrement, \
     disable_validate_slicecount, \
     disable_validate_multiframe_implicit, \
     disable_resampling, \
+    disable_out_of_core, \
+    disable_header_scaling, \
     enable_validate_orientation, \
     enable_validate_orthogonal, \
     enable_validate_slicecount, \
     enable_validate_sliceincrement, \
     enable_validate_multiframe_implicit, \
-    enable_resampling
+    enable_resampling, \
+    enable_out_of_core, \
+    enable_header_scaling
 from dicom2nifti.convert_dicom import dicom_series_to_nifti
 from dicom2nifti.convert_dir import convert_directory
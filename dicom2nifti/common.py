@@ -11,24 +11,56 @@ import dicom2nifti.patch_pydicom_encodings
 
 dicom2nifti.patch_pydicom_encodings.apply()
 
+import functools
+import hashlib
 import os
 import struct
+from multiprocessing.pool import ThreadPool
 
 import pydicom
+from pydicom.errors import InvalidDicomError
+from pydicom.multival import MultiValue
 from pydicom.tag import Tag
 
 import logging
 import numpy
+import six
+from nibabel.fileslice import canonical_slicers
 
 from dicom2nifti.exceptions import ConversionValidationError, ConversionError
 import dicom2nifti.settings
 
 logger = logging.getLogger(__name__)
 
+# transfer syntaxes of which the pixel data can be used as is (implicit and explicit vr little endian)
+NATIVE_LITTLE_ENDIAN_TYPES = ['1.2.840.10008.1.2',
+                              '1.2.840.10008.1.2.1']
+PIXEL_DATA_TAG = Tag(0x7fe0, 0x0010)
+
+# header fields needed to detect the vendor, validate the file, group it by series, name the series and
+# know how many files to expect for it
+# reading only these (see compressed_dicom.probe_file) skips the large private blocks of the vendors
+CLASSIFICATION_TAGS = ['SeriesInstanceUID',
+                       'SeriesNumber',
+                       'SeriesDescription',
+                       'SequenceName',
+                       'ProtocolName',
+                       'InstanceNumber',
+                       'AcquisitionNumber',
+                       'ImagePositionPatient',
+                       'ImageOrientationPatient',
+                       'ImageType',
+                       'Manufacturer',
+                       'Modality',
+                       'ImagesInAcquisition',
+                       'NumberOfTemporalPositions',
+                       'Rows',
+                       'Columns']
+
 
 # Disable false positive numpy errors
 # pylint: disable=E1101
-def read_dicom_directory(dicom_directory, stop_before_pixels=False):
+def read_dicom_directory(dicom_directory, stop_before_pixels=False, workers=None):
     """
     Read all dicom files in a given directory (stop before pixels)
 
@@ -36,20 +68,83 @@ def read_dicom_directory(dicom_directory, stop_before_pixels=False):
     :type dicom_directory: six.string_types
     :param stop_before_pixels: Should we stop reading before the pixeldata (handy if we only want header info)
     :param dicom_directory: Directory with dicom data
+    :param workers: number of threads used to read the files (None or 1 to read them serially)
     :return: List of dicom objects
     """
-    dicom_input = []
+
+    def _probe_dicom_file(file_path):
+        dicom_probe = compressed_dicom.probe_file(file_path,
+                                                  defer_size=100,
+                                                  stop_before_pixels=stop_before_pixels,
+                                                  force=dicom2nifti.settings.pydicom_read_force)
+        if dicom_probe.is_dicom and is_valid_imaging_dicom(dicom_probe.header):
+            return dicom_probe
+        return None
+
+    dicom_probes = [dicom_probe
+                    for dicom_probe in scan_files(_probe_dicom_file, list_files(dicom_directory), workers)
+                    if dicom_probe is not None]
+    # compressed files that need gdcmconv are decompressed together
+    return compressed_dicom.get_datasets(dicom_probes)
+
+
+def list_files(dicom_directory):
+    """
+    List all files in a directory (recursively) in os.walk order
+
+    :param dicom_directory: directory to list
+    :return: list with the file paths
+    """
+    file_paths = []
     for root, _, files in os.walk(dicom_directory):
         for dicom_file in files:
-            file_path = os.path.join(root, dicom_file)
-            if compressed_dicom.is_dicom_file(file_path):
-                dicom_headers = compressed_dicom.read_file(file_path,
-                                                           defer_size=100,
-                                                           stop_before_pixels=stop_before_pixels,
-                                                           force=dicom2nifti.settings.pydicom_read_force)
-                if is_valid_imaging_dicom(dicom_headers):
-                    dicom_input.append(dicom_headers)
-    return dicom_input
+            file_paths.append(os.path.join(root, dicom_file))
+    return file_paths
+
+
+def scan_files(scan_function, file_paths, workers=None):
+    """
+    Apply a (header) scan function on a list of files
+    If workers is larger than 1 the files are scanned concurrently using a thread pool.
+    The results are always returned in the order of file_paths so the outcome is the same as a serial scan.
+
+    :param scan_function: function taking a file path
+    :param file_paths: list with the file paths to scan
+    :param workers: number of threads to use (None or 1 to scan serially)
+    :return: list with the results of scan_function for each file
+    """
+    if workers is None or workers <= 1 or len(file_paths) <= 1:
+        return [scan_function(file_path) for file_path in file_paths]
+
+    pool = ThreadPool(min(workers, len(file_paths)))
+    try:
+        return pool.map(scan_function, file_paths)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def read_dicom_files(dicom_files, stop_before_pixels=False):
+    """
+    Read a list of dicom files (for example all files of 1 series as indexed by convert_dir)
+
+    :type stop_before_pixels: bool
+    :type dicom_files: list of six.string_types
+    :param stop_before_pixels: Should we stop reading before the pixeldata (handy if we only want header info)
+    :param dicom_files: list with the paths of the dicom files to read
+    :return: List of dicom objects
+    """
+    dicom_probes = []
+    for file_path in dicom_files:
+        dicom_probe = compressed_dicom.probe_file(file_path,
+                                                  defer_size=100,
+                                                  stop_before_pixels=stop_before_pixels,
+                                                  force=dicom2nifti.settings.pydicom_read_force)
+        if not dicom_probe.is_dicom:
+            raise InvalidDicomError('File is missing the DICM header block: %s' % file_path)
+        dicom_probes.append(dicom_probe)
+    # compressed files that need gdcmconv are decompressed together
+    return compressed_dicom.get_datasets(dicom_probes)
 
 
 def is_hitachi(dicom_input):
@@ -193,54 +288,356 @@ def is_valid_imaging_dicom(dicom_header):
         return False
 
 
-def get_volume_pixeldata(sorted_slices):
+def get_volume_pixeldata(sorted_slices, rescale=True):
     """
     the slice and intercept calculation can cause the slices to have different dtypes
     we should get the correct dtype that can cover all of them
-    
+
+    The volume is allocated once as an x,y,z array in fortran (nifti) order based on the Rows and Columns of the
+    headers and every slice is written directly into it. The scaling is applied afterwards for the whole volume
+    at once (see do_series_scaling).
+
     :type sorted_slices: list of slices
     :param sorted_slices: sliced sored in the correct order to create volume
+    :param rescale: apply the scaling, False to keep the stored values (see get_header_scaling)
+    """
+    vol = None
+    for index, slice_ in enumerate(sorted_slices):
+        slice_data = get_pixel_array(slice_)
+        if vol is None:
+            vol = numpy.empty((slice_.Columns, slice_.Rows, len(sorted_slices)), dtype=slice_data.dtype, order='F')
+        else:
+            combined_dtype = numpy.promote_types(vol.dtype, slice_data.dtype)
+            if combined_dtype != vol.dtype:
+                vol = vol.astype(combined_dtype, order='F')
+        vol[:, :, index] = slice_data.T
+    vol = _sign_extend_volume(vol, sorted_slices)
+    if not rescale:
+        return vol
+    return do_series_scaling(vol, [get_scaling_parameters(slice_) for slice_ in sorted_slices])
+
+
+def get_volume_dtype(sorted_slices):
+    """
+    Get the dtype of the volume created by get_volume_pixeldata based on the headers only (without reading any data)
+    For integer scaling the range of BitsStored is used instead of the range of the actual data, so the dtype can be
+    wider than the one of get_volume_pixeldata but it can always hold the scaled data.
+
+    :param sorted_slices: slices of the volume
+    :return: numpy dtype
     """
-    slices = []
+    dtype = _get_stored_dtype(sorted_slices)
     combined_dtype = None
     for slice_ in sorted_slices:
-        slice_data = _get_slice_pixeldata(slice_)
-        slice_data = slice_data[numpy.newaxis, :, :]
-        slices.append(slice_data)
+        parameters = get_scaling_parameters(slice_)
+        if parameters is None:
+            slice_dtype = dtype
+        else:
+            slope, intercept, need_floats = _get_scaling_factors(*parameters)
+            if need_floats:
+                slice_dtype = numpy.dtype(numpy.float32)
+            else:
+                bits_stored = slice_.get('BitsStored', slice_.BitsAllocated)
+                if dtype.kind == 'i':
+                    minimum, maximum = -2 ** (bits_stored - 1), 2 ** (bits_stored - 1) - 1
+                else:
+                    minimum, maximum = 0, 2 ** bits_stored - 1
+                slice_dtype = _get_integer_scaling_dtype(minimum, maximum, slope, intercept)
+            slice_dtype = numpy.result_type(numpy.result_type(slice_dtype, slope), intercept)
         if combined_dtype is None:
-            combined_dtype = slice_data.dtype
+            combined_dtype = slice_dtype
         else:
-            combined_dtype = numpy.promote_types(combined_dtype, slice_data.dtype)
+            combined_dtype = numpy.promote_types(combined_dtype, slice_dtype)
+    return combined_dtype
+
 
-    # create the new volume with with the correct data
-    vol = numpy.concatenate(slices, axis=0)
+def _get_stored_dtype(sorted_slices):
+    """
+    Get the dtype of the unscaled data of the slices based on the headers only (see get_volume_pixeldata)
+    """
+    dtype = numpy.dtype(get_numpy_type(sorted_slices[0]))
+    for slice_ in sorted_slices[1:]:
+        dtype = numpy.promote_types(dtype, get_numpy_type(slice_))
+    if dtype.kind == 'u' and any(_needs_sign_extension(slice_) for slice_ in sorted_slices):
+        dtype = numpy.dtype('int%d' % (dtype.itemsize * 8))
+    return dtype
 
-    # Done
-    vol = numpy.transpose(vol, (2, 1, 0))
+
+class SliceArrayProxy(object):
+    """
+    Array proxy (like the nibabel ArrayProxy) for the volume of a list of sorted slices
+    It can be used as dataobj of a nibabel image. The slices are only decoded when they are indexed, so reading a single
+    slice of a large series only decodes that slice. The values are the same as the ones of get_volume_pixeldata, the
+    dtype is the one of get_volume_dtype.
+    """
+    is_proxy = True
+
+    def __init__(self, sorted_slices):
+        """
+        :param sorted_slices: slices sorted in the correct order to create the volume
+        """
+        self._sorted_slices = sorted_slices
+        self._shape = (int(sorted_slices[0].Columns), int(sorted_slices[0].Rows), len(sorted_slices))
+        self._dtype = get_volume_dtype(sorted_slices)
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def ndim(self):
+        return len(self._shape)
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    def __array__(self, dtype=None):
+        data = self._get_volume(self._sorted_slices)
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+    def __getitem__(self, slicer):
+        """
+        Get a part of the volume, only the slices within the slicer are decoded
+        """
+        slicers = list(canonical_slicers(slicer, self._shape))
+        # the z axis is the third axis that is not a new axis
+        z_axis = [index for index, item in enumerate(slicers) if item is not None][2]
+        slice_indexes = numpy.arange(self._shape[2])[slicers[z_axis]]
+        volume = self._get_volume([self._sorted_slices[index] for index in numpy.atleast_1d(slice_indexes)])
+        # the selected slices are decoded in order so only the selection of the other axes remains
+        slicers[z_axis] = 0 if numpy.ndim(slice_indexes) == 0 else slice(None)
+        return volume[tuple(slicers)]
+
+    def _get_volume(self, sorted_slices):
+        if not sorted_slices:
+            return numpy.zeros(self._shape[:2] + (0,), dtype=self._dtype, order='F')
+        return get_volume_pixeldata(sorted_slices).astype(self._dtype, copy=False)
+
+
+def get_4d_pixeldata(timepoints, timepoint_to_block, allocate=None, shape=None, dtype=None):
+    """
+    Create a 4d block by converting the timepoints one by one and writing each of them directly into the block
+    Only a single timepoint is kept in memory next to the block, which can be a memory mapped file (see nifti_writer).
+    If the shape and dtype are known from the headers the block is allocated before the first timepoint is converted,
+    otherwise they are taken from the first timepoint. If a timepoint needs a wider dtype than the block the block is
+    allocated again with the combined dtype.
+
+    :param timepoints: list with the input for timepoint_to_block of each timepoint
+    :param timepoint_to_block: function converting a timepoint to a x,y,z block
+    :param allocate: function(shape, dtype) returning the empty block to fill (default numpy.zeros)
+    :param shape: x,y,z,t shape of the block (optional)
+    :param dtype: dtype of the block (optional, only used together with shape)
+    :return: the x,y,z,t block
+    """
+    if allocate is None:
+        allocate = numpy.zeros
+    full_block = None
+    if shape is not None and dtype is not None:
+        full_block = allocate(tuple(shape), dtype)
+    for index, timepoint in enumerate(timepoints):
+        logger.info('Creating block %s of %s' % (index + 1, len(timepoints)))
+        data_block = timepoint_to_block(timepoint)
+        if full_block is None:
+            full_block = allocate(data_block.shape + (len(timepoints),), data_block.dtype)
+        elif full_block.shape[:3] != data_block.shape:
+            logger.warning('Missing slices (slice count mismatch between timepoint %s and %s)' % (index - 1, index))
+            logger.warning('---------------------------------------------------------')
+            logger.warning(full_block[:, :, :, index].shape)
+            logger.warning(data_block.shape)
+            logger.warning('---------------------------------------------------------')
+            raise ConversionError("MISSING_DICOM_FILES")
+        elif not numpy.can_cast(data_block.dtype, full_block.dtype):
+            promoted_block = allocate(full_block.shape, numpy.promote_types(full_block.dtype, data_block.dtype))
+            for previous_index in range(0, index):
+                promoted_block[:, :, :, previous_index] = full_block[:, :, :, previous_index]
+            full_block = promoted_block
+        full_block[:, :, :, index] = data_block
+    return full_block
+
+
+def get_4d_volume_pixeldata(grouped_slices, allocate=None, rescale=True):
+    """
+    Create the x,y,z,t block of a 4d series that is stored as separate slices per timepoint
+    The block is allocated once, sized from the headers of the first timepoint and typed from the headers of all
+    slices. The stored data of every timepoint is written directly into it and the scaling is applied once for the
+    full block (see do_series_scaling).
+    If all scaled slices need floats the block is allocated as float32 immediately so it can be scaled in place.
+
+    :param grouped_slices: list with for each timepoint the slices sorted in the correct order to create the volume
+    :param allocate: function(shape, dtype) returning the empty block to fill (default numpy.zeros)
+    :param rescale: apply the scaling, False to keep the stored values (see get_header_scaling)
+    :return: the x,y,z,t block
+    """
+    first_slice = grouped_slices[0][0]
+    shape = (int(first_slice.Columns), int(first_slice.Rows), len(grouped_slices[0]), len(grouped_slices))
+    for index, timepoint_slices in enumerate(grouped_slices):
+        if len(timepoint_slices) != shape[2]:
+            logger.warning('Missing slices (slice count mismatch between timepoint 0 and %s)' % index)
+            raise ConversionError("MISSING_DICOM_FILES")
+
+    all_slices = [slice_ for timepoint_slices in grouped_slices for slice_ in timepoint_slices]
+    dtype = _get_stored_dtype(all_slices)
+    # scaling parameters in c order over the z and t axes
+    scaling_parameters = [None] * (shape[2] * shape[3])
+    if rescale:
+        for t_index, timepoint_slices in enumerate(grouped_slices):
+            for z_index, slice_ in enumerate(timepoint_slices):
+                scaling_parameters[z_index * shape[3] + t_index] = get_scaling_parameters(slice_)
+        scaling_factors = [_get_scaling_factors(*parameters)
+                           for parameters in scaling_parameters if parameters is not None]
+        if scaling_factors and all(need_floats for _, _, need_floats in scaling_factors) and \
+                numpy.promote_types(dtype, numpy.float32) == numpy.float32:
+            dtype = numpy.dtype(numpy.float32)
+
+    full_block = get_4d_pixeldata(grouped_slices, functools.partial(get_volume_pixeldata, rescale=False),
+                                  allocate, shape, dtype)
+    return do_series_scaling(full_block, scaling_parameters, allocate)
+
+
+def _needs_sign_extension(dicom_slice):
+    """
+    Check for signed data where BitsStored is lower than BitsAllocated (and PixelRepresentation = 1)
+    for example a hitachi mri scan can have BitsAllocated 16 but BitsStored is 12 and HighBit 11
+    """
+    return dicom_slice.BitsAllocated != dicom_slice.BitsStored and \
+        dicom_slice.HighBit == dicom_slice.BitsStored - 1 and \
+        dicom_slice.PixelRepresentation == 1
+
+
+def _sign_extend_volume(vol, sorted_slices):
+    """
+    Fix overflow issues for signed data where BitsStored is lower than BitsAllocated by copying the sign bit
+    (HighBit) into the unused high bits. This is done in place with a shift left followed by an arithmetic shift
+    right so no masks or copies are needed.
+
+    :param vol: x,y,z volume with the unscaled pixel data of the slices
+    :param sorted_slices: the slices of the volume (in z order)
+    :return: the (signed) volume
+    """
+    slice_indexes = [index for index, slice_ in enumerate(sorted_slices) if _needs_sign_extension(slice_)]
+    if not slice_indexes:
+        return vol
+    if vol.dtype.kind == 'u':
+        # assert that it is a signed type
+        vol = vol.view(numpy.dtype('int%d' % (vol.dtype.itemsize * 8)))
+    if len(slice_indexes) == len(sorted_slices) and \
+            len(set(slice_.BitsStored for slice_ in sorted_slices)) == 1:
+        shift = vol.dtype.itemsize * 8 - sorted_slices[0].BitsStored
+        numpy.left_shift(vol, shift, out=vol)
+        numpy.right_shift(vol, shift, out=vol)
+    else:
+        for index in slice_indexes:
+            shift = vol.dtype.itemsize * 8 - sorted_slices[index].BitsStored
+            slice_data = vol[:, :, index]
+            numpy.left_shift(slice_data, shift, out=slice_data)
+            numpy.right_shift(slice_data, shift, out=slice_data)
     return vol
 
 
-def _get_slice_pixeldata(dicom_slice):
+def get_pixel_array(dicom_headers):
     """
-    the slice and intercept calculation can cause the slices to have different dtypes
-    we should get the correct dtype that can cover all of them
+    Get the (unscaled) pixel data of a dataset, same as pydicom pixel_array
+    Uncompressed little endian pixel data is used without going through the pydicom pixel data handlers (that also
+    keep a copy on the dataset): if the PixelData was deferred while reading it is memory mapped from the file,
+    otherwise a view on the PixelData bytes is used. The returned array can be read only.
+
+    :param dicom_headers: the dataset to get the pixel data from
+    :return: rows x columns array (frames x rows x columns for multiframe data)
+    """
+    data = _get_native_pixeldata(dicom_headers)
+    if data is None:
+        data = dicom_headers.pixel_array
+    return data
+
+
+def get_pixel_data_digest(dicom_headers):
+    """
+    Get a digest of the raw (not decoded) pixel data together with the fields needed to decode it
+    Two datasets with the same digest have the same pixel_array. Deferred pixel data is read from the file in chunks
+    and not kept on the dataset.
+
+    :param dicom_headers: the dataset to get the digest for
+    :return: hex digest (blake2b if available, sha1 otherwise)
+    """
+    digest = _new_digest()
+    file_meta = getattr(dicom_headers, 'file_meta', None)
+    pixel_format = [None if file_meta is None else file_meta.get('TransferSyntaxUID')]
+    for keyword in ['Rows', 'Columns', 'BitsAllocated', 'BitsStored', 'HighBit', 'PixelRepresentation',
+                    'SamplesPerPixel', 'NumberOfFrames', 'PhotometricInterpretation', 'PlanarConfiguration']:
+        pixel_format.append(dicom_headers.get(keyword))
+    digest.update(repr(pixel_format).encode('utf-8'))
+
+    pixel_data_element = dicom_headers._dict.get(PIXEL_DATA_TAG)
+    if pixel_data_element is None:
+        return digest.hexdigest()
+    filename = getattr(dicom_headers, 'filename', None)
+    if getattr(pixel_data_element, 'value', None) is None and \
+            getattr(pixel_data_element, 'value_tell', None) is not None and \
+            pixel_data_element.length != 0xFFFFFFFF and \
+            isinstance(filename, six.string_types) and os.path.isfile(filename):
+        with open(filename, 'rb') as file_stream:
+            file_stream.seek(pixel_data_element.value_tell)
+            remaining = pixel_data_element.length
+            while remaining > 0:
+                chunk = file_stream.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                remaining -= len(chunk)
+    else:
+        digest.update(dicom_headers.PixelData)
+    return digest.hexdigest()
 
-    :type dicom_slice: pydicom object
-    :param dicom_slice: slice to get the pixeldata for
-    """
-    data = dicom_slice.pixel_array
-    # fix overflow issues for signed data where BitsStored is lower than BitsAllocated and PixelReprentation = 1 (signed)
-    # for example a hitachi mri scan can have BitsAllocated 16 but BitsStored is 12 and HighBit 11
-    if dicom_slice.BitsAllocated != dicom_slice.BitsStored and \
-            dicom_slice.HighBit == dicom_slice.BitsStored - 1 and \
-            dicom_slice.PixelRepresentation == 1:
-        if dicom_slice.BitsAllocated == 16:
-            data = data.astype(numpy.int16)  # assert that it is a signed type
-        max_value = pow(2, dicom_slice.HighBit) - 1
-        invert_value = -1 ^ max_value
-        data[data > max_value] = numpy.bitwise_or(data[data > max_value], invert_value)
-        pass
-    return apply_scaling(data, dicom_slice)
+
+def _new_digest():
+    if hasattr(hashlib, 'blake2b'):
+        return hashlib.blake2b()
+    return hashlib.sha1()
+
+
+def _get_native_pixeldata(dicom_headers):
+    """
+    Fast path of get_pixel_array for uncompressed little endian data with one sample per pixel
+
+    :param dicom_headers: the dataset to get the pixel data from
+    :return: the array or None if the dataset needs pydicom to decode the pixel data
+    """
+    try:
+        file_meta = getattr(dicom_headers, 'file_meta', None)
+        if file_meta is None or file_meta.get('TransferSyntaxUID') not in NATIVE_LITTLE_ENDIAN_TYPES:
+            return None
+        if dicom_headers.BitsAllocated not in [8, 16, 32] or \
+                dicom_headers.get('SamplesPerPixel', 1) != 1 or \
+                'PixelData' not in dicom_headers:
+            return None
+        dtype = numpy.dtype('<%s%d' % (('u', 'i')[dicom_headers.PixelRepresentation],
+                                       dicom_headers.BitsAllocated // 8))
+        number_of_frames = int(dicom_headers.get('NumberOfFrames', 1) or 1)
+        if number_of_frames == 1:
+            shape = (dicom_headers.Rows, dicom_headers.Columns)
+        else:
+            shape = (number_of_frames, dicom_headers.Rows, dicom_headers.Columns)
+        pixel_count = int(numpy.prod(shape))
+
+        # deferred pixel data is mapped straight from the file (the value offset was recorded while reading)
+        pixel_data_element = dicom_headers._dict.get(PIXEL_DATA_TAG)
+        filename = getattr(dicom_headers, 'filename', None)
+        if getattr(pixel_data_element, 'value', None) is None and \
+                getattr(pixel_data_element, 'value_tell', None) is not None and \
+                isinstance(filename, six.string_types) and os.path.isfile(filename):
+            if pixel_data_element.length == 0xFFFFFFFF or pixel_data_element.length < pixel_count * dtype.itemsize:
+                return None
+            return numpy.memmap(filename, dtype=dtype, mode='r', offset=pixel_data_element.value_tell, shape=shape)
+
+        pixel_data = dicom_headers.PixelData
+        if len(pixel_data) < pixel_count * dtype.itemsize:
+            return None
+        return numpy.frombuffer(pixel_data, dtype=dtype, count=pixel_count).reshape(shape)
+    except (AttributeError, KeyError, TypeError, ValueError, IndexError):
+        return None
 
 
 def _is_float(float_value):
@@ -366,6 +763,73 @@ def set_ss_value(tag, value):
     tag.value = value
 
 
+# numpy types of the binary VRs (the raw values of implicit transfer syntax are little endian)
+_BINARY_VR_TYPES = {'FD': '<f8', 'FL': '<f4', 'SS': '<i2', 'US': '<u2', 'SL': '<i4', 'UL': '<u4'}
+# conversion of the values of the string VRs (multiple values are separated by a backslash)
+_STRING_VR_TYPES = {'IS': int, 'DS': float}
+
+
+def get_series_values(datasets, tag, vr, count=1, default=None):
+    """
+    Getter for the value of a (private) field for all datasets of a series at once, also works with implicit
+    transfersyntax (like the get_fd_value, get_fl_value, ... getters)
+    For binary VRs the raw values of all datasets are joined and converted with a single numpy.frombuffer.
+
+    :param datasets: the datasets (or sequence items) to read the field from
+    :param tag: the tag to read
+    :param vr: the VR of the field (FD, FL, SS, US, SL, UL, IS or DS)
+    :param count: number of values to read of each dataset
+    :param default: value (or list of count values) for datasets without the field, None to raise a KeyError
+    :return: numpy array with the values (len(datasets) values or len(datasets) x count if count is not 1)
+    """
+    present = [tag in dataset for dataset in datasets]
+    if default is None and not all(present):
+        raise KeyError(tag)
+    elements = [dataset[tag] for dataset, is_present in zip(datasets, present) if is_present]
+
+    if vr in _BINARY_VR_TYPES:
+        dtype = numpy.dtype(_BINARY_VR_TYPES[vr])
+        raw_values = [element.value for element in elements if element.VR in ['OB', 'UN']]
+        if len(raw_values) == len(elements) and \
+                all(len(raw_value) == count * dtype.itemsize for raw_value in raw_values):
+            values = numpy.frombuffer(bytearray(b''.join(raw_values)), dtype=dtype)
+        else:
+            values = numpy.array([_get_element_values(element, vr, count) for element in elements], dtype=dtype)
+    else:
+        values = numpy.array([_get_element_values(element, vr, count) for element in elements],
+                             dtype=numpy.dtype(_STRING_VR_TYPES[vr]))
+    values = values.reshape((len(elements), count))
+
+    if len(elements) != len(datasets):
+        all_values = numpy.empty((len(datasets), count), dtype=values.dtype)
+        all_values[:] = numpy.reshape(default, (-1, count))
+        all_values[numpy.array(present, dtype=bool)] = values
+        values = all_values
+    if count == 1:
+        return values[:, 0]
+    return values
+
+
+def _get_element_values(element, vr, count):
+    """
+    Get the first count values of a single element for get_series_values
+    """
+    value = element.value
+    if element.VR in ['OB', 'UN'] and vr in _BINARY_VR_TYPES:
+        return numpy.frombuffer(value, dtype=_BINARY_VR_TYPES[vr])[:count]
+    if isinstance(value, bytes):
+        value = value.decode('ascii')
+    if isinstance(value, six.string_types):
+        value = value.replace('\x00', ' ').split('\\')
+    elif not isinstance(value, (list, tuple, MultiValue)):
+        value = [value]
+    # only the requested values are converted, trailing values can be empty or malformed (GE private fields)
+    value = list(value)[:count]
+    if vr in _STRING_VR_TYPES:
+        value = [_STRING_VR_TYPES[vr](item) for item in value]
+    return value
+
+
 def apply_scaling(data, dicom_headers):
     """
     Rescale the data based on the RescaleSlope and RescaleOffset
@@ -374,8 +838,20 @@ def apply_scaling(data, dicom_headers):
     :param dicom_headers: dicom headers to use to retreive the scaling factors
     :param data: the input data
     """
+    scaling_parameters = get_scaling_parameters(dicom_headers)
+    if scaling_parameters is None:
+        return data
+    return do_scaling(data, *scaling_parameters)
+
+
+def get_scaling_parameters(dicom_headers):
+    """
+    Get the scaling factors of a slice as used by apply_scaling
 
-    # Apply the rescaling if needed
+    :param dicom_headers: dicom headers to use to retreive the scaling factors
+    :return: tuple with rescale_slope, rescale_intercept, private_scale_slope and private_scale_intercept or None if
+             the headers contain no scaling
+    """
     private_scale_slope_tag = Tag(0x2005, 0x100E)
     private_scale_intercept_tag = Tag(0x2005, 0x100D)
     if 'RescaleSlope' in dicom_headers or 'RescaleIntercept' in dicom_headers \
@@ -396,12 +872,139 @@ def apply_scaling(data, dicom_headers):
                 private_scale_slope = float(dicom_headers[private_scale_slope_tag].value)
         except:
             pass
-        return do_scaling(data, rescale_slope, rescale_intercept, private_scale_slope, private_scale_intercept)
+        return rescale_slope, rescale_intercept, private_scale_slope, private_scale_intercept
+    return None
+
+
+def get_header_scaling(dicoms):
+    """
+    Get the scaling to write to the nifti header (scl_slope and scl_inter) instead of applying it to the data
+    See get_uniform_scaling
+
+    :param dicoms: all slices of the series
+    :return: tuple with slope and intercept or None if the scaling should be applied to the data
+    """
+    return get_uniform_scaling([get_scaling_parameters(dicom_) for dicom_ in dicoms])
+
+
+def get_uniform_scaling(scaling_parameters):
+    """
+    Check if the scaling can be written to the nifti header instead of converting the data to float
+    This is the case if enabled in the settings (see settings.enable_header_scaling) and all slices or frames have the
+    same non integer scaling. Integer scaling is always applied to the data as it keeps the data integer anyway.
+
+    :param scaling_parameters: list with the scaling parameters of all slices or frames as returned by
+                               get_scaling_parameters (None for no scaling)
+    :return: tuple with slope and intercept or None if the scaling should be applied to the data
+    """
+    if not dicom2nifti.settings.header_scaling:
+        return None
+    scaling_factors = set()
+    for parameters in scaling_parameters:
+        if parameters is None:
+            parameters = (1, 0, 1.0, 0.0)
+        scaling_factors.add(_get_scaling_factors(*parameters))
+        if len(scaling_factors) > 1:
+            # slices disagree on the scaling
+            return None
+    if not scaling_factors:
+        return None
+    slope, intercept, need_floats = scaling_factors.pop()
+    if not need_floats:
+        return None
+    return slope, intercept
+
+
+def do_scaling(data, rescale_slope, rescale_intercept, private_scale_slope=1.0, private_scale_intercept=0.0):
+    slope, intercept, need_floats = _get_scaling_factors(rescale_slope, rescale_intercept,
+                                                         private_scale_slope, private_scale_intercept)
+    # Maybe we need to change the datatype?
+    if data.dtype in [numpy.float32, numpy.float64]:
+        pass
+    elif need_floats:
+        data = data.astype(numpy.float32)
     else:
+        # Determine required range and datatype from that
+        dtype = _get_integer_scaling_dtype(data.min(), data.max(), slope, intercept)
+
+        # Change datatype
+        if dtype != data.dtype:
+            data = data.astype(dtype)
+
+    data = (data * slope) + intercept
+
+    return data
+
+
+def do_series_scaling(data, scaling_parameters, allocate=None):
+    """
+    Rescale all slices/frames of a block at once
+    One output dtype is planned for the whole block (the dtype covering the results of do_scaling for each frame)
+    and the scaling is applied as a single broadcast operation instead of calling do_scaling for every frame.
+
+    :param data: block with the frames on the axes after the first two (x, y, frame axes), can be modified in place
+    :param scaling_parameters: list with for each frame (in c order over the frame axes) the scaling parameters as
+                               returned by get_scaling_parameters (None for no scaling)
+    :param allocate: function(shape, dtype) allocating the block if the scaling needs a wider dtype (default astype)
+    :return: the scaled block
+    """
+    if all(parameters is None for parameters in scaling_parameters):
         return data
+    frames_shape = data.shape[2:]
+    is_float_data = data.dtype in [numpy.float32, numpy.float64]
+
+    minimums, maximums = None, None
+    slopes, intercepts, frame_dtypes = [], [], []
+    for index, parameters in enumerate(scaling_parameters):
+        if parameters is None:
+            slopes.append(1)
+            intercepts.append(0)
+            frame_dtypes.append(data.dtype)
+            continue
+        slope, intercept, need_floats = _get_scaling_factors(*parameters)
+        if is_float_data:
+            dtype = data.dtype
+        elif need_floats:
+            dtype = numpy.dtype(numpy.float32)
+        else:
+            if minimums is None:
+                # a single scan over the block for the range of all frames
+                minimums = numpy.ravel(data.min(axis=(0, 1)))
+                maximums = numpy.ravel(data.max(axis=(0, 1)))
+            dtype = _get_integer_scaling_dtype(minimums[index], maximums[index], slope, intercept)
+        slopes.append(slope)
+        intercepts.append(intercept)
+        # dtype of (data * slope) + intercept for this frame
+        frame_dtypes.append(numpy.result_type(numpy.result_type(dtype, slope), intercept))
+
+    combined_dtype = frame_dtypes[0]
+    for frame_dtype in frame_dtypes[1:]:
+        combined_dtype = numpy.promote_types(combined_dtype, frame_dtype)
+
+    if data.dtype != combined_dtype:
+        if allocate is None:
+            data = data.astype(combined_dtype, order='K')
+        else:
+            scaled_data = allocate(data.shape, combined_dtype)
+            scaled_data[...] = data
+            data = scaled_data
+    data *= numpy.array(slopes, dtype=combined_dtype).reshape(frames_shape)
+    data += numpy.array(intercepts, dtype=combined_dtype).reshape(frames_shape)
+    return data
 
 
-def do_scaling(data, rescale_slope, rescale_intercept, private_scale_slope=1.0, private_scale_intercept=0.0):
+def _get_scaling_factors(rescale_slope, rescale_intercept, private_scale_slope, private_scale_intercept):
+    """
+    Get the slope and intercept to apply and whether the result needs a float dtype
+
+    Scaling according to ISMRM2013_PPM_scaling_reminder
+    The actual scaling is not does the scaling the same way as the next code example
+    and https://github.com/fedorov/DICOMPhilipsRescalePlugin/blob/master/DICOMPhilipsRescalePlugin.py
+    FOR DEFAULT DATA
+    RESULT_DATA = (STORED_VALUE * RESCALE_SLOPE) + RESCALE_INTERCEPT
+    FOR PHILIPS DATA
+    RESULT_DATA = (STORED_VALUE * PRIVATE_SCALE_SLOPE) + PRIVATE_SCALE_INTERCEPT
+    """
     # Obtain slope and offset
     need_floats = False
 
@@ -419,60 +1022,44 @@ def do_scaling(data, rescale_slope, rescale_intercept, private_scale_slope=1.0,
         rescale_intercept = float(rescale_intercept)
         private_scale_slope = float(private_scale_slope)
         private_scale_intercept = float(private_scale_intercept)
-    # Maybe we need to change the datatype?
-    if data.dtype in [numpy.float32, numpy.float64]:
-        pass
-    elif need_floats:
-        data = data.astype(numpy.float32)
-    else:
-        # Determine required range
-        minimum_required, maximum_required = data.min(), data.max()
-        minimum_required = min([minimum_required, minimum_required * rescale_slope + rescale_intercept,
-                                maximum_required * rescale_slope + rescale_intercept])
-        maximum_required = max([maximum_required, minimum_required * rescale_slope + rescale_intercept,
-                                maximum_required * rescale_slope + rescale_intercept])
-
-        # Determine required datatype from that
-        if minimum_required < 0:
-            # Signed integer type
-            maximum_required = max([-minimum_required, maximum_required])
-            if maximum_required < 2 ** 7:
-                dtype = numpy.int8
-            elif maximum_required < 2 ** 15:
-                dtype = numpy.int16
-            elif maximum_required < 2 ** 31:
-                dtype = numpy.int32
-            else:
-                dtype = numpy.float32
-        else:
-            # Unsigned integer type
-            if maximum_required < 2 ** 8:
-                dtype = numpy.uint8
-            elif maximum_required < 2 ** 16:
-                dtype = numpy.uint16
-            elif maximum_required < 2 ** 32:
-                dtype = numpy.uint32
-            else:
-                dtype = numpy.float32
 
-        # Change datatype
-        if dtype != data.dtype:
-            data = data.astype(dtype)
-
-    # Apply rescale_slope and rescale_intercept
-    # Scaling according to ISMRM2013_PPM_scaling_reminder
-    # The actual scaling is not does the scaling the same way as the next code example
-    # and https://github.com/fedorov/DICOMPhilipsRescalePlugin/blob/master/DICOMPhilipsRescalePlugin.py
-    # FOR DEFAULT DATA
-    # RESULT_DATA = (STORED_VALUE * RESCALE_SLOPE) + RESCALE_INTERCEPT
-    # FOR PHILIPS DATA
-    # RESULT_DATA = (STORED_VALUE * PRIVATE_SCALE_SLOPE) + PRIVATE_SCALE_INTERCEPT
     if private_scale_slope == 1.0 and private_scale_intercept == 0.0:
-        data = (data * rescale_slope) + rescale_intercept
-    else:
-        data = (data * private_scale_slope) + private_scale_intercept
+        return rescale_slope, rescale_intercept, need_floats
+    return private_scale_slope, private_scale_intercept, need_floats
 
-    return data
+
+def _get_integer_scaling_dtype(minimum_required, maximum_required, rescale_slope, rescale_intercept):
+    """
+    Get the smallest integer dtype that can hold the data range before and after integer scaling
+    """
+    minimum_required = min([minimum_required, minimum_required * rescale_slope + rescale_intercept,
+                            maximum_required * rescale_slope + rescale_intercept])
+    maximum_required = max([maximum_required, minimum_required * rescale_slope + rescale_intercept,
+                            maximum_required * rescale_slope + rescale_intercept])
+
+    # Determine required datatype from that
+    if minimum_required < 0:
+        # Signed integer type
+        maximum_required = max([-minimum_required, maximum_required])
+        if maximum_required < 2 ** 7:
+            dtype = numpy.int8
+        elif maximum_required < 2 ** 15:
+            dtype = numpy.int16
+        elif maximum_required < 2 ** 31:
+            dtype = numpy.int32
+        else:
+            dtype = numpy.float32
+    else:
+        # Unsigned integer type
+        if maximum_required < 2 ** 8:
+            dtype = numpy.uint8
+        elif maximum_required < 2 ** 16:
+            dtype = numpy.uint16
+        elif maximum_required < 2 ** 32:
+            dtype = numpy.uint32
+        else:
+            dtype = numpy.float32
+    return numpy.dtype(dtype)
 
 
 def write_bvec_file(bvecs, bvec_file):
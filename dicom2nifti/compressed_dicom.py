@@ -1,30 +1,324 @@
 import logging
+import multiprocessing
 import os
+import shutil
 import subprocess
 import tempfile
+from multiprocessing.pool import ThreadPool
 
 import dicom2nifti.settings as settings
 from dicom2nifti.exceptions import ConversionError
 
 import pydicom
+import pydicom.config
+import pydicom.filereader
+from pydicom.errors import InvalidDicomError
+from pydicom.tag import Tag
 
 logger = logging.getLogger(__name__)
 
+# transfer syntaxes that can be read without decompressing the pixel data
+UNCOMPRESSED_TYPES = ["1.2.840.10008.1.2",
+                      "1.2.840.10008.1.2.1",
+                      "1.2.840.10008.1.2.1.99",
+                      "1.2.840.10008.1.2.2"]
+# decompressed files are only written to tmpfs if they take at most this fraction of the available memory
+TMPFS_MEMORY_FRACTION = 0.25
 
-def read_file(dicom_file, defer_size=None, stop_before_pixels=False, force=False):
-    if _is_compressed(dicom_file, force):
-        with tempfile.NamedTemporaryFile() as fp:
-            _decompress_dicom(dicom_file, output_file=fp.name)
-            return pydicom.read_file(fp,
-                                     defer_size=None, # We can't defer
-                                     stop_before_pixels=stop_before_pixels,
-                                     force=force)
 
-    dicom_header = pydicom.read_file(dicom_file,
-                                     defer_size=defer_size,
-                                     stop_before_pixels=stop_before_pixels,
-                                     force=force)
-    return dicom_header
+class DicomProbe(object):
+    """
+    Result of probing a file with a single open: the DICM check, the transfer syntax and the parsed header
+    """
+
+    def __init__(self, filename, is_dicom=False, transfer_syntax=None, header=None, stop_before_pixels=True):
+        self.filename = filename
+        self.is_dicom = is_dicom
+        self.transfer_syntax = transfer_syntax
+        self.header = header
+        self.stop_before_pixels = stop_before_pixels
+
+    @property
+    def is_compressed(self):
+        """
+        True if the pixel data needs to be decompressed before it can be read
+        """
+        return self.transfer_syntax not in UNCOMPRESSED_TYPES
+
+    @property
+    def needs_decompression(self):
+        """
+        True if the pixel data was requested but can only be read after decompressing the file with gdcmconv
+        """
+        return not self.stop_before_pixels and self.is_compressed and \
+            _get_pixel_data_handler(self.transfer_syntax) is None
+
+    def get_dataset(self):
+        """
+        Get the dataset for this file, decompressing it if the pixel data was read and is compressed
+        The pixel data is decoded in process by pydicom if one of its pixel data handlers supports the transfer
+        syntax (gdcm, pillow, rle, ...), otherwise the file is decompressed with gdcmconv
+        """
+        dataset = self.get_decoded_dataset()
+        if dataset is None:
+            with tempfile.NamedTemporaryFile() as fp:
+                _decompress_dicom(self.filename, output_file=fp.name)
+                return pydicom.read_file(fp,
+                                         defer_size=None,  # We can't defer
+                                         stop_before_pixels=False,
+                                         force=True)
+        return dataset
+
+    def get_decoded_dataset(self):
+        """
+        Get the dataset for this file if its pixel data can be read in process
+        A pixel data handler can support the transfer syntax but still fail on the data (pillow only decodes 8 bit
+        JPEG Extended for example) so compressed pixel data is decoded here (pydicom keeps the decoded array)
+
+        :returns: the dataset or None if the file has to be decompressed with gdcmconv
+        """
+        if self.needs_decompression:
+            return None
+        if not self.stop_before_pixels and self.is_compressed and 'PixelData' in self.header:
+            try:
+                self.header.pixel_array
+            except Exception:
+                logger.info('Decoding %s in process failed, decompressing with gdcmconv' % self.filename)
+                return None
+        return self.header
+
+
+class BatchDecompressor(object):
+    """
+    Decompress many files with a bounded pool of concurrent gdcmconv processes
+    The decompressed files are written to a scratch directory that is removed on exit. This is on tmpfs if available
+    and the files fit in memory (see get_tmpfs_directory).
+
+    Usage:
+        with BatchDecompressor() as decompressor:
+            decompressed_files = decompressor.decompress(dicom_files)
+    """
+
+    def __init__(self, workers=None, expected_size=None):
+        """
+        :param workers: number of concurrent gdcmconv processes (None for the number of cpus)
+        :param expected_size: expected total size in bytes of the decompressed files (None if unknown, tmpfs is then
+        not used)
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = max(1, workers)
+        self.expected_size = expected_size
+        self.scratch_directory = None
+
+    def __enter__(self):
+        self.scratch_directory = tempfile.mkdtemp(prefix='dicom2nifti_',
+                                                  dir=get_tmpfs_directory(self.expected_size))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        shutil.rmtree(self.scratch_directory, ignore_errors=True)
+        self.scratch_directory = None
+
+    def decompress(self, dicom_files):
+        """
+        Decompress the files into the scratch directory
+
+        :param dicom_files: list with the compressed dicom files
+        :returns: list with the paths of the decompressed files (in the order of dicom_files)
+        """
+        if self.scratch_directory is None:
+            raise ValueError('BatchDecompressor must be used as a context manager')
+        output_files = [os.path.join(self.scratch_directory, '%06d.dcm' % index) for index in range(len(dicom_files))]
+        jobs = list(zip(dicom_files, output_files))
+        if self.workers == 1 or len(jobs) <= 1:
+            for job in jobs:
+                _decompress_job(job)
+        else:
+            pool = ThreadPool(min(self.workers, len(jobs)))
+            try:
+                pool.map(_decompress_job, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        return output_files
+
+
+def _decompress_job(job):
+    dicom_file, output_file = job
+    _decompress_dicom(dicom_file, output_file=output_file)
+
+
+def get_tmpfs_directory(expected_size):
+    """
+    Get a memory backed directory for scratch files if the system has one (/dev/shm on linux)
+    The decompressed files are read into memory completely afterwards, so while they are read the data is in memory
+    twice. tmpfs is only used if the files take at most TMPFS_MEMORY_FRACTION of the available memory.
+
+    :param expected_size: expected total size in bytes of the files (None if unknown)
+    :returns: the directory or None to use the default temporary directory
+    """
+    if expected_size is None or not (os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK | os.X_OK)):
+        return None
+    available_memory = _get_available_memory()
+    if available_memory is None or expected_size > available_memory * TMPFS_MEMORY_FRACTION:
+        return None
+    shm_stat = os.statvfs('/dev/shm')
+    if expected_size > shm_stat.f_bavail * shm_stat.f_frsize:
+        return None
+    return '/dev/shm'
+
+
+def _get_available_memory():
+    """
+    Get the memory available for new allocations (MemAvailable in /proc/meminfo)
+
+    :returns: available memory in bytes or None if unknown
+    """
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _get_decompressed_size(dicom_probe):
+    """
+    Estimate the size of a file after decompression from its image headers (falls back to the file size)
+    """
+    header = dicom_probe.header
+    try:
+        pixel_data_size = int(header.Rows) * int(header.Columns) * int(header.get('NumberOfFrames', 1) or 1) * \
+            int(header.get('SamplesPerPixel', 1)) * int(header.BitsAllocated) // 8
+    except (AttributeError, TypeError, ValueError):
+        pixel_data_size = 0
+    return max(pixel_data_size, os.path.getsize(dicom_probe.filename))
+
+
+def get_datasets(dicom_probes, workers=None):
+    """
+    Get the datasets of a list of probed files (for example a whole series)
+    All files that need gdcmconv are decompressed together in a BatchDecompressor
+
+    :param dicom_probes: list of DicomProbe objects of dicom files
+    :param workers: number of concurrent gdcmconv processes (None for the number of cpus)
+    :returns: list with the datasets (in the order of dicom_probes)
+    """
+    datasets = [None] * len(dicom_probes)
+    compressed_indexes = []
+    for index, dicom_probe in enumerate(dicom_probes):
+        datasets[index] = dicom_probe.get_decoded_dataset()
+        if datasets[index] is None:
+            compressed_indexes.append(index)
+
+    if compressed_indexes:
+        logger.info('Decompressing %d files with gdcmconv' % len(compressed_indexes))
+        expected_size = sum(_get_decompressed_size(dicom_probes[index]) for index in compressed_indexes)
+        with BatchDecompressor(workers, expected_size) as decompressor:
+            decompressed_files = decompressor.decompress([dicom_probes[index].filename
+                                                          for index in compressed_indexes])
+            for index, decompressed_file in zip(compressed_indexes, decompressed_files):
+                # read everything now as the decompressed file is removed afterwards
+                datasets[index] = pydicom.read_file(decompressed_file,
+                                                    defer_size=None,  # We can't defer
+                                                    stop_before_pixels=False,
+                                                    force=True)
+    return datasets
+
+
+def _get_pixel_data_handler(transfer_syntax):
+    """
+    Get the first available pydicom pixel data handler that can decode the transfer syntax
+
+    :param transfer_syntax: transfer syntax uid of the file
+    :returns: the handler module or None if there is no handler (installed) for this transfer syntax
+    """
+    if transfer_syntax is None:
+        return None
+    for handler in pydicom.config.pixel_data_handlers:
+        try:
+            if handler.is_available() and handler.supports_transfer_syntax(transfer_syntax):
+                return handler
+        except Exception:  # a broken optional decoder should not stop the gdcmconv fallback
+            continue
+    return None
+
+
+def probe_file(dicom_file, defer_size=None, stop_before_pixels=True, force=False, specific_tags=None):
+    """
+    Open a file once to check the DICM header block, get the transfer syntax and parse the headers
+    If the DICM header block is missing the file is only parsed when force is enabled
+
+    :param dicom_file: file to probe
+    :param defer_size: see pydicom read_file
+    :param stop_before_pixels: see pydicom read_file
+    :param force: try to read the file even if the DICM header block is missing
+    :param specific_tags: only read these tags (keywords or tags) and stop parsing after the last one of them
+    :returns: DicomProbe (is_dicom is False if the file could not be read as dicom)
+    """
+    with open(dicom_file, 'rb') as file_stream:
+        file_stream.seek(128)
+        is_dicom = file_stream.read(4) == b'DICM'
+        if not is_dicom and not force:
+            return DicomProbe(dicom_file)
+        file_stream.seek(0)
+        if specific_tags is not None:
+            stop_before_pixels = True
+        if is_dicom:
+            dicom_header = _read_dataset(file_stream, defer_size, stop_before_pixels, force, specific_tags)
+        else:
+            try:
+                dicom_header = _read_dataset(file_stream, defer_size, stop_before_pixels, True, specific_tags)
+            except:
+                return DicomProbe(dicom_file)
+            if dicom_header is None:
+                return DicomProbe(dicom_file)
+
+    transfer_syntax = None
+    file_meta = getattr(dicom_header, 'file_meta', None)
+    if file_meta is not None and 'TransferSyntaxUID' in file_meta:
+        transfer_syntax = file_meta.TransferSyntaxUID
+    return DicomProbe(dicom_file,
+                      is_dicom=True,
+                      transfer_syntax=transfer_syntax,
+                      header=dicom_header,
+                      stop_before_pixels=stop_before_pixels)
+
+
+def _read_dataset(file_stream, defer_size, stop_before_pixels, force, specific_tags):
+    """
+    Read a dataset from an open file
+    With specific_tags the parsing stops at the first top level element after the last requested tag, so the
+    (often large) private blocks and sequences further in the file are never read
+    """
+    if specific_tags is None:
+        return pydicom.read_file(file_stream,
+                                 defer_size=defer_size,
+                                 stop_before_pixels=stop_before_pixels,
+                                 force=force)
+    last_tag = max(Tag(tag) for tag in specific_tags)
+
+    def _after_last_tag(tag, vr, length):
+        return tag > last_tag
+
+    return pydicom.filereader.read_partial(file_stream,
+                                           stop_when=_after_last_tag,
+                                           defer_size=defer_size,
+                                           force=force,
+                                           specific_tags=specific_tags)
+
+
+def read_file(dicom_file, defer_size=None, stop_before_pixels=False, force=False):
+    dicom_probe = probe_file(dicom_file,
+                             defer_size=defer_size,
+                             stop_before_pixels=stop_before_pixels,
+                             force=force)
+    if not dicom_probe.is_dicom:
+        raise InvalidDicomError('File is missing the DICM header block: %s' % dicom_file)
+    return dicom_probe.get_dataset()
 
 
 def _compress_dicom(input_file):
@@ -106,12 +400,7 @@ def _is_compressed(dicom_file, force=False):
                                stop_before_pixels=True,
                                force=force)
 
-    uncompressed_types = ["1.2.840.10008.1.2",
-                          "1.2.840.10008.1.2.1",
-                          "1.2.840.10008.1.2.1.99",
-                          "1.2.840.10008.1.2.2"]
-
-    if 'TransferSyntaxUID' in header.file_meta and header.file_meta.TransferSyntaxUID in uncompressed_types:
+    if 'TransferSyntaxUID' in header.file_meta and header.file_meta.TransferSyntaxUID in UNCOMPRESSED_TYPES:
         return False
     return True
 
@@ -15,8 +15,6 @@ from dicom2nifti import convert_hitachi
 dicom2nifti.patch_pydicom_encodings.apply()
 
 import os
-import tempfile
-import shutil
 import sys
 
 from six import reraise
@@ -75,15 +73,10 @@ def dicom_series_to_nifti(original_dicom_directory, output_file=None, reorient_n
     :param original_dicom_directory: directory with the dicom files for a single series/scan
     :return nibabel image
     """
-    # copy files so we can can modify without altering the original
-    dirloc = "temp"
-    os.makedirs(dirloc)
-    # temp_directory = tempfile.mkdtemp(dir=)
     try:
-        dicom_directory = os.path.join(dirloc, 'dicom')
-        shutil.copytree(original_dicom_directory, dicom_directory)
-
-        dicom_input = common.read_dicom_directory(dicom_directory)
+        # the files are read in place, compressed files that need gdcmconv are decompressed into a unique scratch
+        # directory that is removed afterwards (see compressed_dicom.BatchDecompressor)
+        dicom_input = common.read_dicom_directory(original_dicom_directory)
 
         return dicom_array_to_nifti(dicom_input, output_file, reorient_nifti)
 
@@ -93,10 +86,6 @@ def dicom_series_to_nifti(original_dicom_directory, output_file=None, reorient_n
             value=ConversionError(str(exception)),
             tb=sys.exc_info()[2])
 
-    #finally:
-        # remove the copied data
-        #shutil.rmtree(dirloc)
-
 
 def dicom_array_to_nifti(dicom_list, output_file, reorient_nifti=True):
     """ Converts dicom single series (see pydicom) to nifty, mimicking SPM
@@ -118,7 +107,8 @@ def dicom_array_to_nifti(dicom_list, output_file, reorient_nifti=True):
     Inspired by http://code.google.com/p/pydicom/source/browse/source/dicom/contrib/pydicom_series.py
 
     :param reorient_nifti: if True the nifti affine and data will be updated so the data is stored LAS oriented
-    :param output_file: file path to write to
+    :param output_file: file path to write to (None to only create the nifti in memory, the resampling and
+    reorientation are done on the written file so they are skipped in this case)
     :param dicom_list: list with uncompressed dicom objects as read by pydicom
     """
     # copy files so we can can modify without altering the original
@@ -139,6 +129,13 @@ def dicom_array_to_nifti(dicom_list, output_file, reorient_nifti=True):
     else:
         raise ConversionValidationError("UNSUPPORTED_DATA")
 
+    if output_file is None:
+        # resampling and reorientation work on the written file, the in memory nifti (lazy for anatomical data) is
+        # returned as converted
+        if settings.resample or reorient_nifti:
+            logger.info('No output file, skipping resampling and reorientation')
+        return results
+
     if settings.resample:
         resample.resample_image(results['NII_FILE'])
 
@@ -204,12 +201,12 @@ def _get_first_header(dicom_directory):
         # go over all the files and try to read the dicom header
         for file_name in file_names:
             file_path = os.path.join(root, file_name)
-            # check wither it is a dicom file
-            if not compressed_dicom.is_dicom_file(file_path):
+            # check wither it is a dicom file and read the headers
+            dicom_probe = compressed_dicom.probe_file(file_path,
+                                                      stop_before_pixels=True,
+                                                      force=dicom2nifti.settings.pydicom_read_force)
+            if not dicom_probe.is_dicom:
                 continue
-            # read the headers
-            return compressed_dicom.read_file(file_path,
-                                              stop_before_pixels=True,
-                                              force=dicom2nifti.settings.pydicom_read_force)
+            return dicom_probe.header
     # no dicom files found
     raise ConversionError('NO_DICOM_FILES_FOUND')
@@ -11,11 +11,14 @@ import dicom2nifti.patch_pydicom_encodings
 
 dicom2nifti.patch_pydicom_encodings.apply()
 
+import functools
 import gc
 import os
 import re
+import sys
 import traceback
 import unicodedata
+from collections import OrderedDict
 
 from pydicom.tag import Tag
 
@@ -27,11 +30,17 @@ from six import iteritems
 import dicom2nifti.common as common
 import dicom2nifti.convert_dicom as convert_dicom
 import dicom2nifti.settings
+from dicom2nifti.header_index import HeaderIndex
 
 logger = logging.getLogger(__name__)
 
+# memory (in bytes) the file lists of the incomplete series can take while streaming before the least recently used
+# series is converted anyway (a file path takes about 100 to 200 bytes, so this is roughly 100000 files)
+MAX_OPEN_SERIES_MEMORY = 16 * 1024 * 1024
 
-def convert_directory(dicom_directory, output_folder, compression=True, reorient=True):
+
+def convert_directory(dicom_directory, output_folder, compression=True, reorient=True, workers=None,
+                      header_index_file=None, streaming=False, max_open_memory=MAX_OPEN_SERIES_MEMORY):
     """
     This function will order all dicom files by series and order them one by one
 
@@ -39,64 +48,263 @@ def convert_directory(dicom_directory, output_folder, compression=True, reorient
     :param reorient: reorient the dicoms according to LAS orientation
     :param output_folder: folder to write the nifti files to
     :param dicom_directory: directory with dicom files
+    :param workers: number of threads used to scan the dicom headers (None or 1 to scan them serially)
+    :param header_index_file: sqlite file to cache the headers in so unchanged files are not read again when grouping
+    the files into series on the next run
+    :param streaming: convert each series as soon as it is complete instead of after indexing the whole directory
+    :param max_open_memory: maximum memory in bytes of the file lists of the incomplete series while streaming
     """
-    # sort dicom files by series uid
-    dicom_series = {}
-    for root, _, files in os.walk(dicom_directory):
-        for dicom_file in files:
-            file_path = os.path.join(root, dicom_file)
-            # noinspection PyBroadException
-            try:
-                if compressed_dicom.is_dicom_file(file_path):
-                    # read the dicom as fast as possible
-                    # (max length for SeriesInstanceUID is 64 so defer_size 100 should be ok)
-
-                    dicom_headers = compressed_dicom.read_file(file_path,
-                                                               defer_size=100,
-                                                               stop_before_pixels=False,
-                                                               force=dicom2nifti.settings.pydicom_read_force)
-                    if not _is_valid_imaging_dicom(dicom_headers):
-                        logger.info("Skipping: %s" % file_path)
-                        continue
-                    logger.info("Organizing: %s" % file_path)
-                    if dicom_headers.SeriesInstanceUID not in dicom_series:
-                        dicom_series[dicom_headers.SeriesInstanceUID] = []
-                    dicom_series[dicom_headers.SeriesInstanceUID].append(dicom_headers)
-            except:  # Explicitly capturing all errors here to be able to continue processing all the rest
-                logger.warning("Unable to read: %s" % file_path)
-                traceback.print_exc()
+    header_index = None
+    if header_index_file is not None:
+        header_index = HeaderIndex(header_index_file)
+    try:
+        if streaming:
+            for series_id, dicom_files in _stream_series_files(dicom_directory, workers, header_index,
+                                                               max_open_memory):
+                convert_series(dicom_files, output_folder, compression, reorient)
+            if header_index is not None:
+                header_index.prune(dicom_directory)
+            return
+
+        # sort dicom files by series uid (header only, the pixel data is read per series during conversion)
+        dicom_series = _get_series_files(dicom_directory, workers, header_index)
+        if header_index is not None:
+            header_index.prune(dicom_directory)
+    finally:
+        if header_index is not None:
+            header_index.close()
 
     # start converting one by one
-    for series_id, dicom_input in iteritems(dicom_series):
-        base_filename = ""
-        # noinspection PyBroadException
-        try:
-            # construct the filename for the nifti
-            base_filename = ""
-            if 'SeriesNumber' in dicom_input[0]:
-                base_filename = _remove_accents('%s' % dicom_input[0].SeriesNumber)
-                if 'SeriesDescription' in dicom_input[0]:
-                    base_filename = _remove_accents('%s_%s' % (base_filename,
-                                                               dicom_input[0].SeriesDescription))
-                elif 'SequenceName' in dicom_input[0]:
-                    base_filename = _remove_accents('%s_%s' % (base_filename,
-                                                               dicom_input[0].SequenceName))
-                elif 'ProtocolName' in dicom_input[0]:
-                    base_filename = _remove_accents('%s_%s' % (base_filename,
-                                                               dicom_input[0].ProtocolName))
-            else:
-                base_filename = _remove_accents(dicom_input[0].SeriesInstanceUID)
-            logger.info('--------------------------------------------')
-            logger.info('Start converting %s' % base_filename)
-            if compression:
-                nifti_file = os.path.join(output_folder, base_filename + '.nii.gz')
-            else:
-                nifti_file = os.path.join(output_folder, base_filename + '.nii')
-            convert_dicom.dicom_array_to_nifti(dicom_input, nifti_file, reorient)
-            gc.collect()
-        except:  # Explicitly capturing app exceptions here to be able to continue processing
-            logger.info("Unable to convert: %s" % base_filename)
-            traceback.print_exc()
+    for series_id, dicom_files in iteritems(dicom_series):
+        convert_series(dicom_files, output_folder, compression, reorient)
+
+
+def convert_series(dicom_files, output_folder, compression=True, reorient=True):
+    """
+    Read the files of a single series and convert them to a nifti named after the series
+    Errors are logged so the processing of the other series can continue
+
+    :param dicom_files: list with the file paths of the series
+    :param compression: enable or disable gzip compression
+    :param reorient: reorient the dicoms according to LAS orientation
+    :param output_folder: folder to write the nifti files to
+    :return: the path to the nifti file or None if the conversion failed
+    """
+    base_filename = ""
+    dicom_input = None
+    # noinspection PyBroadException
+    try:
+        # read the full dicom files for this series only
+        dicom_input = common.read_dicom_files(dicom_files)
+
+        # construct the filename for the nifti
+        base_filename = _get_base_filename(dicom_input[0])
+        logger.info('--------------------------------------------')
+        logger.info('Start converting %s' % base_filename)
+        if compression:
+            nifti_file = os.path.join(output_folder, base_filename + '.nii.gz')
+        else:
+            nifti_file = os.path.join(output_folder, base_filename + '.nii')
+        convert_dicom.dicom_array_to_nifti(dicom_input, nifti_file, reorient)
+        return nifti_file
+    except:  # Explicitly capturing app exceptions here to be able to continue processing
+        logger.info("Unable to convert: %s" % base_filename)
+        traceback.print_exc()
+        return None
+    finally:
+        # release the pixel data of this series before starting the next one
+        dicom_input = None
+        gc.collect()
+
+
+def _get_series_files(dicom_directory, workers=None, header_index=None):
+    """
+    Index all dicom files in a directory by SeriesInstanceUID
+    Only the headers are read so the memory usage does not depend on the size of the study
+
+    :param dicom_directory: directory with dicom files
+    :param workers: number of threads used to read the headers (None or 1 to read them serially)
+    :param header_index: HeaderIndex to get the headers of unchanged files from (None to read all files)
+    :return: ordered dict with the SeriesInstanceUID as key and the list of file paths as value
+    """
+    dicom_series = OrderedDict()
+    file_paths = common.list_files(dicom_directory)
+    series_uids = common.scan_files(functools.partial(get_series_uid, header_index=header_index), file_paths, workers)
+    for file_path, series_uid in zip(file_paths, series_uids):
+        if series_uid is None:
+            continue
+        if series_uid not in dicom_series:
+            dicom_series[series_uid] = []
+        dicom_series[series_uid].append(file_path)
+    return dicom_series
+
+
+def _stream_series_files(dicom_directory, workers=None, header_index=None, max_open_memory=MAX_OPEN_SERIES_MEMORY):
+    """
+    Index the dicom files directory by directory and yield each series as soon as it is complete
+    A series is complete when the number of files expected from its headers is reached (only for series with a
+    reliable count, see _get_expected_file_count) or when the directory it was found in is finished. Series that were
+    found in several directories are yielded once the whole directory tree is indexed.
+    If the file lists of the incomplete series take more than max_open_memory bytes the least recently used series is
+    yielded with the files found so far. Series that receive files after they were yielded are yielded again with all
+    their files at the end.
+
+    :param dicom_directory: directory with dicom files
+    :param workers: number of threads used to read the headers (None or 1 to read them serially)
+    :param header_index: HeaderIndex to get the headers of unchanged files from (None to read all files)
+    :param max_open_memory: maximum memory in bytes of the file lists of the incomplete series
+    :return: generator of (SeriesInstanceUID, list of file paths) tuples
+    """
+    series_files = OrderedDict()  # series uid -> all file paths found so far
+    expected_counts = {}  # series uid -> reliable number of files expected for the series
+    open_series = OrderedDict()  # incomplete series -> memory of their file list, least recently used first
+    open_memory = 0  # memory of the file lists of the open series
+    series_directories = {}  # series uid -> the directory of its files, None if they are in several directories
+    emitted_counts = {}  # series uid -> number of files when the series was yielded
+    for root, _, file_names in os.walk(dicom_directory):
+        file_paths = [os.path.join(root, file_name) for file_name in file_names]
+        series_infos = common.scan_files(functools.partial(_get_series_info, header_index=header_index),
+                                         file_paths, workers)
+        for file_path, series_info in zip(file_paths, series_infos):
+            if series_info is None:
+                continue
+            series_uid, expected_count = series_info
+            if series_uid not in series_files:
+                series_files[series_uid] = []
+                expected_counts[series_uid] = expected_count
+                series_directories[series_uid] = root
+            elif series_directories[series_uid] != root:
+                series_directories[series_uid] = None
+            series_files[series_uid].append(file_path)
+            if series_uid in emitted_counts:  # yielded again at the end
+                continue
+            open_series[series_uid] = open_series.pop(series_uid, 0) + sys.getsizeof(file_path)
+            open_memory += sys.getsizeof(file_path)
+
+            if expected_counts[series_uid] == len(series_files[series_uid]):
+                open_memory -= open_series.pop(series_uid)
+                emitted_counts[series_uid] = len(series_files[series_uid])
+                yield series_uid, list(series_files[series_uid])
+            while open_series and open_memory > max_open_memory:
+                lru_series_uid, series_memory = open_series.popitem(last=False)
+                open_memory -= series_memory
+                logger.warning('Too many open series, converting %s with the %d files found so far' %
+                               (lru_series_uid, len(series_files[lru_series_uid])))
+                emitted_counts[lru_series_uid] = len(series_files[lru_series_uid])
+                yield lru_series_uid, list(series_files[lru_series_uid])
+
+        # keep the headers read so far if the scan is interrupted
+        if header_index is not None:
+            header_index.commit()
+
+        # directory boundary, the series that were only found in this directory are complete
+        for series_uid in [series_uid for series_uid in open_series if series_directories[series_uid] == root]:
+            open_memory -= open_series.pop(series_uid)
+            emitted_counts[series_uid] = len(series_files[series_uid])
+            yield series_uid, list(series_files[series_uid])
+
+    # the series found in several directories and the ones that received files after they were yielded
+    for series_uid, dicom_files in iteritems(series_files):
+        if series_uid in emitted_counts:
+            if emitted_counts[series_uid] == len(dicom_files):
+                continue
+            logger.warning('Found more files for %s, converting it again' % series_uid)
+        yield series_uid, list(dicom_files)
+
+
+def get_series_uid(file_path, header_index=None):
+    """
+    Read the header of a file and return its SeriesInstanceUID
+    None is returned for files that are not valid imaging dicom files
+
+    :param file_path: the file to read
+    :param header_index: HeaderIndex to get the header from if the file did not change (None to always read)
+    """
+    series_info = _get_series_info(file_path, header_index)
+    if series_info is None:
+        return None
+    return series_info[0]
+
+
+def _get_series_info(file_path, header_index=None):
+    """
+    Read the header of a file and return its SeriesInstanceUID and the number of files expected for the series
+    None is returned for files that are not valid imaging dicom files
+
+    :param file_path: the file to read
+    :param header_index: HeaderIndex to get the header from if the file did not change (None to always read)
+    :return: tuple with the SeriesInstanceUID and the expected number of files (None if unknown)
+    """
+    # noinspection PyBroadException
+    try:
+        # read the dicom as fast as possible, only the tags needed to classify it
+        # (max length for SeriesInstanceUID is 64 so defer_size 100 should be ok)
+        if header_index is not None:
+            dicom_probe = header_index.probe_file(file_path,
+                                                  defer_size=100,
+                                                  force=dicom2nifti.settings.pydicom_read_force)
+        else:
+            dicom_probe = compressed_dicom.probe_file(file_path,
+                                                      defer_size=100,
+                                                      stop_before_pixels=True,
+                                                      force=dicom2nifti.settings.pydicom_read_force,
+                                                      specific_tags=common.CLASSIFICATION_TAGS)
+        if dicom_probe.is_dicom:
+            dicom_headers = dicom_probe.header
+            if not _is_valid_imaging_dicom(dicom_headers):
+                logger.info("Skipping: %s" % file_path)
+                return None
+            logger.info("Organizing: %s" % file_path)
+            return dicom_headers.SeriesInstanceUID, _get_expected_file_count(dicom_headers)
+    except:  # Explicitly capturing all errors here to be able to continue processing all the rest
+        logger.warning("Unable to read: %s" % file_path)
+        traceback.print_exc()
+    return None
+
+
+def _get_expected_file_count(dicom_header):
+    """
+    Get the number of files of a series based on ImagesInAcquisition and NumberOfTemporalPositions
+    Multiframe files contain the whole series so only 1 file is expected
+    ImagesInAcquisition only counts the images of 1 acquisition, a classic 4d series reaches it after the first
+    timepoint. So the count is only returned if NumberOfTemporalPositions is known as well. If ImagesInAcquisition
+    already counts all timepoints the count is too high, the series is then yielded at the end of the scan.
+
+    :param dicom_header: header of one of the dicom files of the series
+    :return: the expected number of files or None if unknown or unreliable
+    """
+    if common.is_multiframe_dicom([dicom_header]):
+        return 1
+    try:
+        if 'ImagesInAcquisition' not in dicom_header or not dicom_header.ImagesInAcquisition:
+            return None
+        if 'NumberOfTemporalPositions' not in dicom_header or not dicom_header.NumberOfTemporalPositions:
+            return None
+        return int(dicom_header.ImagesInAcquisition) * int(dicom_header.NumberOfTemporalPositions)
+    except (TypeError, ValueError):
+        return None
+
+
+def _get_base_filename(dicom_header):
+    """
+    Construct the filename for the nifti (without extension) based on the series information
+
+    :param dicom_header: header of one of the dicom files of the series
+    """
+    if 'SeriesNumber' in dicom_header:
+        base_filename = _remove_accents('%s' % dicom_header.SeriesNumber)
+        if 'SeriesDescription' in dicom_header:
+            base_filename = _remove_accents('%s_%s' % (base_filename,
+                                                       dicom_header.SeriesDescription))
+        elif 'SequenceName' in dicom_header:
+            base_filename = _remove_accents('%s_%s' % (base_filename,
+                                                       dicom_header.SequenceName))
+        elif 'ProtocolName' in dicom_header:
+            base_filename = _remove_accents('%s_%s' % (base_filename,
+                                                       dicom_header.ProtocolName))
+    else:
+        base_filename = _remove_accents(dicom_header.SeriesInstanceUID)
+    return base_filename
 
 
 def _is_valid_imaging_dicom(dicom_header):
@@ -7,24 +7,20 @@ dicom2nifti
 
 from __future__ import print_function
 import dicom2nifti.patch_pydicom_encodings
-from dicom2nifti.exceptions import ConversionError
 
 dicom2nifti.patch_pydicom_encodings.apply()
 
 import itertools
 import os
-from math import pow
 
 import logging
-import nibabel
 import numpy
 
 from pydicom.tag import Tag
 
-from six import string_types
-
 import dicom2nifti.common as common
 import dicom2nifti.convert_generic as convert_generic
+import dicom2nifti.nifti_writer as nifti_writer
 
 logger = logging.getLogger(__name__)
 
@@ -93,23 +89,24 @@ def _4d_to_nifti(grouped_dicoms, output_file):
     This function will convert ge 4d series to a nifti
     """
 
-    # Create mosaic block
-    logger.info('Creating data block')
-    full_block = _get_full_block(grouped_dicoms)
-
     logger.info('Creating affine')
     # Create the nifti header info
     affine = common.create_affine(grouped_dicoms[0])
 
-    logger.info('Creating nifti')
-    # Convert to nifti
-    nii_image = nibabel.Nifti1Image(full_block, affine)
-    common.set_tr_te(nii_image, float(grouped_dicoms[0][0].RepetitionTime),
-                     float(grouped_dicoms[0][0].EchoTime))
-    logger.info('Saving nifti to disk %s' % output_file)
-    # Save to disk
+    # non integer scaling can be stored in the nifti header to keep the integer data (see settings)
+    scaling = None
     if output_file is not None:
-        nii_image.to_filename(output_file)
+        scaling = common.get_header_scaling([dicom_ for timepoint in grouped_dicoms for dicom_ in timepoint])
+
+    # Create data block and convert to nifti
+    logger.info('Creating data block')
+    nii_image = nifti_writer.create_4d_nifti(lambda allocate: _get_full_block(grouped_dicoms, allocate,
+                                                                              scaling is None),
+                                             affine,
+                                             output_file,
+                                             float(grouped_dicoms[0][0].RepetitionTime),
+                                             float(grouped_dicoms[0][0].EchoTime),
+                                             scaling)
 
     if _is_diffusion_imaging(grouped_dicoms):
         bval_file = None
@@ -135,41 +132,14 @@ def _4d_to_nifti(grouped_dicoms, output_file):
             'NII': nii_image}
 
 
-def _get_full_block(grouped_dicoms):
+def _get_full_block(grouped_dicoms, allocate=None, rescale=True):
     """
     Generate a full datablock containing all timepoints
+
+    :param allocate: function(shape, dtype) allocating the block (see common.get_4d_pixeldata)
+    :param rescale: apply the scaling to the data (see common.get_volume_pixeldata)
     """
-    # For each slice / mosaic create a data volume block
-    data_blocks = []
-    for index in range(0, len(grouped_dicoms)):
-        logger.info('Creating block %s of %s' % (index + 1, len(grouped_dicoms)))
-        data_blocks.append(_timepoint_to_block(grouped_dicoms[index]))
-
-    # Add the data_blocks together to one 4d block
-    size_x = numpy.shape(data_blocks[0])[0]
-    size_y = numpy.shape(data_blocks[0])[1]
-    size_z = numpy.shape(data_blocks[0])[2]
-    size_t = len(data_blocks)
-    full_block = numpy.zeros((size_x, size_y, size_z, size_t), dtype=data_blocks[0].dtype)
-    for index in range(0, size_t):
-        if full_block[:, :, :, index].shape != data_blocks[index].shape:
-            logger.warning('Missing slices (slice count mismatch between timepoint %s and %s)' % (index - 1, index))
-            logger.warning('---------------------------------------------------------')
-            logger.warning(full_block[:, :, :, index].shape)
-            logger.warning(data_blocks[index].shape)
-            logger.warning('---------------------------------------------------------')
-            raise ConversionError("MISSING_DICOM_FILES")
-        full_block[:, :, :, index] = data_blocks[index]
-
-    return full_block
-
-
-def _timepoint_to_block(timepoint_dicoms):
-    """
-    Convert slices to a block of data by reading the headers and appending
-    """
-    # similar way of getting the block to anatomical however here we are creating the dicom series our selves
-    return common.get_volume_pixeldata(timepoint_dicoms)
+    return common.get_4d_volume_pixeldata(grouped_dicoms, allocate, rescale)
 
 
 def _get_grouped_dicoms(dicom_input):
@@ -217,43 +187,31 @@ def _get_bvals_bvecs(grouped_dicoms):
     """
     Write the bvals from the sorted dicom files to a bval file
     """
-    # loop over all timepoints and create a list with all bvals and bvecs
-    bvals = numpy.zeros([len(grouped_dicoms)], dtype=numpy.int32)
-    bvecs = numpy.zeros([len(grouped_dicoms), 3])
-
-    for group_index in range(0, len(grouped_dicoms)):
-        dicom_ = grouped_dicoms[group_index][0]
-        # 0019:10bb: Diffusion X
-        # 0019:10bc: Diffusion Y
-        # 0019:10bd: Diffusion Z
-        # 0043:1039: B-values (4 values, 1st value is actual B value)
-
-        # bval can be stored both in string as number format in dicom so implement both
-        # some workarounds needed for implicit transfer syntax to work
-        if isinstance(dicom_[Tag(0x0043, 0x1039)].value, string_types):  # this works for python2.7
-            original_bval = float(dicom_[Tag(0x0043, 0x1039)].value.split('\\')[0])
-        elif isinstance(dicom_[Tag(0x0043, 0x1039)].value, bytes):  # this works for python3.o
-            original_bval = float(dicom_[Tag(0x0043, 0x1039)].value.decode("utf-8").split('\\')[0])
-        else:
-            original_bval = dicom_[Tag(0x0043, 0x1039)][0]
-        original_bvec = numpy.array([0, 0, 0], dtype=numpy.float)
-        original_bvec[0] = -float(dicom_[Tag(0x0019, 0x10bb)].value)  # invert based upon mricron output
-        original_bvec[1] = float(dicom_[Tag(0x0019, 0x10bc)].value)
-        original_bvec[2] = float(dicom_[Tag(0x0019, 0x10bd)].value)
-
-        # Add calculated B Value
-        if original_bval != 0:  # only normalize if there is a value
-            corrected_bval = original_bval * pow(numpy.linalg.norm(original_bvec), 2)
-            if numpy.linalg.norm(original_bvec) != 0:
-                normalized_bvec = original_bvec / numpy.linalg.norm(original_bvec)
-            else:
-                normalized_bvec = original_bvec
-        else:
-            corrected_bval = original_bval
-            normalized_bvec = original_bvec
-
-        bvals[group_index] = int(round(corrected_bval))  # we want the original numbers back as in the protocol
-        bvecs[group_index, :] = normalized_bvec
+    first_dicoms = [timepoint_dicoms[0] for timepoint_dicoms in grouped_dicoms]
+    # 0019:10bb: Diffusion X
+    # 0019:10bc: Diffusion Y
+    # 0019:10bd: Diffusion Z
+    # 0043:1039: B-values (4 values, 1st value is actual B value)
+
+    # bval can be stored both in string as number format in dicom, get_series_values handles both
+    # (also for implicit transfer syntax)
+    original_bvals = common.get_series_values(first_dicoms, Tag(0x0043, 0x1039), 'DS')
+    original_bvecs = numpy.zeros([len(grouped_dicoms), 3])
+    # invert based upon mricron output
+    original_bvecs[:, 0] = -common.get_series_values(first_dicoms, Tag(0x0019, 0x10bb), 'DS')
+    original_bvecs[:, 1] = common.get_series_values(first_dicoms, Tag(0x0019, 0x10bc), 'DS')
+    original_bvecs[:, 2] = common.get_series_values(first_dicoms, Tag(0x0019, 0x10bd), 'DS')
+
+    # Add calculated B Value, only normalize if there is a value
+    norms = numpy.linalg.norm(original_bvecs, axis=1)
+    has_bval = original_bvals != 0
+    corrected_bvals = numpy.where(has_bval, original_bvals * numpy.power(norms, 2), original_bvals)
+    bvecs = original_bvecs.copy()
+    normalized = has_bval & (norms != 0)
+    bvecs[normalized] = original_bvecs[normalized] / norms[normalized, numpy.newaxis]
+
+    # we want the original numbers back as in the protocol
+    bvals = numpy.round(corrected_bvals).astype(numpy.int32)
 
     return bvals, bvecs
 
@@ -19,6 +19,7 @@ from pydicom.tag import Tag
 import six
 
 import dicom2nifti.common as common
+import dicom2nifti.nifti_writer as nifti_writer
 import dicom2nifti.settings as settings
 from dicom2nifti.exceptions import ConversionError
 
@@ -62,13 +63,23 @@ def dicom_to_nifti(dicom_input, output_file):
         # validate that all slices have a consistent slice increment
         common.validate_sliceincrement(dicom_input)
 
+    # non integer scaling can be stored in the nifti header to keep the integer data (see settings)
+    scaling = None
+    if output_file is not None:
+        scaling = common.get_header_scaling(dicom_input)
+
     # Get data; originally z,y,x, transposed to x,y,z
-    data = common.get_volume_pixeldata(dicom_input)
+    if output_file is None:
+        # nothing is written so the slices are only decoded when the data of the nifti is accessed
+        data = common.SliceArrayProxy(dicom_input)
+    else:
+        data = common.get_volume_pixeldata(dicom_input, rescale=scaling is None)
 
     affine = common.create_affine(dicom_input)
 
     # Convert to nifti
     nii_image = nibabel.Nifti1Image(data, affine)
+    nifti_writer.set_scaling(nii_image, scaling)
 
     # Set TR and TE if available
     if Tag(0x0018, 0x0081) in dicom_input[0] and Tag(0x0018, 0x0081) in dicom_input[0]:
@@ -91,13 +102,20 @@ def _remove_duplicate_slices(dicoms):
 
     dicoms_dict = {}
     filtered_dicoms = []
+    # digests of the raw pixel data, only calculated (once) for slices with the same position so nothing is decoded
+    pixel_digests = {}
+
+    def _get_pixel_digest(dicom_):
+        if id(dicom_) not in pixel_digests:
+            pixel_digests[id(dicom_)] = common.get_pixel_data_digest(dicom_)
+        return pixel_digests[id(dicom_)]
+
     for dicom_ in dicoms:
         if tuple(dicom_.ImagePositionPatient) not in dicoms_dict:
             dicoms_dict[tuple(dicom_.ImagePositionPatient)] = dicom_
             filtered_dicoms.append(dicom_)
         else:
-            if numpy.array_equal(dicom_.pixel_array,
-                                 dicoms_dict[tuple(dicom_.ImagePositionPatient)].pixel_array):
+            if _get_pixel_digest(dicom_) == _get_pixel_digest(dicoms_dict[tuple(dicom_.ImagePositionPatient)]):
                 logger.warning('Removing duplicate slice from series')
             else:
                 filtered_dicoms.append(dicom_)
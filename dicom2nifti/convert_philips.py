@@ -11,7 +11,6 @@ import dicom2nifti.patch_pydicom_encodings
 dicom2nifti.patch_pydicom_encodings.apply()
 
 import os
-import traceback
 
 import logging
 import nibabel
@@ -23,6 +22,7 @@ from pydicom.tag import Tag
 import dicom2nifti.common as common
 import dicom2nifti.settings as settings
 import dicom2nifti.convert_generic as convert_generic
+import dicom2nifti.nifti_writer as nifti_writer
 from dicom2nifti.exceptions import ConversionError
 
 pydicom_config.enforce_valid_values = False
@@ -224,7 +224,14 @@ def _multiframe_to_nifti(dicom_input, output_file):
 
     # Create mosaic block
     logger.info('Creating data block')
-    full_block = _multiframe_to_block(multiframe_dicom)
+    full_block, scaling_parameters = _multiframe_to_unscaled_block(multiframe_dicom)
+
+    # non integer scaling can be stored in the nifti header to keep the integer data (see settings)
+    scaling = None
+    if output_file is not None:
+        scaling = common.get_uniform_scaling(scaling_parameters)
+    if scaling is None:
+        full_block = common.do_series_scaling(full_block, scaling_parameters)
 
     logger.info('Creating affine')
 
@@ -234,6 +241,7 @@ def _multiframe_to_nifti(dicom_input, output_file):
 
     # Convert to nifti
     nii_image = nibabel.Nifti1Image(full_block, affine)
+    nifti_writer.set_scaling(nii_image, scaling)
     timing_parameters = multiframe_dicom.SharedFunctionalGroupsSequence[0].MRTimingAndRelatedParametersSequence[0]
     first_frame = multiframe_dicom[Tag(0x5200, 0x9230)][0]
     common.set_tr_te(nii_image, float(timing_parameters.RepetitionTime),
@@ -273,23 +281,24 @@ def _singleframe_to_nifti(grouped_dicoms, output_file):
     This function will convert a philips singleframe series to a nifti
     """
 
-    # Create mosaic block
-    logger.info('Creating data block')
-    full_block = _singleframe_to_block(grouped_dicoms)
-
     logger.info('Creating affine')
     # Create the nifti header info
     affine = common.create_affine(grouped_dicoms[0])
 
-    logger.info('Creating nifti')
-    # Convert to nifti
-    nii_image = nibabel.Nifti1Image(full_block, affine)
-    common.set_tr_te(nii_image, float(grouped_dicoms[0][0].RepetitionTime), float(grouped_dicoms[0][0].EchoTime))
-
+    # non integer scaling can be stored in the nifti header to keep the integer data (see settings)
+    scaling = None
     if output_file is not None:
-        # Save to disk
-        logger.info('Saving nifti to disk %s' % output_file)
-        nii_image.to_filename(output_file)
+        scaling = common.get_header_scaling([dicom_ for timepoint in grouped_dicoms for dicom_ in timepoint])
+
+    # Create data block and convert to nifti
+    logger.info('Creating data block')
+    nii_image = nifti_writer.create_4d_nifti(lambda allocate: _singleframe_to_block(grouped_dicoms, allocate,
+                                                                                    scaling is None),
+                                             affine,
+                                             output_file,
+                                             float(grouped_dicoms[0][0].RepetitionTime),
+                                             float(grouped_dicoms[0][0].EchoTime),
+                                             scaling)
 
     if _is_singleframe_diffusion_imaging(grouped_dicoms):
         bval_file = None
@@ -319,35 +328,14 @@ def _singleframe_to_nifti(grouped_dicoms, output_file):
             'NII': nii_image}
 
 
-def _singleframe_to_block(grouped_dicoms):
+def _singleframe_to_block(grouped_dicoms, allocate=None, rescale=True):
     """
     Generate a full datablock containing all timepoints
-    """
-    # For each slice / mosaic create a data volume block
-    data_blocks = []
-    for index in range(0, len(grouped_dicoms)):
-        logger.info('Creating block %s of %s' % (index + 1, len(grouped_dicoms)))
-        current_block = _stack_to_block(grouped_dicoms[index])
-        current_block = current_block[:, :, :, numpy.newaxis]
-        data_blocks.append(current_block)
-
-    try:
-        full_block = numpy.concatenate(data_blocks, axis=3)
-    except:
-        traceback.print_exc()
-        raise ConversionError("MISSING_DICOM_FILES")
-
-    # Apply the rescaling if needed
-    common.apply_scaling(full_block, grouped_dicoms[0][0])
-
-    return full_block
 
-
-def _stack_to_block(timepoint_dicoms):
-    """
-    Convert a mosaic slice to a block of data by reading the headers, splitting the mosaic and appending
+    :param allocate: function(shape, dtype) allocating the block (see common.get_4d_pixeldata)
+    :param rescale: apply the scaling to the data (see common.get_volume_pixeldata)
     """
-    return common.get_volume_pixeldata(timepoint_dicoms)
+    return common.get_4d_volume_pixeldata(grouped_dicoms, allocate, rescale)
 
 
 def _get_grouped_dicoms(dicom_input):
@@ -366,13 +354,13 @@ def _get_grouped_dicoms(dicom_input):
     timepoint_index = 0
     previous_stack_position = -1
 
+    # get the stack positions of all dicoms at once as this is a slow step
+    stack_positions = common.get_series_values(dicoms, Tag(0x2001, 0x100a), 'IS', default=0)
+
     # loop over all sorted dicoms
-    stack_position_tag = Tag(0x2001, 0x100a)  # put this there as this is a slow step and used a lot
     for index in range(0, len(dicoms)):
         dicom_ = dicoms[index]
-        stack_position = 0
-        if stack_position_tag in dicom_:
-            stack_position = common.get_is_value(dicom_[stack_position_tag])
+        stack_position = stack_positions[index]
         if previous_stack_position == stack_position:
             # if the stack number is the same we move to the next timepoint
             timepoint_index += 1
@@ -412,17 +400,20 @@ def _create_affine_multiframe(multiframe_dicom):
          [0, 0, 0, 1]])
 
 
-def _multiframe_to_block(multiframe_dicom):
+def _multiframe_to_unscaled_block(multiframe_dicom):
     """
-    Generate a full datablock containing all stacks
+    Generate a full datablock containing all stacks without applying the scaling
+
+    :return: tuple with the block and the scaling parameters of the frames (see common.do_series_scaling)
     """
     # Calculate the amount of stacks and slices in the stack
     number_of_stack_slices = int(common.get_ss_value(multiframe_dicom[Tag(0x2001, 0x105f)][0][Tag(0x2001, 0x102d)]))
     number_of_stacks = int(int(multiframe_dicom.NumberOfFrames) / number_of_stack_slices)
 
     # We create a numpy array
-    size_x = multiframe_dicom.pixel_array.shape[2]
-    size_y = multiframe_dicom.pixel_array.shape[1]
+    pixel_array = common.get_pixel_array(multiframe_dicom)
+    size_x = pixel_array.shape[2]
+    size_y = pixel_array.shape[1]
     size_z = number_of_stack_slices
     size_t = number_of_stacks
     # get the format
@@ -431,7 +422,22 @@ def _multiframe_to_block(multiframe_dicom):
     # get header info needed for ordering
     frame_info = multiframe_dicom[0x5200, 0x9230]
 
-    data_4d = numpy.zeros((size_z, size_y, size_x, size_t), dtype=format_string)
+    # the unscaled data is put directly in x, y, z, t order, the scaling is applied for all frames at once
+    full_block = numpy.zeros((size_x, size_y, size_z, size_t), dtype=format_string, order='F')
+    scaling_parameters = [(1, 0, 1.0, 0.0)] * (size_z * size_t)
+
+    # get the private scaling of all frames at once (frames without it are not scaled)
+    private_scale_slopes = numpy.ones(size_t * size_z)
+    private_scale_intercepts = numpy.zeros(size_t * size_z)
+    private_sequence_tag = Tag(0x2005, 0x140f)
+    private_frames = [slice_index for slice_index in range(0, size_t * size_z)
+                      if private_sequence_tag in frame_info[slice_index]]
+    if private_frames:
+        private_items = [frame_info[slice_index][private_sequence_tag][0] for slice_index in private_frames]
+        private_scale_intercepts[private_frames] = common.get_series_values(private_items, Tag(0x2005, 0x100d),
+                                                                            'FL', default=0.0)
+        private_scale_slopes[private_frames] = common.get_series_values(private_items, Tag(0x2005, 0x100e),
+                                                                        'FL', default=1.0)
 
     # loop over each slice and insert in datablock
     t_location_index = _get_t_position_index(multiframe_dicom)
@@ -443,40 +449,17 @@ def _multiframe_to_block(multiframe_dicom):
         else:
             t_location = frame_info[slice_index].FrameContentSequence[0].DimensionIndexValues[t_location_index] - 1
 
-        block_data = multiframe_dicom.pixel_array[slice_index, :, :]
-        # apply scaling
+        # transpose the slice so the directions are correct
+        full_block[:, :, z_location, t_location] = pixel_array[slice_index, :, :].T
+        # get the scaling
         rescale_intercept = frame_info[slice_index].PixelValueTransformationSequence[0].RescaleIntercept
         rescale_slope = frame_info[slice_index].PixelValueTransformationSequence[0].RescaleSlope
-        private_scale_slope = 1.0
-        private_scale_intercept = 0.0
-        private_sequence_tag = Tag(0x2005, 0x140f)
-        private_scale_intercept_tag = Tag(0x2005, 0x100d)
-        private_scale_slope_tag = Tag(0x2005, 0x100e)
-        if private_sequence_tag in frame_info[slice_index]:
-            if private_scale_intercept_tag in frame_info[slice_index][private_sequence_tag][0]:
-                private_scale_intercept = common.get_fl_value(frame_info[slice_index][private_sequence_tag][0][
-                                                                  private_scale_intercept_tag])
-            if private_scale_slope_tag in frame_info[slice_index][private_sequence_tag][0]:
-                private_scale_slope = common.get_fl_value(
-                    frame_info[slice_index][private_sequence_tag][0][private_scale_slope_tag])
-        block_data = common.do_scaling(block_data,
-                                       rescale_slope, rescale_intercept,
-                                       private_scale_slope, private_scale_intercept)
-        # switch to float if needed
-        if block_data.dtype != data_4d.dtype:
-            data_4d = data_4d.astype(block_data.dtype)
-        data_4d[z_location, :, :, t_location] = block_data
-
-    full_block = numpy.zeros((size_x, size_y, size_z, size_t), dtype=data_4d.dtype)
-
-    # loop over each stack and reorganize the data
-    for t_index in range(0, size_t):
-        # transpose the block so the directions are correct
-        data_3d = numpy.transpose(data_4d[:, :, :, t_index], (2, 1, 0))
-        # add the block the the full data
-        full_block[:, :, :, t_index] = data_3d
-
-    return full_block
+        private_scale_slope = float(private_scale_slopes[slice_index])
+        private_scale_intercept = float(private_scale_intercepts[slice_index])
+        scaling_parameters[z_location * size_t + t_location] = (rescale_slope, rescale_intercept,
+                                                                private_scale_slope, private_scale_intercept)
+
+    return full_block, scaling_parameters
 
 
 def _get_t_position_index(multiframe_dicom):
@@ -527,13 +510,16 @@ def _create_bvals_bvecs(multiframe_dicom, bval_file, bvec_file, nifti, nifti_fil
     bvals = numpy.zeros([number_of_stacks], dtype=numpy.int32)
     bvecs = numpy.zeros([number_of_stacks, 3])
 
-    # loop over all timepoints and create a list with all bvals and bvecs
-    for stack_index in range(0, number_of_stacks):
-        stack = multiframe_dicom[Tag(0x5200, 0x9230)][stack_index]
-        if str(stack[Tag(0x0018, 0x9117)][0][Tag(0x0018, 0x9075)].value) == 'DIRECTIONAL':
-            bvals[stack_index] = common.get_fd_value(stack[Tag(0x0018, 0x9117)][0][Tag(0x0018, 0x9087)])
-            bvecs[stack_index, :] = common.get_fd_array_value(stack[Tag(0x0018, 0x9117)][0]
-                                                              [Tag(0x0018, 0x9076)][0][Tag(0x0018, 0x9089)], 3)
+    # get the bvals and bvecs of all directional timepoints at once
+    diffusion_items = [multiframe_dicom[Tag(0x5200, 0x9230)][stack_index][Tag(0x0018, 0x9117)][0]
+                       for stack_index in range(0, number_of_stacks)]
+    directional = [index for index, diffusion_item in enumerate(diffusion_items)
+                   if str(diffusion_item[Tag(0x0018, 0x9075)].value) == 'DIRECTIONAL']
+    if directional:
+        directional_items = [diffusion_items[index] for index in directional]
+        bvals[directional] = common.get_series_values(directional_items, Tag(0x0018, 0x9087), 'FD')
+        bvecs[directional, :] = common.get_series_values([item[Tag(0x0018, 0x9076)][0] for item in directional_items],
+                                                         Tag(0x0018, 0x9089), 'FD', 3)
 
     # truncate nifti if needed
     nifti, bvals, bvecs = _fix_diffusion_images(bvals, bvecs, nifti, nifti_file)
@@ -564,9 +550,19 @@ def _fix_diffusion_images(bvals, bvecs, nifti, nifti_file):
     bvals = bvals[:-1]
     bvecs = bvecs[:-1]
 
-    # remove last elements from the nifti
-    new_nifti = nibabel.Nifti1Image(nifti.get_data()[:, :, :, :-1], nifti.affine)
-    new_nifti.to_filename(nifti_file)
+    # remove last elements from the nifti (keeping the scaling stored in the header)
+    data, scaling = nifti_writer.get_unscaled_data(nifti)
+    if nifti_writer.is_out_of_core(nifti_file):
+        # the data can be memory mapped from nifti_file so it is copied timepoint by timepoint
+        with nifti_writer.NiftiWriter(nifti_file, nifti.affine, scaling=scaling) as writer:
+            new_data = writer.allocate(data.shape[:3] + (data.shape[3] - 1,), data.dtype)
+            for timepoint in range(0, new_data.shape[3]):
+                new_data[:, :, :, timepoint] = data[:, :, :, timepoint]
+            new_nifti = writer.close()
+    else:
+        new_nifti = nibabel.Nifti1Image(data[:, :, :, :-1], nifti.affine)
+        nifti_writer.set_scaling(new_nifti, scaling)
+        new_nifti.to_filename(nifti_file)
 
     return new_nifti, bvals, bvecs
 
@@ -580,23 +576,22 @@ def _create_singleframe_bvals_bvecs(grouped_dicoms, bval_file, bvec_file, nifti,
     bvals = numpy.zeros([len(grouped_dicoms)], dtype=numpy.int32)
     bvecs = numpy.zeros([len(grouped_dicoms), 3])
 
-    # loop over all timepoints and create a list with all bvals and bvecs
+    # get the bvals and bvecs of all timepoints at once
+    first_dicoms = [stack[0] for stack in grouped_dicoms]
     if _is_bval_type_a(grouped_dicoms):
         bval_tag = Tag(0x2001, 0x1003)
         bvec_x_tag = Tag(0x2005, 0x10b0)
         bvec_y_tag = Tag(0x2005, 0x10b1)
         bvec_z_tag = Tag(0x2005, 0x10b2)
-        for stack_index in range(0, len(grouped_dicoms)):
-            bvals[stack_index] = common.get_fl_value(grouped_dicoms[stack_index][0][bval_tag])
-            bvecs[stack_index, :] = [common.get_fl_value(grouped_dicoms[stack_index][0][bvec_x_tag]),
-                                     common.get_fl_value(grouped_dicoms[stack_index][0][bvec_y_tag]),
-                                     common.get_fl_value(grouped_dicoms[stack_index][0][bvec_z_tag])]
+        bvals[:] = common.get_series_values(first_dicoms, bval_tag, 'FL')
+        bvecs[:, 0] = common.get_series_values(first_dicoms, bvec_x_tag, 'FL')
+        bvecs[:, 1] = common.get_series_values(first_dicoms, bvec_y_tag, 'FL')
+        bvecs[:, 2] = common.get_series_values(first_dicoms, bvec_z_tag, 'FL')
     elif _is_bval_type_b(grouped_dicoms):
         bval_tag = Tag(0x0018, 0x9087)
         bvec_tag = Tag(0x0018, 0x9089)
-        for stack_index in range(0, len(grouped_dicoms)):
-            bvals[stack_index] = common.get_fd_value(grouped_dicoms[stack_index][0][bval_tag])
-            bvecs[stack_index, :] = common.get_fd_array_value(grouped_dicoms[stack_index][0][bvec_tag], 3)
+        bvals[:] = common.get_series_values(first_dicoms, bval_tag, 'FD')
+        bvecs[:, :] = common.get_series_values(first_dicoms, bvec_tag, 'FD', 3)
 
     # truncate nifti if needed
     nifti, bvals, bvecs = _fix_diffusion_images(bvals, bvecs, nifti, nifti_file)
@@ -10,27 +10,46 @@ import dicom2nifti.patch_pydicom_encodings
 
 dicom2nifti.patch_pydicom_encodings.apply()
 
+import functools
 import os
 import re
+import struct
 import traceback
 
 import logging
-import nibabel
 import numpy
 
 from pydicom.tag import Tag
 
 import dicom2nifti.common as common
 import dicom2nifti.convert_generic as convert_generic
+import dicom2nifti.nifti_writer as nifti_writer
+import dicom2nifti.settings as settings
 from dicom2nifti.exceptions import ConversionValidationError, ConversionError
 
 logger = logging.getLogger(__name__)
 
+# a "name = value" line of the ascconv headers
+_ASCCONV_PARAMETER = re.compile(r'^[ \t]*([^\s=]+)[ \t]*=[ \t]*([^\r\n]*)', re.MULTILINE)
+
+# layout of the siemens CSA headers (name, vm, vr, syngodt, number of items, unused) and of its items
+_CSA_ELEMENT = struct.Struct('<64si4s3i')
+_CSA_ITEM = struct.Struct('<4i')
+_CSA_MAX_ITEMS = 1000
+_CSA_CONVERTERS = {'FL': float, 'FD': float, 'DS': float,
+                   'IS': int, 'SL': int, 'SS': int, 'UL': int, 'US': int}
+# attribute of a dataset in which its parsed csa headers are kept (tag -> (raw value, parsed header))
+_CSA_HEADER_ATTRIBUTE = '_dicom2nifti_csa_headers'
+
 
 # Disable this warning as there is not reason for an init class in an enum
 # pylint: disable=w0232, r0903, E1101
 
 
+# minimum difference (in mm) in slice location between timepoints of a classic 4d series that is not float noise
+SLICE_LOCATION_TOLERANCE = 1e-3
+
+
 class MosaicType(object):
     """
     Enum for the possible types of mosaic data
@@ -141,21 +160,17 @@ def _mosaic_4d_to_nifti(dicom_input, output_file):
     sorted_mosaics = _get_sorted_mosaics(dicom_input)
     common.validate_orientation(sorted_mosaics)
 
-    # Create mosaic block
-    logger.info('Creating data block')
-    full_block = _mosaic_get_full_block(sorted_mosaics)
-
     logger.info('Creating affine')
     # Create the nifti header info
     affine = _create_affine_siemens_mosaic(dicom_input)
-    logger.info('Creating nifti')
-    # Convert to nifti
-    nii_image = nibabel.Nifti1Image(full_block, affine)
-    common.set_tr_te(nii_image, float(sorted_mosaics[0].RepetitionTime), float(sorted_mosaics[0].EchoTime))
-    logger.info('Saving nifti to disk')
-    # Save to disk
-    if output_file is not None:
-        nii_image.to_filename(output_file)
+
+    # Create mosaic block and convert to nifti
+    logger.info('Creating data block')
+    nii_image = nifti_writer.create_4d_nifti(lambda allocate: _mosaic_get_full_block(sorted_mosaics, allocate),
+                                             affine,
+                                             output_file,
+                                             float(sorted_mosaics[0].RepetitionTime),
+                                             float(sorted_mosaics[0].EchoTime))
 
     if _is_diffusion_imaging(dicom_input[0]):
         # Create the bval en bvec files
@@ -188,26 +203,31 @@ def _classic_4d_to_nifti(grouped_dicoms, output_file):
     Some inspiration on which fields can be used was taken from
     http://slicer.org/doc/html/DICOMDiffusionVolumePlugin_8py_source.html
     """
+    # validate the timepoints before any data is read
+    _classic_validate_grouped_dicoms(grouped_dicoms)
+
     # Get the sorted mosaics
     all_dicoms = [i for sl in grouped_dicoms for i in sl]  # combine into 1 list for validating
     common.validate_orientation(all_dicoms)
 
-    # Create mosaic block
-    logger.info('Creating data block')
-    full_block = _classic_get_full_block(grouped_dicoms)
-
     logger.info('Creating affine')
     # Create the nifti header info
     affine = common.create_affine(grouped_dicoms[0])
 
-    logger.info('Creating nifti')
-    # Convert to nifti
-    nii_image = nibabel.Nifti1Image(full_block, affine)
-    common.set_tr_te(nii_image, float(grouped_dicoms[0][0].RepetitionTime), float(grouped_dicoms[0][0].EchoTime))
-    logger.info('Saving nifti to disk')
-    # Save to disk
+    # non integer scaling can be stored in the nifti header to keep the integer data (see settings)
+    scaling = None
     if output_file is not None:
-        nii_image.to_filename(output_file)
+        scaling = common.get_header_scaling(all_dicoms)
+
+    # Create data block and convert to nifti
+    logger.info('Creating data block')
+    nii_image = nifti_writer.create_4d_nifti(lambda allocate: _classic_get_full_block(grouped_dicoms, allocate,
+                                                                                      scaling is None),
+                                             affine,
+                                             output_file,
+                                             float(grouped_dicoms[0][0].RepetitionTime),
+                                             float(grouped_dicoms[0][0].EchoTime),
+                                             scaling)
 
     if _is_diffusion_imaging(grouped_dicoms[0][0]):
         logger.info('Creating bval en bvec')
@@ -236,87 +256,84 @@ def _classic_4d_to_nifti(grouped_dicoms, output_file):
 
 def _classic_get_grouped_dicoms(dicom_input):
     """
-    Search all dicoms in the dicom directory, sort and validate them
+    Search all dicoms in the dicom directory, sort and group them per timepoint (see _classic_validate_grouped_dicoms
+    for the validation of the groups)
 
-    fast_read = True will only read the headers not the data
+    The dicoms are grouped on acquisition number with a stable argsort so the slices of every timepoint keep their
+    sorted order. Missing acquisition numbers result in empty timepoints.
     """
-    # Loop overall files and build dict
     # Order all dicom files by InstanceNumber
     if [d for d in dicom_input if 'InstanceNumber' in d]:
         dicoms = sorted(dicom_input, key=lambda x: x.InstanceNumber)
     else:
         dicoms = common.sort_dicoms(dicom_input)
 
-    # now group per stack
-    grouped_dicoms = []
+    # the acquisition number is the timepoint of the slice
+    acquisition_numbers = common.get_series_values(dicoms, Tag(0x0020, 0x0012), 'IS', default=1)
+    stack_indexes = acquisition_numbers - acquisition_numbers.min()
+    stack_sizes = numpy.bincount(stack_indexes)
+    sorted_indexes = numpy.argsort(stack_indexes, kind='mergesort')
 
-    # loop over all sorted dicoms
-    stack_position_tag = Tag(0x0020, 0x0012)  # in this case it is the acquisition number
-    for index in range(0, len(dicoms)):
-        dicom_ = dicoms[index]
-        if stack_position_tag not in dicom_:
-            stack_index = 0
-        else:
-            stack_index = dicom_[stack_position_tag].value - 1
-        while len(grouped_dicoms) <= stack_index:
-            grouped_dicoms.append([])
-        grouped_dicoms[stack_index].append(dicom_)
-
-    return grouped_dicoms
+    return [[dicoms[index] for index in stack]
+            for stack in numpy.split(sorted_indexes, numpy.cumsum(stack_sizes)[:-1])]
 
 
-def _classic_get_full_block(grouped_dicoms):
+def _classic_validate_grouped_dicoms(grouped_dicoms):
     """
-    Generate a full datablock containing all timepoints
+    Validate the timepoints of a classic 4d series before any data is read
+    All timepoints should have the same number of slices and the slices should be at the same locations (within half
+    the slice distance, so small position updates by prospective motion correction are allowed)
     """
-    # For each slice / mosaic create a data volume block
-    data_blocks = []
-    for index in range(0, len(grouped_dicoms)):
-        logger.info('Creating block %s of %s' % (index + 1, len(grouped_dicoms)))
-        data_blocks.append(_classic_timepoint_to_block(grouped_dicoms[index]))
+    stack_sizes = numpy.array([len(stack) for stack in grouped_dicoms])
+    if numpy.any(stack_sizes != stack_sizes[0]):
+        logger.warning('Missing slices (slice count per timepoint: %s)' % stack_sizes)
+        raise ConversionError('MISSING_DICOM_FILES')
 
-    # Add the data_blocks together to one 4d block
-    size_x = numpy.shape(data_blocks[0])[0]
-    size_y = numpy.shape(data_blocks[0])[1]
-    size_z = numpy.shape(data_blocks[0])[2]
-    size_t = len(data_blocks)
-    full_block = numpy.zeros((size_x, size_y, size_z, size_t), dtype=data_blocks[0].dtype)
-    for index in range(0, size_t):
-        full_block[:, :, :, index] = data_blocks[index]
+    if not settings.validate_sliceincrement or stack_sizes[0] < 2:
+        return
+    # the location of every slice along the slice normal (timepoints x slices)
+    image_orientation = numpy.array(grouped_dicoms[0][0].ImageOrientationPatient, dtype=float)
+    slice_normal = numpy.cross(image_orientation[0:3], image_orientation[3:6])
+    image_positions = numpy.array([[dicom_.ImagePositionPatient for dicom_ in stack] for stack in grouped_dicoms],
+                                  dtype=float)
+    slice_locations = numpy.dot(image_positions, slice_normal)
+    # half the slice distance, slices at the same location (or float noise) fall back to a fixed minimum
+    unique_locations = numpy.unique(slice_locations[0])
+    slice_distance = numpy.min(numpy.diff(unique_locations)) if len(unique_locations) > 1 else 0.0
+    tolerance = max(slice_distance / 2, SLICE_LOCATION_TOLERANCE)
+    inconsistent = numpy.any(numpy.abs(slice_locations - slice_locations[0]) > tolerance, axis=1)
+    if numpy.any(inconsistent):
+        logger.warning('Slice positions of timepoint %s differ from the first timepoint' %
+                       numpy.flatnonzero(inconsistent)[0])
+        raise ConversionValidationError('SLICE_POSITIONS_INCONSISTENT')
 
-    return full_block
 
-
-def _classic_timepoint_to_block(timepoint_dicoms):
+def _classic_get_full_block(grouped_dicoms, allocate=None, rescale=True):
     """
-    Convert slices to a block of data by reading the headers and appending
+    Generate a full datablock containing all timepoints
+
+    :param allocate: function(shape, dtype) allocating the block (see common.get_4d_pixeldata)
+    :param rescale: apply the scaling to the data (see common.get_volume_pixeldata)
     """
-    # similar way of getting the block to anatomical however here we are creating the dicom series our selves
-    return common.get_volume_pixeldata(timepoint_dicoms)
+    return common.get_4d_volume_pixeldata(grouped_dicoms, allocate, rescale)
 
 
-def _mosaic_get_full_block(sorted_mosaics):
+def _mosaic_get_full_block(sorted_mosaics, allocate=None):
     """
     Generate a full datablock containing all timepoints
-    """
-    # For each slice / mosaic create a data volume block
-    data_blocks = []
-    for index in range(0, len(sorted_mosaics)):
-        data_blocks.append(_mosaic_to_block(sorted_mosaics[index]))
-
-    # Add the data_blocks together to one 4d block
-    size_x = numpy.shape(data_blocks[0])[0]
-    size_y = numpy.shape(data_blocks[0])[1]
-    size_z = numpy.shape(data_blocks[0])[2]
-    size_t = len(data_blocks)
-    full_block = numpy.zeros((size_x, size_y, size_z, size_t), dtype=data_blocks[0].dtype)
-    for index in range(0, size_t):
-        full_block[:, :, :, index] = data_blocks[index]
 
-    # Apply the rescaling if needed
-    common.apply_scaling(full_block, sorted_mosaics[0])
-
-    return full_block
+    :param allocate: function(shape, dtype) allocating the block (see common.get_4d_pixeldata)
+    """
+    # all mosaics of a series share the same protocol so it is only parsed once (if it is needed)
+    protocol_cache = {}
+    # the block is sized from the headers of the first mosaic so it is allocated only once
+    shape = tuple(_get_mosaic_size(sorted_mosaics[0], protocol_cache)) + (len(sorted_mosaics),)
+    dtype = numpy.dtype(common.get_numpy_type(sorted_mosaics[0]))
+    for mosaic in sorted_mosaics[1:]:
+        dtype = numpy.promote_types(dtype, common.get_numpy_type(mosaic))
+    return common.get_4d_pixeldata(sorted_mosaics,
+                                   functools.partial(_mosaic_to_block, protocol_cache=protocol_cache),
+                                   allocate, shape, dtype)
 
 
 def _get_sorted_mosaics(dicom_input):
@@ -345,36 +362,183 @@ def _get_asconv_headers(mosaic):
     return asconv_headers
 
 
-def _get_mosaic_type(mosaic):
+def _get_ascconv_protocol(mosaic, protocol_cache=None):
+    """
+    Parse the ascconv headers into a dict with the (unparsed) value of every parameter, for example
+    {'sSliceArray.lSize': '36', 'sSliceArray.asSlice[0].sPosition.dTra': '-59.85445753', ...}
+    Parsing the headers once avoids scanning the full text for every parameter that is needed.
+
+    :param mosaic: the mosaic to parse the headers of
+    :param protocol_cache: dict to cache the parsed protocols in (keyed by the raw headers, which all mosaics of a
+                           series share)
+    """
+    raw_headers = mosaic[Tag(0x0029, 0x1020)].value
+    if protocol_cache is not None and raw_headers in protocol_cache:
+        return protocol_cache[raw_headers]
+
+    protocol = {}
+    for key, value in _ASCCONV_PARAMETER.findall(_get_asconv_headers(mosaic)):
+        # like a search in the text the first occurrence of a parameter is used
+        protocol.setdefault(key, value.strip())
+    if protocol_cache is not None:
+        protocol_cache[raw_headers] = protocol
+    return protocol
+
+
+def _get_ascconv_value(protocol, key, pattern):
+    """
+    Get the part of the value of a protocol parameter that matches the pattern
+    None if the parameter is not there or its value does not match
+    """
+    if key not in protocol:
+        return None
+    match = re.match(pattern, protocol[key])
+    if match is None:
+        return None
+    return match.group(0)
+
+
+def parse_csa_header(csa_bytes):
+    """
+    Parse a siemens CSA header, the binary format of the image header (0029,1010) and series header (0029,1020)
+    Both the old CSA1 format and the CSA2 format (starting with SV10) are supported.
+
+    :param csa_bytes: the raw value of the CSA header
+    :return: dict with for every element in the header the list of its values, converted to int or float based on
+             the VR of the element (for example {'NumberOfImagesInMosaic': [48], 'B_value': [1000], ...})
     """
-    Check the extra ascconv headers for the mosaic type based on the slice position
+    csa_bytes = bytes(csa_bytes)
+    offset = 0
+    is_csa2 = csa_bytes[:4] == b'SV10'
+    if is_csa2:
+        offset = 8
+    try:
+        number_of_elements = struct.unpack_from('<I', csa_bytes, offset)[0]
+        offset += 8
+        if not 0 < number_of_elements <= _CSA_MAX_ITEMS:
+            raise ConversionError('INVALID_CSA_HEADER')
+
+        csa_header = {}
+        csa1_length_offset = 0
+        for element_index in range(number_of_elements):
+            name, value_multiplicity, vr, _, number_of_items, _ = _CSA_ELEMENT.unpack_from(csa_bytes, offset)
+            offset += _CSA_ELEMENT.size
+            if number_of_items > _CSA_MAX_ITEMS:
+                raise ConversionError('INVALID_CSA_HEADER')
+            if element_index == 1:
+                # the item lengths in CSA1 are offset by the number of items of the second element
+                csa1_length_offset = number_of_items
+            converter = _CSA_CONVERTERS.get(_csa_string(vr))
+            number_of_values = value_multiplicity if value_multiplicity > 0 else number_of_items
+
+            values = []
+            for item_index in range(number_of_items):
+                item_header = _CSA_ITEM.unpack_from(csa_bytes, offset)
+                offset += _CSA_ITEM.size
+                if is_csa2:
+                    item_length = item_header[1]
+                    if offset + item_length > len(csa_bytes):
+                        raise ConversionError('INVALID_CSA_HEADER')
+                else:
+                    item_length = item_header[0] - csa1_length_offset
+                    if item_length < 0 or offset + item_length > len(csa_bytes):
+                        break
+                if item_index < number_of_values:
+                    value = _csa_string(csa_bytes[offset:offset + item_length])
+                    if converter is None:
+                        values.append(value)
+                    elif item_length == 0:
+                        # numeric values end at the first empty item
+                        number_of_values = item_index
+                    else:
+                        values.append(converter(value))
+                # items are padded to a multiple of 4 bytes
+                offset += item_length + (-item_length % 4)
+            csa_header[_csa_string(name)] = values
+    except (struct.error, ValueError):
+        raise ConversionError('INVALID_CSA_HEADER')
+    return csa_header
+
+
+def _csa_string(value):
+    """
+    Convert a null terminated string of a CSA header
+    """
+    return value.split(b'\x00', 1)[0].decode('ISO-8859-1').strip()
+
+
+def get_csa_header(dicom_headers, tag=Tag(0x0029, 0x1010)):
+    """
+    Get the parsed CSA header of a dataset (see parse_csa_header)
+    The parsed header is memoized on the dataset itself so asking for several values of the same dataset only parses
+    its header once (and it is released together with the dataset).
+
+    :param dicom_headers: the dataset to get the CSA header of
+    :param tag: tag of the CSA header, the image header (0029,1010) by default or the series header (0029,1020)
+    :return: dict with the values of the CSA header, None if the dataset has no (valid) CSA header
+    """
+    if tag not in dicom_headers:
+        return None
+    csa_bytes = dicom_headers[tag].value
+    csa_headers = dicom_headers.__dict__.setdefault(_CSA_HEADER_ATTRIBUTE, {})
+    # the raw value is kept to notice a replaced element
+    if tag in csa_headers and csa_headers[tag][0] is csa_bytes:
+        return csa_headers[tag][1]
+
+    try:
+        csa_header = parse_csa_header(csa_bytes)
+    except ConversionError:
+        logger.warning('Unable to read the CSA header %s' % tag)
+        csa_header = None
+    csa_headers[tag] = (csa_bytes, csa_header)
+    return csa_header
+
+
+def _get_csa_values(dicom_headers, name, count=1):
+    """
+    Get the values of an element of the CSA image header of a dataset
+    None if there is no CSA header or if the element has less than count values
+    """
+    csa_header = get_csa_header(dicom_headers)
+    if csa_header is None or len(csa_header.get(name, [])) < count:
+        return None
+    return csa_header[name][:count]
+
+
+def _get_mosaic_type(mosaic, protocol_cache=None):
+    """
+    Check the extra ascconv headers for the mosaic type based on the slice position (the order of the slices in the
+    mosaic)
     We always assume axial in this case
     the implementation resembles the last lines of documentation in
     https://www.icts.uiowa.edu/confluence/plugins/viewsource/viewpagesrc.action?pageId=54756326
-    """
+    NOTE: the SliceNormalVector of the CSA image header is not used for this as the mosaic tiles are not stored along
+    it (for SIEMENS_FMRI the normal equals the cross product of the row and column direction while the slices are
+    stored descending)
 
-    ascconv_headers = _get_asconv_headers(mosaic)
+    :param protocol_cache: dict to cache the parsed ascconv headers in (see _get_ascconv_protocol)
+    """
+    protocol = _get_ascconv_protocol(mosaic, protocol_cache)
 
     try:
-        size = int(re.findall(r'sSliceArray\.lSize\s*=\s*(\d+)', ascconv_headers)[0])
+        size = int(_get_ascconv_value(protocol, 'sSliceArray.lSize', r'\d+'))
 
         # get the locations of the slices
         slice_location = [None] * size
         for index in range(size):
-            axial_result = re.findall(
-                r'sSliceArray\.asSlice\[%s\]\.sPosition\.dTra\s*=\s*([-+]?[0-9]*\.?[0-9]*)' % index,
-                ascconv_headers)
-            if len(axial_result) > 0:
-                axial = float(axial_result[0])
+            axial_result = _get_ascconv_value(protocol, 'sSliceArray.asSlice[%s].sPosition.dTra' % index,
+                                              r'[-+]?[0-9]*\.?[0-9]*')
+            if axial_result is not None:
+                axial = float(axial_result)
             else:
                 axial = 0.0
             slice_location[index] = axial
 
         # should we invert (https://www.icts.uiowa.edu/confluence/plugins/viewsource/viewpagesrc.action?pageId=54756326)
         invert = False
-        invert_result = re.findall(r'sSliceArray\.ucImageNumbTra\s*=\s*([-+]?0?x?[0-9]+)', ascconv_headers)
-        if len(invert_result) > 0:
-            invert_value = int(invert_result[0], 16)
+        invert_result = _get_ascconv_value(protocol, 'sSliceArray.ucImageNumbTra', r'[-+]?0?x?[0-9]+')
+        if invert_result is not None:
+            invert_value = int(invert_result, 16)
             if invert_value >= 0:
                 invert = True
 
@@ -394,48 +558,66 @@ def _get_mosaic_type(mosaic):
         raise ConversionError("MOSAIC_TYPE_NOT_SUPPORTED")
 
 
-def _mosaic_to_block(mosaic):
-    """
-    Convert a mosaic slice to a block of data by reading the headers, splitting the mosaic and appending
+def _get_mosaic_size(mosaic, protocol_cache=None):
     """
-    # get the mosaic type
-    mosaic_type = _get_mosaic_type(mosaic)
+    Get the size of the block of a mosaic (tile size and number of slices) from the headers
 
+    :param protocol_cache: dict to cache the parsed ascconv headers in (see _get_ascconv_protocol)
+    """
     # get the size of one tile format is 64p*64 or 80*80 or something similar
     matches = re.findall(r'(\d+)\D+(\d+)\D*', str(mosaic[Tag(0x0051, 0x100b)].value))[0]
 
-    ascconv_headers = _get_asconv_headers(mosaic)
-    size = [int(matches[0]),
+    number_of_slices = _get_csa_values(mosaic, 'NumberOfImagesInMosaic')
+    if number_of_slices is None:
+        protocol = _get_ascconv_protocol(mosaic, protocol_cache)
+        number_of_slices = [_get_ascconv_value(protocol, 'sSliceArray.lSize', r'\d+')]
+
+    return [int(matches[0]),
             int(matches[1]),
-            int(re.findall(r'sSliceArray\.lSize\s*=\s*(\d+)', ascconv_headers)[0])]
-
-    # get the number of rows and columns
-    number_x = int(mosaic.Rows / size[0])
-    number_y = int(mosaic.Columns / size[1])
-
-    # recreate 2d slice
-    data_2d = mosaic.pixel_array
-    # create 3d block
-    data_3d = numpy.zeros((size[2], size[1], size[0]), dtype=data_2d.dtype)
-    # fill 3d block by taking the correct portions of the slice
-    z_index = 0
-    for y_index in range(0, number_y):
-        if z_index >= size[2]:
-            break
-        for x_index in range(0, number_x):
-            if mosaic_type == MosaicType.ASCENDING:
-                data_3d[z_index, :, :] = data_2d[size[1] * y_index:size[1] * (y_index + 1),
-                                         size[0] * x_index:size[0] * (x_index + 1)]
-            else:
-                data_3d[size[2] - (z_index + 1), :, :] = data_2d[size[1] * y_index:size[1] * (y_index + 1),
-                                                         size[0] * x_index:size[0] * (x_index + 1)]
-            z_index += 1
-            if z_index >= size[2]:
-                break
-    # reorient the block of data
-    data_3d = numpy.transpose(data_3d, (2, 1, 0))
+            int(number_of_slices[0])]
+
 
-    return data_3d
+def _mosaic_to_block(mosaic, protocol_cache=None):
+    """
+    Convert a mosaic slice to a block of data by reading the headers, splitting the mosaic and appending
+
+    :param protocol_cache: dict to cache the parsed ascconv headers in (see _get_ascconv_protocol)
+    """
+    # get the mosaic type
+    mosaic_type = _get_mosaic_type(mosaic, protocol_cache)
+
+    size = _get_mosaic_size(mosaic, protocol_cache)
+
+    return _unpack_mosaic(common.get_pixel_array(mosaic), size, mosaic_type)
+
+
+def _unpack_mosaic(mosaic_data, size, mosaic_type):
+    """
+    Split the tiles of a mosaic into a x,y,z block
+    The tiles are taken out of the mosaic with a reshape to rows x tile_y x columns x tile_x followed by a swap of
+    the axes, so the data is copied only once. This also works for a stack of mosaics (t x rows x columns) which
+    results in the x,y,z,t block of all of them.
+
+    :param mosaic_data: rows x columns data of the mosaic (or t x rows x columns for a stack of mosaics)
+    :param size: tile x size, tile y size and number of slices (see _get_mosaic_size)
+    :param mosaic_type: ascending or descending slice order (see _get_mosaic_type)
+    :return: x,y,z block (x,y,z,t for a stack of mosaics)
+    """
+    stack_shape = mosaic_data.shape[:-2]
+    number_y = mosaic_data.shape[-2] // size[1]
+    number_x = mosaic_data.shape[-1] // size[0]
+    tiles = mosaic_data[..., :number_y * size[1], :number_x * size[0]]
+    tiles = tiles.reshape(stack_shape + (number_y, size[1], number_x, size[0])).swapaxes(-3, -2)
+    tiles = tiles.reshape(stack_shape + (number_y * number_x, size[1], size[0]))[..., :size[2], :, :]
+    if tiles.shape[-3] < size[2]:
+        # slices that are not in the mosaic are left empty
+        missing_tiles = numpy.zeros(stack_shape + (size[2] - tiles.shape[-3], size[1], size[0]), dtype=tiles.dtype)
+        tiles = numpy.concatenate([tiles, missing_tiles], axis=-3)
+    if mosaic_type != MosaicType.ASCENDING:
+        tiles = tiles[..., ::-1, :, :]
+    # reorient the block of data (..., z, y, x to x, y, z, ...)
+    stack_axes = tuple(range(len(stack_shape)))
+    return tiles.transpose((len(stack_shape) + 2, len(stack_shape) + 1, len(stack_shape)) + stack_axes)
 
 
 def _create_affine_siemens_mosaic(dicom_input):
@@ -469,17 +651,10 @@ def _create_bvals(sorted_dicoms, bval_file):
     """
     Write the bvals from the sorted dicom files to a bval file
     """
-    bvals = []
-    for index in range(0, len(sorted_dicoms)):
-        if type(sorted_dicoms[0]) is list:
-            dicom_headers = sorted_dicoms[index][0]
-        else:
-            dicom_headers = sorted_dicoms[index]
-
-        bvals.append(common.get_is_value(dicom_headers[Tag(0x0019, 0x100c)]))
+    bvals = _get_bvals(_get_first_headers(sorted_dicoms))
     # save the found bvecs to the file
     common.write_bval_file(bvals, bval_file)
-    return numpy.array(bvals)
+    return bvals
 
 
 def _create_bvecs(sorted_dicoms, bvec_file):
@@ -488,13 +663,10 @@ def _create_bvecs(sorted_dicoms, bvec_file):
     # inspired by dicom2nii from mricron
     # see  http://users.fmrib.ox.ac.uk/~robson/internal/Dicom2Nifti111.m
     """
-    if type(sorted_dicoms[0]) is list:
-        dicom_headers = sorted_dicoms[0][0]
-    else:
-        dicom_headers = sorted_dicoms[0]
+    dicom_headers = _get_first_headers(sorted_dicoms)
 
     # get the patient orientation
-    image_orientation = dicom_headers.ImageOrientationPatient
+    image_orientation = dicom_headers[0].ImageOrientationPatient
     read_vector = numpy.array([float(image_orientation[0]), float(image_orientation[1]), float(image_orientation[2])])
     phase_vector = numpy.array([float(image_orientation[3]), float(image_orientation[4]), float(image_orientation[5])])
     mosaic_vector = numpy.cross(read_vector, phase_vector)
@@ -503,32 +675,59 @@ def _create_bvecs(sorted_dicoms, bvec_file):
     read_vector /= numpy.linalg.norm(read_vector)
     phase_vector /= numpy.linalg.norm(phase_vector)
     mosaic_vector /= numpy.linalg.norm(mosaic_vector)
-    # create an empty array for the new bvecs
-    bvecs = numpy.zeros([len(sorted_dicoms), 3])
-    # for each slice calculate the new bvec
-    for index in range(0, len(sorted_dicoms)):
-        if type(sorted_dicoms[0]) is list:
-            dicom_headers = sorted_dicoms[index][0]
-        else:
-            dicom_headers = sorted_dicoms[index]
-
-        # get the bval als this is needed in some checks
-        bval = common.get_is_value(dicom_headers[Tag(0x0019, 0x100c)])
-        # get the bvec if it exists in the headers
-        bvec = numpy.array([0, 0, 0])
-        if Tag(0x0019, 0x100e) in dicom_headers:
-            # in case of implicit VR the private field cannot be split into an array, we do this here
-            bvec = numpy.array(common.get_fd_array_value(dicom_headers[Tag(0x0019, 0x100e)], 3))
-        # if bval is 0 or the vector is 0 no projection is needed and the vector is 0,0,0
-        new_bvec = numpy.array([0, 0, 0])
-
-        if bval > 0 and not (bvec == [0, 0, 0]).all():
-            # project the bvec and invert the y direction
-            new_bvec = numpy.array(
-                [numpy.dot(bvec, read_vector), -numpy.dot(bvec, phase_vector), numpy.dot(bvec, mosaic_vector)])
-            # normalize the bvec
-            new_bvec /= numpy.linalg.norm(new_bvec)
-        bvecs[index, :] = new_bvec
-        # save the found bvecs to the file
-        common.write_bvec_file(bvecs, bvec_file)
-    return numpy.array(bvecs)
+
+    # get the bvals als these are needed in some checks
+    bvals = _get_bvals(dicom_headers)
+    # get the bvecs if they exist in the headers
+    bvecs = _get_bvecs(dicom_headers)
+
+    # if bval is 0 or the vector is 0 no projection is needed and the vector is 0,0,0
+    new_bvecs = numpy.zeros([len(dicom_headers), 3])
+    projected = (bvals > 0) & numpy.any(bvecs != 0, axis=1)
+    # project the bvecs and invert the y direction
+    new_bvecs[projected, 0] = numpy.dot(bvecs[projected], read_vector)
+    new_bvecs[projected, 1] = -numpy.dot(bvecs[projected], phase_vector)
+    new_bvecs[projected, 2] = numpy.dot(bvecs[projected], mosaic_vector)
+    # normalize the bvecs
+    new_bvecs[projected] /= numpy.linalg.norm(new_bvecs[projected], axis=1)[:, numpy.newaxis]
+    # save the found bvecs to the file
+    common.write_bvec_file(new_bvecs, bvec_file)
+    return new_bvecs
+
+
+def _get_first_headers(sorted_dicoms):
+    """
+    Get the headers of every timepoint (the first slice for classic dicoms grouped per timepoint)
+    """
+    if type(sorted_dicoms[0]) is list:
+        return [timepoint_dicoms[0] for timepoint_dicoms in sorted_dicoms]
+    return list(sorted_dicoms)
+
+
+def _get_bvals(dicom_headers):
+    """
+    Get the bvals of the datasets from the CSA image headers, or from the private field (0019,100c) for the datasets
+    without it
+    """
+    bvals = [_get_csa_values(dicom_header, 'B_value') for dicom_header in dicom_headers]
+    missing = [index for index, bval in enumerate(bvals) if bval is None]
+    if missing:
+        private_bvals = common.get_series_values([dicom_headers[index] for index in missing],
+                                                 Tag(0x0019, 0x100c), 'IS')
+        for index, bval in zip(missing, private_bvals):
+            bvals[index] = [bval]
+    return numpy.array([bval[0] for bval in bvals])
+
+
+def _get_bvecs(dicom_headers):
+    """
+    Get the (not projected) bvecs of the datasets from the CSA image headers, or from the private field (0019,100e)
+    for the datasets without it (0,0,0 if that is not there either)
+    """
+    # in case of implicit VR the private field cannot be split into an array, get_series_values handles this
+    bvecs = common.get_series_values(dicom_headers, Tag(0x0019, 0x100e), 'FD', 3, default=[0, 0, 0])
+    for index, dicom_header in enumerate(dicom_headers):
+        bvec = _get_csa_values(dicom_header, 'DiffusionGradientDirection', 3)
+        if bvec is not None:
+            bvecs[index] = bvec
+    return bvecs
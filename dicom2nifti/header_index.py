@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent on disk index of the dicom headers, used to avoid re-reading unchanged files when grouping them into series
+
+@author: abrys
+"""
+from __future__ import print_function
+
+import json
+import logging
+import numbers
+import os
+import sqlite3
+import threading
+
+import pydicom
+from pydicom.multival import MultiValue
+
+import dicom2nifti.common as common
+import dicom2nifti.compressed_dicom as compressed_dicom
+
+logger = logging.getLogger(__name__)
+
+# increase when the stored fields change so old indexes are rebuilt
+INDEX_VERSION = 3
+
+# header fields needed to index, validate and name the series
+HEADER_FIELDS = common.CLASSIFICATION_TAGS
+
+FILE_META_FIELDS = ['MediaStorageSOPClassUID',
+                    'TransferSyntaxUID']
+
+# number of new entries after which they are committed, so an interrupted scan keeps most of its work
+COMMIT_INTERVAL = 1000
+
+
+class HeaderIndex(object):
+    """
+    SQLite backed cache of the header fields used while indexing a dicom directory
+    Entries are keyed by the file path, size and modification time so changed files are read again.
+    Files that are not dicom are stored too so they are skipped on the next run.
+    New entries are committed every commit_interval puts (and by commit and close).
+    """
+
+    def __init__(self, index_file, commit_interval=COMMIT_INTERVAL):
+        """
+        :param index_file: the sqlite file of the index
+        :param commit_interval: number of new entries after which they are committed
+        """
+        self.index_file = index_file
+        self.commit_interval = commit_interval
+        self._pending_puts = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(index_file, check_same_thread=False)
+        self._create_tables()
+
+    def _create_tables(self):
+        with self._lock:
+            version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+            if version != INDEX_VERSION:
+                logger.info('Creating header index %s' % self.index_file)
+                self._connection.execute('DROP TABLE IF EXISTS headers')
+                self._connection.execute('PRAGMA user_version = %d' % INDEX_VERSION)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS headers ('
+                                     'path TEXT PRIMARY KEY, '
+                                     'size INTEGER, '
+                                     'mtime REAL, '
+                                     'is_dicom INTEGER, '
+                                     'transfer_syntax TEXT, '
+                                     'header TEXT)')
+            self._connection.commit()
+
+    def get(self, file_path):
+        """
+        Get the cached probe of a file
+
+        :param file_path: the file to look up
+        :returns: DicomProbe with a header containing only the indexed fields, None if not cached or changed
+        """
+        file_path = os.path.abspath(file_path)
+        statinfo = os.stat(file_path)
+        with self._lock:
+            row = self._connection.execute('SELECT is_dicom, transfer_syntax, header '
+                                           'FROM headers WHERE path = ? AND size = ? AND mtime = ?',
+                                           (file_path, statinfo.st_size, statinfo.st_mtime)).fetchone()
+        if row is None:
+            return None
+        is_dicom, transfer_syntax, header = row
+        if not is_dicom:
+            return compressed_dicom.DicomProbe(file_path)
+        return compressed_dicom.DicomProbe(file_path,
+                                           is_dicom=True,
+                                           transfer_syntax=transfer_syntax,
+                                           header=_json_to_header(header),
+                                           stop_before_pixels=True)
+
+    def put(self, file_path, dicom_probe):
+        """
+        Store the probe of a file in the index
+
+        :param file_path: the probed file
+        :param dicom_probe: DicomProbe as returned by compressed_dicom.probe_file
+        """
+        file_path = os.path.abspath(file_path)
+        statinfo = os.stat(file_path)
+        header = None
+        if dicom_probe.is_dicom:
+            header = _header_to_json(dicom_probe.header)
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?)',
+                                     (file_path, statinfo.st_size, statinfo.st_mtime,
+                                      1 if dicom_probe.is_dicom else 0,
+                                      dicom_probe.transfer_syntax,
+                                      header))
+            self._pending_puts += 1
+            if self._pending_puts >= self.commit_interval:
+                self._commit()
+
+    def probe_file(self, file_path, defer_size=None, force=False):
+        """
+        Probe the indexed header fields of a file, only reading the file if it is not in the index
+
+        :param file_path: file to probe
+        :param defer_size: see pydicom read_file
+        :param force: see compressed_dicom.probe_file
+        """
+        dicom_probe = self.get(file_path)
+        if dicom_probe is None:
+            dicom_probe = compressed_dicom.probe_file(file_path,
+                                                      defer_size=defer_size,
+                                                      stop_before_pixels=True,
+                                                      force=force,
+                                                      specific_tags=HEADER_FIELDS)
+            self.put(file_path, dicom_probe)
+        return dicom_probe
+
+    def prune(self, directory):
+        """
+        Remove the entries of the files in a directory that no longer exist
+
+        :param directory: the scanned (root) directory
+        :returns: number of removed entries
+        """
+        directory = os.path.join(os.path.abspath(directory), '')
+        with self._lock:
+            removed_paths = [(path,) for (path,) in self._connection.execute('SELECT path FROM headers')
+                             if path.startswith(directory) and not os.path.exists(path)]
+            self._connection.executemany('DELETE FROM headers WHERE path = ?', removed_paths)
+            self._commit()
+        if removed_paths:
+            logger.info('Removed %d deleted files from header index %s' % (len(removed_paths), self.index_file))
+        return len(removed_paths)
+
+    def commit(self):
+        """
+        Write the pending changes to disk
+        """
+        with self._lock:
+            self._commit()
+
+    def _commit(self):
+        self._connection.commit()
+        self._pending_puts = 0
+
+    def close(self):
+        """
+        Commit and close the index
+        """
+        self.commit()
+        self._connection.close()
+
+
+def _header_to_json(dicom_header):
+    """
+    Serialize the indexed fields of a dicom header to json
+    """
+    fields = {}
+    for keyword in HEADER_FIELDS:
+        if keyword in dicom_header:
+            fields[keyword] = _to_json_value(dicom_header.data_element(keyword).value)
+    file_meta = getattr(dicom_header, 'file_meta', None)
+    file_meta_fields = {}
+    if file_meta is not None:
+        for keyword in FILE_META_FIELDS:
+            if keyword in file_meta:
+                file_meta_fields[keyword] = _to_json_value(file_meta.data_element(keyword).value)
+    return json.dumps({'header': fields, 'file_meta': file_meta_fields})
+
+
+def _json_to_header(json_string):
+    """
+    Recreate a (partial) dicom header from the json stored in the index
+    """
+    fields = json.loads(json_string)
+    dicom_header = pydicom.Dataset()
+    for keyword, value in fields['header'].items():
+        setattr(dicom_header, keyword, value)
+    dicom_header.file_meta = pydicom.Dataset()
+    for keyword, value in fields['file_meta'].items():
+        setattr(dicom_header.file_meta, keyword, value)
+    return dicom_header
+
+
+def _to_json_value(value):
+    """
+    Convert a pydicom value to something json can store
+    """
+    if value is None:
+        return None
+    if isinstance(value, (MultiValue, list, tuple)):
+        return [_to_json_value(item) for item in value]
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Number):
+        return float(value)
+    return str(value)
@@ -12,6 +12,7 @@ from __future__ import print_function
 import nibabel
 import numpy
 
+import dicom2nifti.nifti_writer as nifti_writer
 from dicom2nifti.image_volume import ImageVolume, SliceType
 
 
@@ -30,15 +31,6 @@ def reorient_image(input_image, output_image):
     # print 'Reading nifti'
     image = ImageVolume(input_image)
 
-    # 4d have a different conversion to 3d
-    # print 'Reorganizing data'
-    if image.nifti_data.squeeze().ndim == 4:
-        new_image = _reorient_4d(image)
-    elif image.nifti_data.squeeze().ndim == 3:
-        new_image = _reorient_3d(image)
-    else:
-        raise Exception('Only 3d and 4d images are supported')
-
     # print 'Recreating affine'
     affine = image.nifti.affine
     # Based on VolumeImage.py where slice orientation 1 represents the axial plane
@@ -76,22 +68,42 @@ def reorient_image(input_image, output_image):
 
     # DONE: Needs to update new_affine, so that there is no translation difference between the original
     # and created image (now there is 1-2 voxels translation)
+
+    # 4d have a different conversion to 3d
+    # print 'Reorganizing data'
+    if image.nifti_data.squeeze().ndim == 4:
+        if nifti_writer.is_out_of_core(output_image):
+            # fill the new file timepoint by timepoint instead of creating the reoriented data in memory
+            with nifti_writer.NiftiWriter(output_image, new_affine, scaling=image.scaling) as writer:
+                _reorient_4d(image, writer.allocate)
+                writer.close()
+            return
+        new_image = _reorient_4d(image)
+    elif image.nifti_data.squeeze().ndim == 3:
+        new_image = _reorient_3d(image)
+    else:
+        raise Exception('Only 3d and 4d images are supported')
+
     # print 'Creating new nifti image'
-    nibabel.nifti1.Nifti1Image(new_image, new_affine).to_filename(output_image)
+    new_nifti = nibabel.nifti1.Nifti1Image(new_image, new_affine)
+    nifti_writer.set_scaling(new_nifti, image.scaling)
+    new_nifti.to_filename(output_image)
 
 
-def _reorient_4d(image):
+def _reorient_4d(image, allocate=numpy.zeros):
     """
     Reorganize the data for a 4d nifti
+
+    :param allocate: function(shape, dtype) creating the empty reoriented data
     """
     # print 'converting 4d image'
     # Create empty array where x,y,z correspond to LR (sagittal), PA (coronal), IS (axial) directions and the size
     # of the array in each direction is the same with the corresponding direction of the input image.
-    new_image = numpy.zeros([image.dimensions[image.sagittal_orientation.normal_component],
-                             image.dimensions[image.coronal_orientation.normal_component],
-                             image.dimensions[image.axial_orientation.normal_component],
-                             image.dimensions[3]],
-                            dtype=image.nifti_data.dtype)
+    new_image = allocate((image.dimensions[image.sagittal_orientation.normal_component],
+                          image.dimensions[image.coronal_orientation.normal_component],
+                          image.dimensions[image.axial_orientation.normal_component],
+                          image.dimensions[3]),
+                         image.nifti_data.dtype)
 
     # loop over all timepoints
     for timepoint in range(0, image.dimensions[3]):
@@ -10,6 +10,8 @@ Created on Fri Jun  7 07:40:20 2013
 import nibabel
 import numpy
 
+import dicom2nifti.nifti_writer as nifti_writer
+
 
 class Slice(object):
     """
@@ -49,9 +51,10 @@ class ImageVolume(object):
     def __init__(self, input_nifti):
         self.nifti = None
         self.nifti = nibabel.load(input_nifti)
+        # use the data as stored, the scaling (scl_slope and scl_inter) is kept separately
+        self.nifti_data, self.scaling = nifti_writer.get_unscaled_data(self.nifti)
         # assert that it is a 3D image
-        assert self.nifti.get_data().squeeze().ndim >= 3
-        self.nifti_data = self.nifti.get_data()
+        assert self.nifti_data.squeeze().ndim >= 3
         # do some basic processing like setting dimensions and min/max values
         self.dimensions = self.nifti_data.shape
         self.axial_orientation = None
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+this module houses the code to write uncompressed nifti files directly to disk (out of core)
+
+@author: abrys
+"""
+from __future__ import print_function
+
+import logging
+import os
+
+import nibabel
+import numpy
+
+import dicom2nifti.common as common
+import dicom2nifti.settings as settings
+
+logger = logging.getLogger(__name__)
+
+
+def is_out_of_core(output_file):
+    """
+    Check if the data for an output file should be written directly to disk instead of being built in memory
+    This is only possible for uncompressed nifti files and needs to be enabled in the settings
+
+    :param output_file: the nifti file that will be written (can be None)
+    """
+    return settings.out_of_core and output_file is not None and output_file.endswith('.nii')
+
+
+def create_4d_nifti(get_full_block, affine, output_file, repetition_time, echo_time, scaling=None):
+    """
+    Create the nifti of a 4d series and write it to disk if an output file is given
+    For uncompressed output with out of core enabled the block is filled directly in the file (see NiftiWriter)
+
+    :param get_full_block: function(allocate) creating the x,y,z,t block (see common.get_4d_pixeldata)
+    :param affine: affine of the nifti
+    :param output_file: file to write to (None to only create the nifti in memory)
+    :param repetition_time: repetition time to store in the header
+    :param echo_time: echo time to store in the header
+    :param scaling: tuple with the slope and intercept to store in the header (see common.get_header_scaling)
+    :return: the nibabel nifti image
+    """
+    if is_out_of_core(output_file):
+        logger.info('Writing nifti to disk %s' % output_file)
+        with NiftiWriter(output_file, affine, repetition_time, echo_time, scaling) as nifti_writer:
+            get_full_block(nifti_writer.allocate)
+            return nifti_writer.close()
+
+    full_block = get_full_block(None)
+    logger.info('Creating nifti')
+    nii_image = nibabel.Nifti1Image(full_block, affine)
+    common.set_tr_te(nii_image, repetition_time, echo_time)
+    set_scaling(nii_image, scaling)
+    if output_file is not None:
+        logger.info('Saving nifti to disk %s' % output_file)
+        nii_image.to_filename(output_file)
+    return nii_image
+
+
+def set_scaling(nii_image, scaling):
+    """
+    Store the scaling of the data in the nifti header (scl_slope and scl_inter)
+
+    :param nii_image: nibabel nifti image
+    :param scaling: tuple with slope and intercept, None to leave the header as is
+    """
+    if scaling is not None:
+        nii_image.header.set_slope_inter(*scaling)
+    return nii_image
+
+
+def get_unscaled_data(nii_image):
+    """
+    Get the data of a nifti as stored (so without applying scl_slope and scl_inter) together with its scaling
+    For a nifti read from an uncompressed file the data stays memory mapped.
+
+    :param nii_image: nibabel nifti image
+    :return: tuple with the data and the (slope, intercept) tuple or None if the data is not scaled
+    """
+    if nibabel.is_proxy(nii_image.dataobj):
+        data = nii_image.dataobj.get_unscaled()
+        slope, intercept = nii_image.dataobj.slope, nii_image.dataobj.inter
+    else:
+        data = numpy.asanyarray(nii_image.dataobj)
+        slope, intercept = nii_image.header.get_slope_inter()
+        if slope is None:
+            return data, None
+    if slope == 1 and (intercept is None or intercept == 0):
+        return data, None
+    return data, (slope, 0.0 if intercept is None else intercept)
+
+
+class NiftiWriter(object):
+    """
+    Write an uncompressed nifti file of which the data is filled in place
+    The header is written first and the data part of the file is memory mapped so it can be filled timepoint by
+    timepoint without ever having the full block in memory.
+    The data is written to a temporary file next to the output file that only replaces the output file on close so
+    the output file can be read while it is being rewritten.
+    """
+
+    def __init__(self, output_file, affine, repetition_time=None, echo_time=None, scaling=None):
+        """
+        :param output_file: the .nii file to write
+        :param affine: affine of the nifti
+        :param repetition_time: repetition time to store in the header (optional)
+        :param echo_time: echo time to store in the header (optional)
+        :param scaling: tuple with the slope and intercept to store in the header (optional)
+        """
+        self.output_file = output_file
+        self.affine = affine
+        self.repetition_time = repetition_time
+        self.echo_time = echo_time
+        self.scaling = scaling
+        self._temporary_files = []
+        self._data = None
+
+    def allocate(self, shape, dtype):
+        """
+        Write the header and memory map the (empty) data of the nifti file
+        This can be called again with a different dtype, the data of the previous allocation stays valid until close
+
+        :param shape: shape of the data
+        :param dtype: numpy dtype of the data
+        :return: fortran ordered numpy memmap with the data of the nifti file
+        """
+        shape = tuple(shape)
+        dtype = numpy.dtype(dtype)
+        # a zero strided placeholder so nibabel creates the header without allocating the data
+        nii_image = nibabel.Nifti1Image(numpy.broadcast_to(numpy.zeros((), dtype=dtype), shape), self.affine)
+        if self.repetition_time is not None and self.echo_time is not None:
+            common.set_tr_te(nii_image, self.repetition_time, self.echo_time)
+        nii_image.update_header()
+        header = nii_image.header
+        if self.scaling is None:
+            header.set_slope_inter(1.0, 0.0)
+        else:
+            header.set_slope_inter(*self.scaling)
+
+        output_directory, output_name = os.path.split(os.path.abspath(self.output_file))
+        temporary_file = os.path.join(output_directory, '.%s.%d.part' % (output_name, len(self._temporary_files)))
+        self._temporary_files.append(temporary_file)
+        with open(temporary_file, 'wb') as nifti_file:
+            header.write_to(nifti_file)
+            data_offset = nifti_file.tell()
+            nifti_file.truncate(data_offset + int(numpy.prod(shape)) * dtype.itemsize)
+
+        self._data = numpy.memmap(temporary_file, dtype=dtype, mode='r+', offset=data_offset, shape=shape, order='F')
+        return self._data
+
+    def close(self):
+        """
+        Flush the data and move the file to the output file
+
+        :return: the written nifti as nibabel image (memory mapped)
+        """
+        if self._data is None:
+            raise ValueError('No data allocated for %s' % self.output_file)
+        self._data.flush()
+        self._data = None
+        final_file = self._temporary_files.pop()
+        for temporary_file in self._temporary_files:
+            os.remove(temporary_file)
+        self._temporary_files = []
+        if os.path.exists(self.output_file):
+            os.remove(self.output_file)
+        os.rename(final_file, self.output_file)
+        return nibabel.load(self.output_file)
+
+    def abort(self):
+        """
+        Remove the temporary files without writing the output file
+        """
+        self._data = None
+        for temporary_file in self._temporary_files:
+            if os.path.exists(temporary_file):
+                os.remove(temporary_file)
+        self._temporary_files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None or self._data is not None:
+            self.abort()
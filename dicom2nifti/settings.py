@@ -9,6 +9,8 @@ gdcmconv_path = None
 resample = False
 resample_padding = 0
 resample_spline_interpolation_order = 0  # spline interpolation order (0 nn , 1 bilinear, 3 cubic)
+out_of_core = False
+header_scaling = False
 
 
 def disable_validate_sliceincrement():
@@ -133,6 +135,42 @@ def disable_resampling():
     global resample
     resample = False
 
+
+def enable_out_of_core():
+    """
+    Write 4d series with uncompressed nifti output (.nii) directly to disk timepoint by timepoint (disabled by default)
+    This keeps the memory usage at about one volume for long fmri and dti series
+    """
+    global out_of_core
+    out_of_core = True
+
+
+def disable_out_of_core():
+    """
+    Build the data of 4d series in memory before writing the nifti (default)
+    """
+    global out_of_core
+    out_of_core = False
+
+
+def enable_header_scaling():
+    """
+    Keep the stored integer pixel data and write the rescale slope and intercept to the nifti header (scl_slope and
+    scl_inter) instead of converting the data to float (disabled by default)
+    This is only done when written to file and if all slices of the series have the same non integer scaling
+    """
+    global header_scaling
+    header_scaling = True
+
+
+def disable_header_scaling():
+    """
+    Apply the rescale slope and intercept to the data (default)
+    """
+    global header_scaling
+    header_scaling = False
+
+
 def set_resample_padding(padding):
     """
     Set the spline interpolation padding
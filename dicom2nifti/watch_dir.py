@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+this module houses the code to watch a (spool) directory and convert the series as they complete
+
+@author: abrys
+"""
+from __future__ import print_function
+
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from six import iteritems
+
+import dicom2nifti.common as common
+import dicom2nifti.convert_dir as convert_dir
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+    inotify_flags = None
+
+logger = logging.getLogger(__name__)
+
+
+class DirectoryWatcher(object):
+    """
+    Watch a directory for new dicom files and convert a series once no new files arrived for it during the quiet period
+    New files are detected using inotify if the inotify_simple package is available, otherwise by polling.
+    Files that were already indexed are never read again unless their size or modification time changes.
+    Only the files of the series that are not converted yet are kept per series, files and series that are removed
+    from the directory are forgotten.
+    """
+
+    def __init__(self, dicom_directory, output_folder, compression=True, reorient=True, quiet_period=30.0,
+                 poll_interval=1.0, use_inotify=True):
+        """
+        :param dicom_directory: directory to watch (can be nested)
+        :param output_folder: folder to write the nifti files to
+        :param compression: enable or disable gzip compression
+        :param reorient: reorient the dicoms according to LAS orientation
+        :param quiet_period: seconds without new files after which a series is considered complete
+        :param poll_interval: seconds between two checks for new files
+        :param use_inotify: use inotify to detect new files if available
+        """
+        self.dicom_directory = dicom_directory
+        self.output_folder = output_folder
+        self.compression = compression
+        self.reorient = reorient
+        self.quiet_period = quiet_period
+        self.poll_interval = poll_interval
+
+        self._files = {}  # file path -> (size, mtime, series uid) of all files that were indexed
+        self._series_files = OrderedDict()  # series uid -> file paths of the series that are not converted
+        self._pending_series = {}  # series uid -> time the last file arrived for series that are not converted
+        self._converted_series = {}  # series uid -> number of files of the converted series
+        self._inotify = None
+        if use_inotify and INotify is not None:
+            self._inotify = _InotifyWatch(dicom_directory)
+        self._initial_scan_done = False
+
+    def poll(self, now=None):
+        """
+        Index the new or changed files in the directory
+
+        :param now: timestamp to register for the new files (default: current time)
+        :return: number of new or changed files
+        """
+        if now is None:
+            now = time.time()
+        if self._inotify is None or not self._initial_scan_done:
+            file_paths = common.list_files(self.dicom_directory)
+            # files that are no longer listed were removed
+            self._remove_files(set(self._files).difference(file_paths))
+            self._initial_scan_done = True
+        else:
+            file_paths = self._inotify.read_paths(0)
+
+        new_files = 0
+        for file_path in file_paths:
+            if file_path.endswith(os.sep):  # a directory that was removed (inotify)
+                self._remove_files([path for path in self._files if path.startswith(file_path)])
+                continue
+            try:
+                statinfo = os.stat(file_path)
+            except OSError:  # removed
+                self._remove_files([file_path])
+                continue
+            file_state = (statinfo.st_size, statinfo.st_mtime)
+            if file_path in self._files:
+                if self._files[file_path][0:2] == file_state:
+                    continue
+                # a changed file is indexed again
+                self._remove_files([file_path])
+            new_files += 1
+
+            series_uid = convert_dir.get_series_uid(file_path)
+            self._files[file_path] = file_state + (series_uid,)
+            if series_uid is None:
+                continue
+            if series_uid in self._converted_series:
+                # a converted series that receives files is converted again with all its files
+                del self._converted_series[series_uid]
+                self._series_files[series_uid] = [path for path, (_, _, uid) in iteritems(self._files)
+                                                  if uid == series_uid]
+            else:
+                self._series_files.setdefault(series_uid, []).append(file_path)
+            self._pending_series[series_uid] = now
+        return new_files
+
+    def _remove_files(self, file_paths):
+        """
+        Forget removed files and the series that have no files left
+        """
+        for file_path in file_paths:
+            if file_path not in self._files:  # removed before it was indexed
+                continue
+            _, _, series_uid = self._files.pop(file_path)
+            if series_uid in self._series_files:
+                self._series_files[series_uid].remove(file_path)
+                if not self._series_files[series_uid]:
+                    del self._series_files[series_uid]
+                    del self._pending_series[series_uid]
+            elif series_uid in self._converted_series:
+                self._converted_series[series_uid] -= 1
+                if self._converted_series[series_uid] == 0:
+                    del self._converted_series[series_uid]
+
+    def get_completed_series(self, now=None):
+        """
+        Get the series that did not receive new files during the quiet period and are not converted yet
+
+        :param now: timestamp to compare with (default: current time)
+        :return: list with series uids
+        """
+        if now is None:
+            now = time.time()
+        return [series_uid for series_uid in self._series_files
+                if series_uid in self._pending_series and now - self._pending_series[series_uid] >= self.quiet_period]
+
+    def convert_completed_series(self, now=None):
+        """
+        Convert all series that are complete
+        If files arrive later for a series that was already converted it will be converted again when it completes
+
+        :param now: timestamp to compare with (default: current time)
+        :return: list with the written nifti files
+        """
+        nifti_files = []
+        for series_uid in self.get_completed_series(now):
+            del self._pending_series[series_uid]
+            dicom_files = self._series_files.pop(series_uid)
+            self._converted_series[series_uid] = len(dicom_files)
+            logger.info('Series completed: %s' % series_uid)
+            nifti_file = convert_dir.convert_series(dicom_files,
+                                                    self.output_folder,
+                                                    self.compression,
+                                                    self.reorient)
+            if nifti_file is not None:
+                nifti_files.append(nifti_file)
+        return nifti_files
+
+    def run(self, max_iterations=None):
+        """
+        Keep watching the directory and converting the completed series (until interrupted)
+
+        :param max_iterations: stop after this number of checks (None to run forever)
+        """
+        iteration = 0
+        while max_iterations is None or iteration < max_iterations:
+            if self._inotify is not None and self._initial_scan_done:
+                self._inotify.wait(self.poll_interval)
+            elif iteration > 0:
+                time.sleep(self.poll_interval)
+            self.poll()
+            self.convert_completed_series()
+            iteration += 1
+
+
+def watch_directory(dicom_directory, output_folder, compression=True, reorient=True, quiet_period=30.0):
+    """
+    Watch a directory and convert each series once no new files arrived for it during the quiet period
+    This function only returns when interrupted
+
+    :param dicom_directory: directory to watch (can be nested)
+    :param output_folder: folder to write the nifti files to
+    :param compression: enable or disable gzip compression
+    :param reorient: reorient the dicoms according to LAS orientation
+    :param quiet_period: seconds without new files after which a series is considered complete
+    """
+    logger.info('Watching %s' % dicom_directory)
+    DirectoryWatcher(dicom_directory, output_folder, compression, reorient, quiet_period).run()
+
+
+class _InotifyWatch(object):
+    """
+    Recursive inotify watch reporting the files that were written, moved or removed in a directory tree
+    """
+
+    def __init__(self, directory):
+        self._inotify = INotify()
+        self._directories = {}  # watch descriptor -> directory
+        self._pending_paths = []
+        self._add_watch_recursive(directory)
+
+    def _add_watch_recursive(self, directory):
+        mask = inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.CREATE | \
+            inotify_flags.DELETE | inotify_flags.MOVED_FROM
+        for root, _, _ in os.walk(directory):
+            watch_descriptor = self._inotify.add_watch(root, mask)
+            self._directories[watch_descriptor] = root
+
+    def wait(self, timeout):
+        """
+        Wait at most timeout seconds for new events
+        """
+        self._read_events(int(timeout * 1000))
+
+    def read_paths(self, timeout):
+        """
+        Get the paths of the files that were written or removed since the last call
+        Removed directories are reported with a trailing separator
+        """
+        self._read_events(int(timeout * 1000))
+        paths = self._pending_paths
+        self._pending_paths = []
+        return paths
+
+    def _read_events(self, timeout):
+        for event in self._inotify.read(timeout=timeout):
+            if event.wd not in self._directories:
+                continue
+            if event.mask & inotify_flags.IGNORED:  # the watched directory was removed
+                del self._directories[event.wd]
+                continue
+            path = os.path.join(self._directories[event.wd], event.name)
+            if event.mask & inotify_flags.ISDIR:
+                if event.mask & (inotify_flags.CREATE | inotify_flags.MOVED_TO):
+                    # watch the new directory and pick up the files that were written before the watch existed
+                    self._add_watch_recursive(path)
+                    self._pending_paths.extend(common.list_files(path))
+                elif event.mask & (inotify_flags.DELETE | inotify_flags.MOVED_FROM):
+                    self._pending_paths.append(os.path.join(path, ''))
+            elif event.mask & (inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO |
+                               inotify_flags.DELETE | inotify_flags.MOVED_FROM):
+                self._pending_paths.append(path)
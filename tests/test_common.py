@@ -9,6 +9,10 @@ import shutil
 import tempfile
 import unittest
 
+import numpy
+import pydicom
+from pydicom.tag import Tag
+
 import dicom2nifti
 import tests.test_data as test_data
 from dicom2nifti.common import read_dicom_directory, \
@@ -16,9 +20,25 @@ from dicom2nifti.common import read_dicom_directory, \
     validate_slicecount, \
     validate_orthogonal, \
     validate_orientation, \
-    sort_dicoms
+    sort_dicoms, \
+    get_volume_pixeldata, \
+    get_4d_volume_pixeldata, \
+    do_scaling, \
+    do_series_scaling, \
+    get_uniform_scaling, \
+    get_volume_dtype, \
+    SliceArrayProxy, \
+    get_pixel_array, \
+    get_series_values, \
+    get_is_value, \
+    get_fd_array_value, \
+    _get_native_pixeldata, \
+    _needs_sign_extension
 from dicom2nifti.convert_generic import dicom_to_nifti
-from dicom2nifti.exceptions import ConversionValidationError
+from dicom2nifti.exceptions import ConversionValidationError, ConversionError
+import dicom2nifti.convert_ge as convert_ge
+import dicom2nifti.convert_philips as convert_philips
+import dicom2nifti.convert_siemens as convert_siemens
 
 
 class TestConversionCommon(unittest.TestCase):
@@ -116,6 +136,168 @@ class TestConversionCommon(unittest.TestCase):
         finally:
             shutil.rmtree(tmp_output_dir)
 
+    def test_get_volume_pixeldata(self):
+        sorted_dicoms = sort_dicoms(read_dicom_directory(test_data.GE_ANATOMICAL))
+        volume = get_volume_pixeldata(sorted_dicoms)
+        expected = numpy.transpose(numpy.array([dicom.pixel_array for dicom in sorted_dicoms]), (2, 1, 0))
+        self.assertTrue(volume.flags['F_CONTIGUOUS'])
+        self.assertEqual(volume.shape, expected.shape)
+        numpy.testing.assert_array_equal(volume, expected)
+
+    def test_get_4d_volume_pixeldata(self):
+        for dicom_directory, get_grouped_dicoms in [(test_data.SIEMENS_CLASSIC_FMRI,
+                                                     convert_siemens._classic_get_grouped_dicoms),
+                                                    (test_data.GE_FMRI, convert_ge._get_grouped_dicoms),
+                                                    (test_data.PHILIPS_FMRI, convert_philips._get_grouped_dicoms)]:
+            grouped_dicoms = get_grouped_dicoms(read_dicom_directory(dicom_directory))
+            for rescale_slope in [None, 1.5, 2]:
+                if rescale_slope is not None:
+                    for dicom in [dicom for timepoint_dicoms in grouped_dicoms for dicom in timepoint_dicoms]:
+                        dicom.RescaleSlope = rescale_slope
+                expected = numpy.stack([get_volume_pixeldata(timepoint_dicoms)
+                                        for timepoint_dicoms in grouped_dicoms], axis=3)
+                allocated = []
+
+                def allocate(shape, dtype):
+                    allocated.append(numpy.zeros(shape, dtype))
+                    return allocated[-1]
+
+                block = get_4d_volume_pixeldata(grouped_dicoms, allocate)
+                self.assertIs(block, allocated[-1])
+                if rescale_slope != 2:
+                    # the block is allocated once and filled in place
+                    # (integer scaling can need a wider dtype, which is only known after reading the data)
+                    self.assertEqual(len(allocated), 1)
+                self.assertEqual(block.dtype, expected.dtype)
+                numpy.testing.assert_array_equal(block, expected)
+
+            # missing slices are detected before any data is read
+            for dicom in grouped_dicoms[0]:
+                del dicom.PixelData
+            self.assertRaises(ConversionError, get_4d_volume_pixeldata, grouped_dicoms[:-1] + [grouped_dicoms[-1][1:]])
+
+    def test_slice_array_proxy(self):
+        for dicom_directory in [test_data.GE_ANATOMICAL,
+                                test_data.HITACHI_ANATOMICAL,
+                                test_data.GENERIC_NON_ISOTROPIC]:
+            sorted_dicoms = sort_dicoms(read_dicom_directory(dicom_directory))
+            volume = get_volume_pixeldata(sort_dicoms(read_dicom_directory(dicom_directory)))
+            proxy = SliceArrayProxy(sorted_dicoms)
+            self.assertEqual(proxy.shape, volume.shape)
+            self.assertEqual(proxy.dtype, get_volume_dtype(sorted_dicoms))
+            self.assertEqual(numpy.promote_types(proxy.dtype, volume.dtype), proxy.dtype)
+
+            # slices that are not indexed are never read
+            del sorted_dicoms[-1].PixelData
+            numpy.testing.assert_array_equal(proxy[:, :, 0], volume[:, :, 0])
+            numpy.testing.assert_array_equal(proxy[..., 1:3], volume[..., 1:3])
+            numpy.testing.assert_array_equal(proxy[None, 2, :, -2], volume[None, 2, :, -2])
+            numpy.testing.assert_array_equal(proxy[:, :, 4:4], volume[:, :, 4:4])
+            self.assertEqual(proxy[:, :, 0].dtype, proxy.dtype)
+            self.assertRaises(AttributeError, numpy.asarray, proxy)
+
+    def test_do_series_scaling(self):
+        random_state = numpy.random.RandomState(0)
+        raw_block = random_state.randint(0, 4096, (16, 12, 5)).astype(numpy.uint16)
+        for scaling_parameters in [[None] * 5,
+                                   [(1, -1024, 1.0, 0.0)] * 5,
+                                   [(2, 0, 1.0, 0.0), (1, 0, 1.0, 0.0), None, (1, 10, 1.0, 0.0), (3, 0, 1.0, 0.0)],
+                                   [(1.5, 0.5, 1.0, 0.0)] * 5,
+                                   [(1, 0, 0.25, 0.0), (1, 0, 1.0, 0.0), (2.5, 1, 1.0, 0.0), None, (1, 0, 1.0, 0.0)]]:
+            expected_slices = []
+            for index, parameters in enumerate(scaling_parameters):
+                slice_data = raw_block[:, :, index]
+                if parameters is not None:
+                    slice_data = do_scaling(slice_data, *parameters)
+                expected_slices.append(slice_data[:, :, numpy.newaxis])
+            expected = numpy.concatenate(expected_slices, axis=2)
+
+            scaled_block = do_series_scaling(raw_block.copy(order='F'), scaling_parameters)
+            self.assertEqual(scaled_block.dtype, expected.dtype)
+            numpy.testing.assert_array_equal(scaled_block, expected)
+
+    def test_get_uniform_scaling(self):
+        # disabled by default
+        self.assertIsNone(get_uniform_scaling([(1.5, 0.5, 1.0, 0.0)] * 5))
+        try:
+            dicom2nifti.settings.enable_header_scaling()
+            self.assertEqual(get_uniform_scaling([(1.5, 0.5, 1.0, 0.0)] * 5), (1.5, 0.5))
+            self.assertEqual(get_uniform_scaling([(1, 0, 0.25, 0.0)] * 5), (0.25, 0.0))
+            # integer scaling keeps integer data
+            self.assertIsNone(get_uniform_scaling([(1, -1024, 1.0, 0.0)] * 5))
+            self.assertIsNone(get_uniform_scaling([None] * 5))
+            # slices that disagree on the scaling
+            self.assertIsNone(get_uniform_scaling([(1.5, 0.5, 1.0, 0.0)] * 4 + [(2.5, 0.5, 1.0, 0.0)]))
+            self.assertIsNone(get_uniform_scaling([(1.5, 0.5, 1.0, 0.0)] * 4 + [None]))
+        finally:
+            dicom2nifti.settings.disable_header_scaling()
+
+    def test_get_series_values(self):
+        bval_tag, bvec_tag = Tag(0x0019, 0x100c), Tag(0x0019, 0x100e)
+        for dicom_directory in [test_data.SIEMENS_CLASSIC_DTI, test_data.SIEMENS_CLASSIC_DTI_IMPLICIT]:
+            dicoms = read_dicom_directory(dicom_directory)
+            numpy.testing.assert_array_equal(get_series_values(dicoms, bval_tag, 'IS'),
+                                             [get_is_value(dicom[bval_tag]) for dicom in dicoms])
+
+            bvec_dicoms = [dicom for dicom in dicoms if bvec_tag in dicom]
+            self.assertGreater(len(bvec_dicoms), 0)
+            numpy.testing.assert_array_equal(get_series_values(bvec_dicoms, bvec_tag, 'FD', 3),
+                                             [get_fd_array_value(dicom[bvec_tag], 3) for dicom in bvec_dicoms])
+            bvecs = get_series_values(dicoms, bvec_tag, 'FD', 3, default=[0, 0, 0])
+            self.assertEqual(bvecs.shape, (len(dicoms), 3))
+            for dicom, bvec in zip(dicoms, bvecs):
+                if bvec_tag in dicom:
+                    numpy.testing.assert_array_equal(bvec, get_fd_array_value(dicom[bvec_tag], 3))
+                else:
+                    numpy.testing.assert_array_equal(bvec, [0, 0, 0])
+            self.assertRaises(KeyError, get_series_values, dicoms, bvec_tag, 'FD', 3)
+
+        # only the requested values are converted (like the trailing values of GE private fields)
+        dicom = pydicom.Dataset()
+        dicom.add_new(Tag(0x0043, 0x1039), 'LO', '1000\\8\\\\x')
+        numpy.testing.assert_array_equal(get_series_values([dicom], Tag(0x0043, 0x1039), 'IS'), [1000])
+        numpy.testing.assert_array_equal(get_series_values([dicom], Tag(0x0043, 0x1039), 'IS', 2), [[1000, 8]])
+
+    def test_get_pixel_array(self):
+        for dicom_directory in [test_data.SIEMENS_ANATOMICAL,
+                                test_data.SIEMENS_ANATOMICAL_IMPLICIT,
+                                test_data.HITACHI_ANATOMICAL,
+                                test_data.PHILIPS_ENHANCED_ANATOMICAL]:
+            for dicom_slice in read_dicom_directory(dicom_directory):
+                # the pixel data is deferred while reading so it is memory mapped
+                slice_data = _get_native_pixeldata(dicom_slice)
+                self.assertIsInstance(slice_data, numpy.memmap)
+                self.assertEqual(slice_data.dtype, dicom_slice.pixel_array.dtype)
+                numpy.testing.assert_array_equal(slice_data, dicom_slice.pixel_array)
+                # once read the pixel data bytes are used
+                slice_data = _get_native_pixeldata(dicom_slice)
+                self.assertNotIsInstance(slice_data, numpy.memmap)
+                numpy.testing.assert_array_equal(get_pixel_array(dicom_slice), dicom_slice.pixel_array)
+
+    def test_sign_extend_volume(self):
+        sorted_dicoms = sort_dicoms(read_dicom_directory(test_data.HITACHI_ANATOMICAL))
+        self.assertTrue(all(_needs_sign_extension(dicom) for dicom in sorted_dicoms))
+        # store some negative 12 bit values (without the high bits set) in the data
+        for dicom in sorted_dicoms:
+            data = dicom.pixel_array.copy()
+            data[0, :4] = [0x0800, 0x0FFF, 0x07FF, 0x0801]
+            dicom.PixelData = data.tobytes()
+
+        # the previous mask based implementation (per slice)
+        expected_slices = []
+        for dicom in sorted_dicoms:
+            data = dicom.pixel_array.astype(numpy.int16)
+            max_value = pow(2, dicom.HighBit) - 1
+            invert_value = -1 ^ max_value
+            data[data > max_value] = numpy.bitwise_or(data[data > max_value], invert_value)
+            expected_slices.append(data[numpy.newaxis, :, :])
+        expected = numpy.transpose(numpy.concatenate(expected_slices, axis=0), (2, 1, 0))
+
+        volume = get_volume_pixeldata(sorted_dicoms)
+        self.assertEqual(volume.dtype, expected.dtype)
+        numpy.testing.assert_array_equal(volume, expected)
+        numpy.testing.assert_array_equal(volume[:4, 0, 0], [-2048, -1, 2047, -2047])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -10,8 +10,12 @@ import shutil
 import tempfile
 import unittest
 
+import pydicom.config
+from pydicom.tag import Tag
+
 import tests.test_data as test_data
 
+import dicom2nifti.common as common
 import dicom2nifti.compressed_dicom as compressed_dicom
 
 
@@ -21,6 +25,101 @@ class TestCompressedDicom(unittest.TestCase):
         assert compressed_dicom._is_compressed(os.path.join(test_data.GENERIC_COMPRESSED, 'IM-0001-0001-0001.dcm')) is True
         assert compressed_dicom._is_compressed(os.path.join(test_data.GENERIC_ANATOMICAL, 'IM-0001-0001-0001.dcm')) is False
 
+    def test_probe_file(self):
+        dicom_probe = compressed_dicom.probe_file(os.path.join(test_data.GENERIC_COMPRESSED, 'IM-0001-0001-0001.dcm'))
+        self.assertTrue(dicom_probe.is_dicom)
+        self.assertTrue(dicom_probe.is_compressed)
+        self.assertEqual(dicom_probe.transfer_syntax, '1.2.840.10008.1.2.4.90')
+        self.assertIsNotNone(dicom_probe.header.SeriesInstanceUID)
+
+        dicom_probe = compressed_dicom.probe_file(os.path.join(test_data.GENERIC_ANATOMICAL, 'IM-0001-0001-0001.dcm'))
+        self.assertTrue(dicom_probe.is_dicom)
+        self.assertFalse(dicom_probe.is_compressed)
+
+        dicom_probe = compressed_dicom.probe_file(os.path.abspath(__file__))
+        self.assertFalse(dicom_probe.is_dicom)
+        self.assertIsNone(dicom_probe.header)
+
+    def test_probe_file_specific_tags(self):
+        for dicom_file in common.list_files(test_data.SIEMENS_FMRI):
+            full_header = compressed_dicom.probe_file(dicom_file).header
+            dicom_probe = compressed_dicom.probe_file(dicom_file, specific_tags=common.CLASSIFICATION_TAGS)
+            self.assertTrue(dicom_probe.is_dicom)
+            for keyword in common.CLASSIFICATION_TAGS:
+                self.assertEqual(keyword in dicom_probe.header, keyword in full_header)
+                if keyword in full_header:
+                    self.assertEqual(dicom_probe.header.data_element(keyword).value,
+                                     full_header.data_element(keyword).value)
+            # the private csa headers are not read
+            self.assertIn(Tag(0x0029, 0x1020), full_header)
+            self.assertNotIn(Tag(0x0029, 0x1020), dicom_probe.header)
+            self.assertTrue(common.is_siemens([dicom_probe.header]))
+            self.assertTrue(common.is_valid_imaging_dicom(dicom_probe.header))
+
+    def test_get_pixel_data_handler(self):
+        # rle is decoded by pydicom with numpy only
+        self.assertIsNotNone(compressed_dicom._get_pixel_data_handler('1.2.840.10008.1.2.5'))
+        self.assertIsNone(compressed_dicom._get_pixel_data_handler('1.2.3.4'))
+        self.assertIsNone(compressed_dicom._get_pixel_data_handler(None))
+
+    def test_failing_pixel_data_handler(self):
+        compressed_file = os.path.join(test_data.GENERIC_COMPRESSED, 'IM-0001-0001-0001.dcm')
+        uncompressed_file = os.path.join(test_data.GENERIC_ANATOMICAL, 'IM-0001-0001-0001.dcm')
+        decompressed_files = []
+
+        def _decompress_dicom(dicom_file, output_file):
+            decompressed_files.append(dicom_file)
+            shutil.copy(uncompressed_file, output_file)
+
+        # a handler that claims the transfer syntax but can not decode the data (like pillow for 12 bit jpeg)
+        failing_handler = _FailingPixelDataHandler()
+        original_decompress_dicom = compressed_dicom._decompress_dicom
+        pydicom.config.pixel_data_handlers.insert(0, failing_handler)
+        compressed_dicom._decompress_dicom = _decompress_dicom
+        try:
+            dicom_probe = compressed_dicom.probe_file(compressed_file, stop_before_pixels=False)
+            self.assertFalse(dicom_probe.needs_decompression)
+            self.assertIsNone(dicom_probe.get_decoded_dataset())
+            self.assertEqual(failing_handler.calls, 1)
+            # the file is decompressed with gdcmconv instead
+            dataset = dicom_probe.get_dataset()
+            self.assertNotEqual(dataset.file_meta.TransferSyntaxUID, dicom_probe.transfer_syntax)
+            datasets = compressed_dicom.get_datasets([compressed_dicom.probe_file(compressed_file,
+                                                                                  stop_before_pixels=False)])
+            self.assertEqual(len(datasets), 1)
+            self.assertEqual(decompressed_files, [compressed_file, compressed_file])
+        finally:
+            pydicom.config.pixel_data_handlers.remove(failing_handler)
+            compressed_dicom._decompress_dicom = original_decompress_dicom
+
+        # uncompressed files are never decompressed
+        dicom_probe = compressed_dicom.probe_file(uncompressed_file, stop_before_pixels=False)
+        self.assertIs(dicom_probe.get_decoded_dataset(), dicom_probe.header)
+
+    def test_batch_decompressor_cleanup(self):
+        with compressed_dicom.BatchDecompressor(workers=2) as decompressor:
+            scratch_directory = decompressor.scratch_directory
+            self.assertTrue(os.path.isdir(scratch_directory))
+        self.assertFalse(os.path.exists(scratch_directory))
+
+    def test_get_tmpfs_directory(self):
+        self.assertIsNone(compressed_dicom.get_tmpfs_directory(None))
+        # files that do not fit in the available memory are written to the default temporary directory
+        self.assertIsNone(compressed_dicom.get_tmpfs_directory(2 ** 60))
+        with compressed_dicom.BatchDecompressor(workers=2, expected_size=2 ** 60) as decompressor:
+            self.assertEqual(os.path.dirname(decompressor.scratch_directory), tempfile.gettempdir())
+        if os.path.isdir('/dev/shm') and compressed_dicom._get_available_memory() is not None:
+            self.assertEqual(compressed_dicom.get_tmpfs_directory(1024), '/dev/shm')
+
+    @unittest.skipIf(compressed_dicom._which('gdcmconv') is None, 'gdcmconv is not installed')
+    def test_batch_decompressor(self):
+        dicom_files = sorted(common.list_files(test_data.GENERIC_COMPRESSED))
+        with compressed_dicom.BatchDecompressor(workers=2) as decompressor:
+            decompressed_files = decompressor.decompress(dicom_files)
+            self.assertEqual(len(decompressed_files), len(dicom_files))
+            for decompressed_file in decompressed_files:
+                self.assertFalse(compressed_dicom._is_compressed(decompressed_file))
+
     def test_read_file(self):
         temporary_directory = tempfile.mkdtemp()
         try:
@@ -35,5 +134,34 @@ class TestCompressedDicom(unittest.TestCase):
             shutil.rmtree(temporary_directory)
 
 
+class _FailingPixelDataHandler(object):
+    """
+    Pixel data handler that supports every transfer syntax but fails to decode
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    @staticmethod
+    def is_available():
+        return True
+
+    @staticmethod
+    def supports_transfer_syntax(transfer_syntax):
+        return True
+
+    @staticmethod
+    def needs_to_convert_to_RGB(dataset):
+        return False
+
+    @staticmethod
+    def should_change_PhotometricInterpretation_to_RGB(dataset):
+        return False
+
+    def get_pixeldata(self, dataset):
+        self.calls += 1
+        raise NotImplementedError('JPEG Lossy only supported if Bits Allocated = 8')
+
+
 if __name__ == '__main__':
     unittest.main()
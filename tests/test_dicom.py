@@ -9,8 +9,11 @@ import os
 import shutil
 import tempfile
 import unittest
+from multiprocessing.pool import ThreadPool
 
 import nibabel
+import numpy
+from pydicom.tag import Tag
 
 import tests.test_data as test_data
 
@@ -117,6 +120,54 @@ class TestConversionDicom(unittest.TestCase):
         finally:
             shutil.rmtree(tmp_output_dir)
 
+    def test_in_memory_conversion(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            # without output file the (lazy) nifti is returned without resampling or reorientation
+            results = convert_dicom.dicom_array_to_nifti(read_dicom_directory(test_data.SIEMENS_ANATOMICAL), None)
+            self.assertTrue(results.get('NII_FILE') is None)
+            self.assertTrue(nibabel.is_proxy(results['NII'].dataobj))
+
+            expected = convert_dicom.dicom_array_to_nifti(read_dicom_directory(test_data.SIEMENS_ANATOMICAL),
+                                                          os.path.join(tmp_output_dir, 'test.nii.gz'),
+                                                          reorient_nifti=False)
+            expected_nifti = nibabel.load(expected['NII_FILE'])
+            numpy.testing.assert_allclose(results['NII'].affine, expected_nifti.affine, atol=1e-4)
+            numpy.testing.assert_array_equal(results['NII'].get_fdata(), expected_nifti.get_fdata())
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
+    def test_concurrent_conversions(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        working_directory = os.getcwd()
+        try:
+            # conversions from the same working directory do not share any scratch space
+            os.chdir(tmp_output_dir)
+            output_files = [os.path.join(tmp_output_dir, 'test_%d.nii.gz' % index) for index in range(4)]
+            pool = ThreadPool(4)
+            try:
+                results = pool.map(lambda output_file: convert_dicom.dicom_series_to_nifti(test_data.SIEMENS_ANATOMICAL,
+                                                                                           output_file,
+                                                                                           False),
+                                   output_files)
+            finally:
+                pool.close()
+                pool.join()
+            for result in results:
+                assert_compare_nifti(result['NII_FILE'],
+                                     ground_thruth_filenames(test_data.SIEMENS_ANATOMICAL)[0])
+            self.assertEqual(sorted(os.listdir(tmp_output_dir)), sorted(os.path.basename(output_file)
+                                                                        for output_file in output_files))
+        finally:
+            os.chdir(working_directory)
+            shutil.rmtree(tmp_output_dir)
+
+    def test_get_first_header(self):
+        # the full header is read, not only the classification tags
+        dicom_header = convert_dicom._get_first_header(test_data.SIEMENS_FMRI)
+        self.assertIn(Tag(0x0029, 0x1020), dicom_header)
+        self.assertNotIn('PixelData', dicom_header)
+
     def test_are_imaging_dicoms(self):
         assert convert_dicom.are_imaging_dicoms(read_dicom_directory(test_data.SIEMENS_ANATOMICAL))
 
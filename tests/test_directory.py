@@ -10,6 +10,8 @@ import shutil
 import tempfile
 import unittest
 
+import pydicom
+
 import dicom2nifti.convert_dir as convert_directory
 import tests.test_data as test_data
 
@@ -26,6 +28,113 @@ class TestConversionDirectory(unittest.TestCase):
         finally:
             shutil.rmtree(tmp_output_dir)
 
+    def test_get_series_files(self):
+        dicom_series = convert_directory._get_series_files(test_data.GENERIC_ANATOMICAL)
+        self.assertEqual(len(dicom_series), 1)
+        dicom_files = list(dicom_series.values())[0]
+        self.assertEqual(len(dicom_files), 4)
+        for dicom_file in dicom_files:
+            self.assertTrue(os.path.isfile(dicom_file))
+
+    def test_get_series_files_workers(self):
+        ge_directory = os.path.dirname(os.path.dirname(test_data.GE_ANATOMICAL))
+        dicom_series = convert_directory._get_series_files(ge_directory)
+        self.assertTrue(len(dicom_series) > 1)
+        self.assertEqual(convert_directory._get_series_files(ge_directory, workers=4), dicom_series)
+
+    def test_stream_series_files(self):
+        ge_directory = os.path.dirname(os.path.dirname(test_data.GE_ANATOMICAL))
+        dicom_series = convert_directory._get_series_files(ge_directory)
+        streamed_series = list(convert_directory._stream_series_files(ge_directory, workers=4))
+        self.assertEqual(dict(streamed_series), dict(dicom_series))
+        self.assertEqual(len(streamed_series), len(dicom_series))
+
+    def test_stream_series_files_max_open_memory(self):
+        tmp_input_dir = tempfile.mkdtemp()
+        try:
+            # 2 interleaved series in a single directory
+            for series_directory in [test_data.GENERIC_ANATOMICAL, test_data.GENERIC_NON_ISOTROPIC]:
+                for file_name in os.listdir(series_directory):
+                    shutil.copy(os.path.join(series_directory, file_name),
+                                os.path.join(tmp_input_dir, os.path.basename(series_directory) + file_name))
+            dicom_series = convert_directory._get_series_files(tmp_input_dir)
+            streamed_series = list(convert_directory._stream_series_files(tmp_input_dir))
+            self.assertEqual(len(streamed_series), len(dicom_series))
+            self.assertEqual(dict(streamed_series), dict(dicom_series))
+            streamed_series = list(convert_directory._stream_series_files(tmp_input_dir, max_open_memory=1))
+            # evicted series are converted again with all files at the end
+            self.assertTrue(len(streamed_series) > len(dicom_series))
+            self.assertEqual(dict(streamed_series), dict(dicom_series))
+        finally:
+            shutil.rmtree(tmp_input_dir)
+
+    def test_stream_series_files_nested(self):
+        tmp_input_dir = tempfile.mkdtemp()
+        try:
+            # a classic 4d series split over a directory per timepoint, ImagesInAcquisition counts 1 timepoint
+            dicom_files = sorted(os.listdir(test_data.SIEMENS_CLASSIC_FMRI))
+            for index, file_name in enumerate(dicom_files):
+                dicom_header = pydicom.read_file(os.path.join(test_data.SIEMENS_CLASSIC_FMRI, file_name))
+                dicom_header.ImagesInAcquisition = len(dicom_files) // 2
+                timepoint_directory = os.path.join(tmp_input_dir, str(index * 2 // len(dicom_files)))
+                if not os.path.isdir(timepoint_directory):
+                    os.mkdir(timepoint_directory)
+                dicom_header.save_as(os.path.join(timepoint_directory, file_name))
+            dicom_series = convert_directory._get_series_files(tmp_input_dir)
+            self.assertEqual(len(dicom_series), 1)
+            # the series is yielded when the first directory is done and again with all its files at the end
+            streamed_series = list(convert_directory._stream_series_files(tmp_input_dir))
+            self.assertEqual(len(streamed_series), 2)
+            self.assertEqual(streamed_series[-1], list(dicom_series.items())[0])
+        finally:
+            shutil.rmtree(tmp_input_dir)
+
+    def test_stream_series_files_directory_boundary(self):
+        tmp_input_dir = tempfile.mkdtemp()
+        try:
+            # a series per directory without expected file count
+            series_directories = [test_data.GENERIC_ANATOMICAL, test_data.GENERIC_NON_ISOTROPIC]
+            for index, series_directory in enumerate(series_directories):
+                shutil.copytree(series_directory, os.path.join(tmp_input_dir, str(index)))
+            scanned_files = []
+            get_series_info = convert_directory._get_series_info
+
+            def _get_series_info(file_path, header_index=None):
+                scanned_files.append(file_path)
+                return get_series_info(file_path, header_index)
+
+            convert_directory._get_series_info = _get_series_info
+            try:
+                streamed_series = convert_directory._stream_series_files(tmp_input_dir)
+                series_uid, dicom_files = next(streamed_series)
+                # the series is yielded before the files of the next directory are read
+                series_directory = os.path.dirname(dicom_files[0])
+                self.assertEqual(set(os.path.dirname(file_path) for file_path in scanned_files), {series_directory})
+                self.assertEqual(sorted(dicom_files), sorted(scanned_files))
+                self.assertEqual(len(list(streamed_series)), 1)
+            finally:
+                convert_directory._get_series_info = get_series_info
+        finally:
+            shutil.rmtree(tmp_input_dir)
+
+    def test_get_expected_file_count(self):
+        dicom_header = pydicom.Dataset()
+        dicom_header.file_meta = pydicom.Dataset()
+        self.assertIsNone(convert_directory._get_expected_file_count(dicom_header))
+        # the images of 1 acquisition are not the whole series
+        dicom_header.ImagesInAcquisition = 30
+        self.assertIsNone(convert_directory._get_expected_file_count(dicom_header))
+        dicom_header.NumberOfTemporalPositions = 10
+        self.assertEqual(convert_directory._get_expected_file_count(dicom_header), 300)
+
+    def test_convert_directory_streaming(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            convert_directory.convert_directory(test_data.GENERIC_ANATOMICAL, tmp_output_dir, streaming=True)
+            self.assertTrue(os.path.isfile(os.path.join(tmp_output_dir, '4_dicom2nifti.nii.gz')))
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
     def test_remove_accents(self):
 
         assert convert_directory._remove_accents(u'êén_ölîfānt@') == 'een_olifant'
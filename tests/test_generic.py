@@ -13,9 +13,11 @@ import tempfile
 import unittest
 
 import nibabel
+import numpy
 
 import tests.test_data as test_data
 
+import dicom2nifti.common as common
 import dicom2nifti.convert_generic as convert_generic
 from dicom2nifti.common import read_dicom_directory
 from dicom2nifti.compressed_dicom import is_dicom_file
@@ -42,6 +44,21 @@ class TestConversionGeneric(unittest.TestCase):
         finally:
             shutil.rmtree(tmp_output_dir)
 
+    def test_lazy_nifti(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            results = convert_generic.dicom_to_nifti(read_dicom_directory(test_data.GE_ANATOMICAL),
+                                                     os.path.join(tmp_output_dir, 'test.nii'))
+            expected = results['NII'].get_fdata()
+
+            results = convert_generic.dicom_to_nifti(read_dicom_directory(test_data.GE_ANATOMICAL), None)
+            self.assertFalse(results['NII'].in_memory)
+            self.assertTrue(isinstance(results['NII'].dataobj, common.SliceArrayProxy))
+            numpy.testing.assert_array_equal(results['NII'].dataobj[:, :, 2], expected[:, :, 2])
+            numpy.testing.assert_array_equal(results['NII'].get_fdata(), expected)
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
     def test_not_a_volume(self):
         tmp_output_dir = tempfile.mkdtemp()
         try:
@@ -74,6 +91,22 @@ class TestConversionGeneric(unittest.TestCase):
         finally:
             shutil.rmtree(temporary_directory)
 
+    def test_remove_duplicate_slices(self):
+        dicoms = read_dicom_directory(test_data.GENERIC_ANATOMICAL)
+        duplicates = read_dicom_directory(test_data.GENERIC_ANATOMICAL)
+        # same position but different pixel data
+        changed_slice = read_dicom_directory(test_data.GENERIC_ANATOMICAL)[0]
+        pixel_data = bytearray(changed_slice.PixelData)
+        pixel_data[0] = (pixel_data[0] + 1) % 256
+        changed_slice.PixelData = bytes(pixel_data)
+
+        filtered_dicoms = convert_generic._remove_duplicate_slices(dicoms + duplicates + [changed_slice])
+        self.assertEqual(len(filtered_dicoms), len(dicoms) + 1)
+        self.assertTrue(changed_slice in filtered_dicoms)
+        # the pixel data was not decoded to find the duplicates
+        for dicom in dicoms + duplicates:
+            self.assertIsNone(getattr(dicom, '_pixel_array', None))
+
 
 if __name__ == '__main__':
     unittest.main()
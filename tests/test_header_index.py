@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+dicom2nifti
+
+@author: abrys
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import dicom2nifti.convert_dir as convert_directory
+import tests.test_data as test_data
+from dicom2nifti.header_index import HeaderIndex
+
+
+class TestHeaderIndex(unittest.TestCase):
+
+    def test_get_series_files(self):
+        tmp_directory = tempfile.mkdtemp()
+        try:
+            ge_directory = os.path.dirname(os.path.dirname(test_data.GE_ANATOMICAL))
+            index_file = os.path.join(tmp_directory, 'index.sqlite')
+            expected_series = convert_directory._get_series_files(ge_directory)
+
+            # first run fills the index
+            header_index = HeaderIndex(index_file)
+            self.assertEqual(convert_directory._get_series_files(ge_directory, header_index=header_index),
+                             expected_series)
+            header_index.close()
+
+            # second run uses the index
+            header_index = HeaderIndex(index_file)
+            for dicom_files in expected_series.values():
+                for dicom_file in dicom_files:
+                    dicom_probe = header_index.get(dicom_file)
+                    self.assertIsNotNone(dicom_probe)
+                    self.assertTrue(dicom_probe.is_dicom)
+                    self.assertTrue(convert_directory._is_valid_imaging_dicom(dicom_probe.header))
+            self.assertEqual(convert_directory._get_series_files(ge_directory, header_index=header_index),
+                             expected_series)
+            header_index.close()
+        finally:
+            shutil.rmtree(tmp_directory)
+
+    def test_changed_file(self):
+        tmp_directory = tempfile.mkdtemp()
+        try:
+            dicom_file = os.path.join(tmp_directory, 'IM-0001-0001-0001.dcm')
+            shutil.copy(os.path.join(test_data.GENERIC_ANATOMICAL, 'IM-0001-0001-0001.dcm'), dicom_file)
+            header_index = HeaderIndex(os.path.join(tmp_directory, 'index.sqlite'))
+            header_index.probe_file(dicom_file)
+            self.assertIsNotNone(header_index.get(dicom_file))
+
+            # a modified file is read again
+            with open(dicom_file, 'ab') as file_stream:
+                file_stream.write(b'\0\0')
+            self.assertIsNone(header_index.get(dicom_file))
+            header_index.close()
+        finally:
+            shutil.rmtree(tmp_directory)
+
+    def test_old_index_version(self):
+        tmp_directory = tempfile.mkdtemp()
+        try:
+            dicom_file = os.path.join(test_data.GENERIC_ANATOMICAL, 'IM-0001-0001-0001.dcm')
+            statinfo = os.stat(dicom_file)
+            index_file = os.path.join(tmp_directory, 'index.sqlite')
+
+            # an index written by a version that also stored the pixel data location
+            connection = sqlite3.connect(index_file)
+            connection.execute('PRAGMA user_version = 2')
+            connection.execute('CREATE TABLE headers (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                               'is_dicom INTEGER, transfer_syntax TEXT, pixel_data_offset INTEGER, '
+                               'pixel_data_length INTEGER, header TEXT)')
+            connection.execute('INSERT INTO headers VALUES (?, ?, ?, 0, NULL, NULL, NULL, NULL)',
+                               (os.path.abspath(dicom_file), statinfo.st_size, statinfo.st_mtime))
+            connection.commit()
+            connection.close()
+
+            # is rebuilt with the current columns and its entries are read again
+            header_index = HeaderIndex(index_file)
+            self.assertIsNone(header_index.get(dicom_file))
+            self.assertTrue(header_index.probe_file(dicom_file).is_dicom)
+            self.assertTrue(header_index.get(dicom_file).is_dicom)
+            columns = [column[1] for column in header_index._connection.execute('PRAGMA table_info(headers)')]
+            self.assertEqual(columns, ['path', 'size', 'mtime', 'is_dicom', 'transfer_syntax', 'header'])
+            header_index.close()
+        finally:
+            shutil.rmtree(tmp_directory)
+
+    def test_commit_and_prune(self):
+        tmp_directory = tempfile.mkdtemp()
+        try:
+            dicom_directory = os.path.join(tmp_directory, 'dicom')
+            shutil.copytree(test_data.GENERIC_ANATOMICAL, dicom_directory)
+            dicom_files = sorted(os.path.join(dicom_directory, file_name) for file_name in os.listdir(dicom_directory))
+            index_file = os.path.join(tmp_directory, 'index.sqlite')
+
+            # entries are committed in batches, so they survive an index that is never closed
+            header_index = HeaderIndex(index_file, commit_interval=2)
+            for dicom_file in dicom_files[:3]:
+                header_index.probe_file(dicom_file)
+            other_index = HeaderIndex(index_file)
+            self.assertIsNotNone(other_index.get(dicom_files[1]))
+            self.assertIsNone(other_index.get(dicom_files[2]))
+            other_index.close()
+            header_index.close()
+
+            # entries of deleted files are removed, other directories are not touched
+            header_index = HeaderIndex(index_file)
+            header_index.probe_file(os.path.join(test_data.GE_ANATOMICAL, os.listdir(test_data.GE_ANATOMICAL)[0]))
+            os.remove(dicom_files[0])
+            self.assertEqual(header_index.prune(tmp_directory), 1)
+            self.assertEqual(header_index.prune(tmp_directory), 0)
+            self.assertEqual(header_index._connection.execute('SELECT COUNT(*) FROM headers').fetchone()[0], 3)
+            header_index.close()
+        finally:
+            shutil.rmtree(tmp_directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+dicom2nifti
+
+@author: abrys
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import nibabel
+import numpy
+
+import dicom2nifti.convert_dicom as convert_dicom
+import dicom2nifti.nifti_writer as nifti_writer
+import dicom2nifti.settings as settings
+import tests.test_data as test_data
+from dicom2nifti.common import read_dicom_directory
+
+
+class TestNiftiWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmp_output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        settings.disable_out_of_core()
+        shutil.rmtree(self.tmp_output_dir)
+
+    def test_nifti_writer(self):
+        data = numpy.arange(2 * 3 * 4 * 5, dtype=numpy.int16).reshape((2, 3, 4, 5))
+        affine = numpy.diag([2.0, 3.0, 4.0, 1.0])
+        expected_file = os.path.join(self.tmp_output_dir, 'expected.nii')
+        expected_image = nibabel.Nifti1Image(data, affine)
+        expected_image.header.structarr['pixdim'][4] = 2.0
+        expected_image.header.structarr['db_name'] = '?TR:2000.000 TE:30'
+        expected_image.to_filename(expected_file)
+
+        output_file = os.path.join(self.tmp_output_dir, 'test.nii')
+        with nifti_writer.NiftiWriter(output_file, affine, 2000.0, 30.0) as writer:
+            block = writer.allocate(data.shape, numpy.float32)
+            block[:, :, :, 0] = 1.5
+            # reallocating keeps the data written so far
+            block = writer.allocate(data.shape, data.dtype)
+            for timepoint in range(0, data.shape[3]):
+                block[:, :, :, timepoint] = data[:, :, :, timepoint]
+            nii_image = writer.close()
+        self.assertEqual(sorted(os.listdir(self.tmp_output_dir)), ['expected.nii', 'test.nii'])
+        numpy.testing.assert_array_equal(nii_image.get_data(), data)
+        with open(output_file, 'rb') as nifti_file, open(expected_file, 'rb') as expected_nifti_file:
+            self.assertEqual(nifti_file.read(), expected_nifti_file.read())
+
+    def test_nifti_writer_abort(self):
+        output_file = os.path.join(self.tmp_output_dir, 'test.nii')
+        with self.assertRaises(ValueError):
+            with nifti_writer.NiftiWriter(output_file, numpy.eye(4)) as writer:
+                writer.allocate((2, 2, 2, 2), numpy.int16)
+                raise ValueError()
+        self.assertEqual(os.listdir(self.tmp_output_dir), [])
+
+    def test_is_out_of_core(self):
+        self.assertFalse(nifti_writer.is_out_of_core('test.nii'))
+        settings.enable_out_of_core()
+        self.assertTrue(nifti_writer.is_out_of_core('test.nii'))
+        self.assertFalse(nifti_writer.is_out_of_core('test.nii.gz'))
+        self.assertFalse(nifti_writer.is_out_of_core(None))
+
+    def test_out_of_core_conversion(self):
+        for dicom_directory in [test_data.SIEMENS_FMRI,
+                                test_data.SIEMENS_CLASSIC_FMRI,
+                                test_data.GE_FMRI,
+                                test_data.PHILIPS_FMRI,
+                                test_data.PHILIPS_DTI]:
+            in_memory_file = os.path.join(self.tmp_output_dir, 'in_memory.nii')
+            out_of_core_file = os.path.join(self.tmp_output_dir, 'out_of_core.nii')
+            settings.disable_out_of_core()
+            convert_dicom.dicom_array_to_nifti(read_dicom_directory(dicom_directory), in_memory_file)
+            settings.enable_out_of_core()
+            results = convert_dicom.dicom_array_to_nifti(read_dicom_directory(dicom_directory), out_of_core_file)
+            self.assertTrue(isinstance(results['NII'], nibabel.nifti1.Nifti1Image))
+
+            in_memory_nifti = nibabel.load(in_memory_file)
+            out_of_core_nifti = nibabel.load(out_of_core_file)
+            self.assertEqual(out_of_core_nifti.get_data_dtype(), in_memory_nifti.get_data_dtype())
+            numpy.testing.assert_array_equal(out_of_core_nifti.affine, in_memory_nifti.affine)
+            numpy.testing.assert_array_equal(out_of_core_nifti.get_data(), in_memory_nifti.get_data())
+            self.assertEqual(sorted(name for name in os.listdir(self.tmp_output_dir) if name.endswith('.nii')),
+                             ['in_memory.nii', 'out_of_core.nii'])
+
+
+if __name__ == '__main__':
+    unittest.main()
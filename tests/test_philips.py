@@ -17,6 +17,7 @@ import tests.test_data as test_data
 
 import dicom2nifti.common as common
 import dicom2nifti.convert_philips as convert_philips
+import dicom2nifti.image_reorientation as image_reorientation
 import dicom2nifti.settings as settings
 from dicom2nifti.common import read_dicom_directory
 from dicom2nifti.exceptions import ConversionError
@@ -170,6 +171,35 @@ class TestConversionPhilips(unittest.TestCase):
         finally:
             shutil.rmtree(tmp_output_dir)
 
+    def test_header_scaling(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            for dicom_directory in [test_data.PHILIPS_ENHANCED_ANATOMICAL, test_data.PHILIPS_ENHANCED_FMRI]:
+                float_file = os.path.join(tmp_output_dir, 'float.nii.gz')
+                scaled_file = os.path.join(tmp_output_dir, 'scaled.nii.gz')
+                convert_philips.dicom_to_nifti(read_dicom_directory(dicom_directory), float_file)
+                settings.enable_header_scaling()
+                try:
+                    convert_philips.dicom_to_nifti(read_dicom_directory(dicom_directory), scaled_file)
+                finally:
+                    settings.disable_header_scaling()
+
+                float_nifti = nibabel.load(float_file)
+                scaled_nifti = nibabel.load(scaled_file)
+                self.assertEqual(float_nifti.get_data_dtype(), numpy.float32)
+                self.assertEqual(scaled_nifti.get_data_dtype(), numpy.uint16)
+                self.assertNotEqual(scaled_nifti.dataobj.slope, 1.0)
+                numpy.testing.assert_allclose(scaled_nifti.get_fdata(), float_nifti.get_fdata(), rtol=1e-5)
+
+                # the reorientation keeps the stored data and the scaling
+                reoriented_file = os.path.join(tmp_output_dir, 'reoriented.nii.gz')
+                image_reorientation.reorient_image(scaled_file, reoriented_file)
+                reoriented_nifti = nibabel.load(reoriented_file)
+                self.assertEqual(reoriented_nifti.get_data_dtype(), numpy.uint16)
+                self.assertEqual(reoriented_nifti.dataobj.slope, scaled_nifti.dataobj.slope)
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
     def test_anatomical_implicit(self):
         tmp_output_dir = tempfile.mkdtemp()
         try:
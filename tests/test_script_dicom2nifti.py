@@ -152,6 +152,29 @@ class TestConversionDicom(unittest.TestCase):
         finally:
             shutil.rmtree(tmp_output_dir)
 
+    def test_watch_option(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        script_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                   'scripts',
+                                   'dicom2nifti')
+        assert os.path.isfile(script_file)
+
+        try:
+            if sys.version_info > (3, 0):
+                from importlib.machinery import SourceFileLoader
+                dicom2nifti_module = SourceFileLoader("dicom2nifti_script", script_file).load_module()
+            else:
+                import imp
+                dicom2nifti_module = imp.load_source('dicom2nifti_script', script_file)
+            # options of the directory scan are rejected instead of silently ignored
+            for option in [['-j', '4'], ['-I', os.path.join(tmp_output_dir, 'index.sqlite')], ['-S']]:
+                with self.assertRaises(SystemExit):
+                    dicom2nifti_module.main(['-w'] + option + [test_data.SIEMENS_ANATOMICAL, tmp_output_dir])
+            self.assertEqual(os.listdir(tmp_output_dir), [])
+
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
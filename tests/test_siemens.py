@@ -4,8 +4,10 @@ dicom2nifti
 
 @author: abrys
 """
+import copy
 import os
 import shutil
+import struct
 import tempfile
 import unittest
 
@@ -15,12 +17,15 @@ import numpy
 import dicom2nifti.compressed_dicom as compressed_dicom
 
 import pydicom
+from pydicom.tag import Tag
 
 import tests.test_data as test_data
 
 import dicom2nifti.convert_siemens as convert_siemens
 import dicom2nifti.common as common
+import dicom2nifti.settings as settings
 from dicom2nifti.common import read_dicom_directory
+from dicom2nifti.exceptions import ConversionError, ConversionValidationError
 from tests.test_tools import assert_compare_nifti, assert_compare_bval, assert_compare_bvec, ground_thruth_filenames
 
 
@@ -201,6 +206,178 @@ class TestConversionSiemens(unittest.TestCase):
         asconv_headers = convert_siemens._get_asconv_headers(mosaic)
         assert len(asconv_headers) == 64022
 
+    def test_get_ascconv_protocol(self):
+        protocol_cache = {}
+        mosaics = read_dicom_directory(test_data.SIEMENS_FMRI)
+        protocol = convert_siemens._get_ascconv_protocol(mosaics[0], protocol_cache)
+        self.assertEqual(protocol['sSliceArray.lSize'], '50')
+        self.assertEqual(protocol['sSliceArray.asSlice[0].sPosition.dTra'], '-59.85445753')
+        self.assertEqual(protocol['tProtocolName'], '""ep2d+AF8-pace""')
+        # all mosaics of the series share the parsed protocol
+        for mosaic in mosaics[1:]:
+            self.assertIs(convert_siemens._get_ascconv_protocol(mosaic, protocol_cache), protocol)
+        self.assertEqual(len(protocol_cache), 1)
+
+        for dicom_directory in [test_data.SIEMENS_FMRI, test_data.SIEMENS_DTI]:
+            mosaic = read_dicom_directory(dicom_directory)[0]
+            self.assertEqual(convert_siemens._get_mosaic_type(mosaic), convert_siemens.MosaicType.DESCENDING)
+
+    def test_unpack_mosaic(self):
+        mosaics = convert_siemens._get_sorted_mosaics(read_dicom_directory(test_data.SIEMENS_DTI))[:3]
+        size = convert_siemens._get_mosaic_size(mosaics[0])
+        stack = numpy.array([common.get_pixel_array(mosaic) for mosaic in mosaics])
+        for mosaic_type in [convert_siemens.MosaicType.ASCENDING, convert_siemens.MosaicType.DESCENDING]:
+            expected_blocks = []
+            for mosaic_data in stack:
+                # tiles are stored row by row
+                expected = numpy.zeros((size[0], size[1], size[2]), dtype=mosaic_data.dtype)
+                for z_index in range(0, size[2]):
+                    y_index, x_index = divmod(z_index, mosaic_data.shape[1] // size[0])
+                    tile = mosaic_data[size[1] * y_index:size[1] * (y_index + 1),
+                                       size[0] * x_index:size[0] * (x_index + 1)]
+                    if mosaic_type == convert_siemens.MosaicType.DESCENDING:
+                        z_index = size[2] - (z_index + 1)
+                    expected[:, :, z_index] = tile.T
+                numpy.testing.assert_array_equal(convert_siemens._unpack_mosaic(mosaic_data, size, mosaic_type),
+                                                 expected)
+                expected_blocks.append(expected)
+            # a stack of mosaics results in the x,y,z,t block
+            numpy.testing.assert_array_equal(convert_siemens._unpack_mosaic(stack, size, mosaic_type),
+                                             numpy.stack(expected_blocks, axis=3))
+
+    def test_parse_csa_header(self):
+        mosaic = read_dicom_directory(test_data.SIEMENS_FMRI)[0]
+        # the series header has the same format as the image header
+        csa_header = convert_siemens.get_csa_header(mosaic, Tag(0x0029, 0x1020))
+        self.assertIn(convert_siemens._get_asconv_headers(mosaic), csa_header['MrPhoenixProtocol'][0])
+        self.assertIs(convert_siemens.get_csa_header(mosaic, Tag(0x0029, 0x1020)), csa_header)
+        # no image header in the (anonymised) test data
+        self.assertIsNone(convert_siemens.get_csa_header(mosaic))
+        self.assertRaises(ConversionError, convert_siemens.parse_csa_header, b'SV10\x04\x03\x02\x01')
+
+        # every header of a long series is parsed only once, however many values are asked
+        parsed_headers = []
+        parse_csa_header = convert_siemens.parse_csa_header
+        convert_siemens.parse_csa_header = lambda csa_bytes: parsed_headers.append(csa_bytes) or \
+            parse_csa_header(csa_bytes)
+        try:
+            mosaics = [copy.deepcopy(mosaic) for _ in range(300)]
+            for index, mosaic in enumerate(mosaics):
+                mosaic.add_new(Tag(0x0029, 0x1010), 'OB', _create_csa_header(
+                    [('B_value', 'IS', [str(index)]),
+                     ('DiffusionGradientDirection', 'FD', ['0.5', '-0.5', '0.70710678'])]))
+            for _ in range(2):
+                numpy.testing.assert_array_equal(convert_siemens._get_bvals(mosaics), range(300))
+                self.assertEqual(convert_siemens._get_bvecs(mosaics).shape, (300, 3))
+            self.assertEqual(len(parsed_headers), 300)
+        finally:
+            convert_siemens.parse_csa_header = parse_csa_header
+
+    def test_csa_image_header(self):
+        mosaic = read_dicom_directory(test_data.SIEMENS_DTI)[0]
+        slice_normal = numpy.cross(mosaic.ImageOrientationPatient[0:3], mosaic.ImageOrientationPatient[3:6])
+        for sign in [1, -1]:
+            mosaic.add_new(Tag(0x0029, 0x1010), 'OB', _create_csa_header(
+                [('NumberOfImagesInMosaic', 'IS', ['48']),
+                 ('SliceNormalVector', 'FD', ['%.8f' % (sign * value) for value in slice_normal]),
+                 ('B_value', 'IS', ['1000']),
+                 ('DiffusionGradientDirection', 'FD', ['0.5', '-0.5', '0.70710678']),
+                 ('ImagedNucleus', 'CS', ['1H'])]))
+            csa_header = convert_siemens.get_csa_header(mosaic)
+            self.assertEqual(csa_header['ImagedNucleus'], ['1H'])
+            self.assertEqual(convert_siemens._get_mosaic_size(mosaic)[2], 48)
+            # the slice order comes from the ascconv headers
+            self.assertEqual(convert_siemens._get_mosaic_type(mosaic), convert_siemens.MosaicType.DESCENDING)
+            numpy.testing.assert_array_equal(convert_siemens._get_bvals([mosaic]), [1000])
+            numpy.testing.assert_array_equal(convert_siemens._get_bvecs([mosaic]), [[0.5, -0.5, 0.70710678]])
+
+    def test_csa_image_header_conversion(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            mosaics = read_dicom_directory(test_data.SIEMENS_FMRI)
+            for mosaic in mosaics:
+                protocol = convert_siemens._get_ascconv_protocol(mosaic)
+                slice_normal = [protocol['sSliceArray.asSlice[0].sNormal.%s' % axis]
+                                for axis in ['dSag', 'dCor', 'dTra']]
+                mosaic.add_new(Tag(0x0029, 0x1010), 'OB', _create_csa_header(
+                    [('NumberOfImagesInMosaic', 'US', [protocol['sSliceArray.lSize']]),
+                     ('SliceNormalVector', 'FD', slice_normal)]))
+            results = convert_siemens.dicom_to_nifti(mosaics, os.path.join(tmp_output_dir, 'test.nii.gz'))
+            # compared directly as the slice order should not change (not even with a matching affine)
+            ground_truth = nibabel.load(ground_thruth_filenames(test_data.SIEMENS_FMRI)[0])
+            numpy.testing.assert_allclose(results['NII'].affine, ground_truth.affine, atol=1e-4)
+            numpy.testing.assert_array_equal(numpy.asanyarray(results['NII'].dataobj),
+                                             numpy.asanyarray(ground_truth.dataobj))
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
+    def test_classic_validate_grouped_dicoms(self):
+        grouped_dicoms = convert_siemens._classic_get_grouped_dicoms(
+            read_dicom_directory(test_data.SIEMENS_CLASSIC_FMRI))
+        for stack_index, stack in enumerate(grouped_dicoms):
+            self.assertEqual(len(stack), len(grouped_dicoms[0]))
+            self.assertEqual(set(int(dicom_.AcquisitionNumber) for dicom_ in stack), {stack_index + 1})
+            self.assertEqual([dicom_.InstanceNumber for dicom_ in stack],
+                             sorted(dicom_.InstanceNumber for dicom_ in stack))
+        convert_siemens._classic_validate_grouped_dicoms(grouped_dicoms)
+
+        # the validation fails before any pixel data is read
+        for dicom_ in [dicom_ for stack in grouped_dicoms for dicom_ in stack]:
+            del dicom_.PixelData
+        missing_slice = [list(stack) for stack in grouped_dicoms]
+        del missing_slice[1][2]
+        self.assertRaises(ConversionError, convert_siemens._classic_4d_to_nifti, missing_slice, None)
+        missing_timepoint = [list(stack) for stack in grouped_dicoms]
+        missing_timepoint[1] = []
+        self.assertRaises(ConversionError, convert_siemens._classic_4d_to_nifti, missing_timepoint, None)
+        settings.enable_validate_sliceincrement()
+        swapped_slices = [list(stack) for stack in grouped_dicoms]
+        swapped_slices[1][0], swapped_slices[1][-1] = swapped_slices[1][-1], swapped_slices[1][0]
+        self.assertRaises(ConversionValidationError, convert_siemens._classic_4d_to_nifti, swapped_slices, None)
+
+        # timepoints can move less than half the slice distance
+        image_orientation = numpy.array(grouped_dicoms[0][0].ImageOrientationPatient, dtype=float)
+        slice_normal = numpy.cross(image_orientation[0:3], image_orientation[3:6])
+        slice_distance = abs(numpy.dot(numpy.subtract(grouped_dicoms[0][1].ImagePositionPatient,
+                                                      grouped_dicoms[0][0].ImagePositionPatient), slice_normal))
+        for shift, valid in [(0.4, True), (0.6, False)]:
+            shifted_slices = [list(stack) for stack in grouped_dicoms]
+            shifted_slices[1] = copy.deepcopy(shifted_slices[1])
+            for dicom_ in shifted_slices[1]:
+                dicom_.ImagePositionPatient = list(numpy.add(dicom_.ImagePositionPatient,
+                                                             shift * slice_distance * slice_normal))
+            if valid:
+                convert_siemens._classic_validate_grouped_dicoms(shifted_slices)
+            else:
+                self.assertRaises(ConversionValidationError,
+                                  convert_siemens._classic_validate_grouped_dicoms, shifted_slices)
+                settings.disable_validate_sliceincrement()
+                try:
+                    convert_siemens._classic_validate_grouped_dicoms(shifted_slices)
+                finally:
+                    settings.enable_validate_sliceincrement()
+
+        # slices at the same location do not make the validation fail on float noise
+        duplicate_slices = copy.deepcopy(grouped_dicoms[:2])
+        for stack in duplicate_slices:
+            stack[1].ImagePositionPatient = stack[0].ImagePositionPatient
+        duplicate_slices[1][0].ImagePositionPatient = list(numpy.add(duplicate_slices[1][0].ImagePositionPatient,
+                                                                     1e-5 * slice_normal))
+        convert_siemens._classic_validate_grouped_dicoms(duplicate_slices)
+
+
+def _create_csa_header(elements):
+    """
+    Create a CSA2 header with the given (name, vr, values) elements
+    """
+    csa_header = b'SV10\x04\x03\x02\x01' + struct.pack('<2I', len(elements), 77)
+    for name, vr, values in elements:
+        csa_header += struct.pack('<64si4s3i', name.encode(), len(values), vr.encode(), 0, len(values) + 1, 77)
+        for value in [value.encode() + b'\x00' for value in values] + [b'']:
+            csa_header += struct.pack('<4i', len(value), len(value), 77, len(value))
+            csa_header += value + b'\x00' * (-len(value) % 4)
+    return csa_header
+
 
 if __name__ == '__main__':
     unittest.main()
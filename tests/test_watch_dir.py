@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+dicom2nifti
+
+@author: abrys
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import tests.test_data as test_data
+from dicom2nifti.watch_dir import DirectoryWatcher
+
+
+class TestWatchDirectory(unittest.TestCase):
+
+    def test_convert_completed_series(self):
+        spool_directory = tempfile.mkdtemp()
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            dicom_files = sorted(os.listdir(test_data.GENERIC_ANATOMICAL))
+            watcher = DirectoryWatcher(spool_directory, tmp_output_dir, quiet_period=10, use_inotify=False)
+
+            # first part of the series arrives
+            for dicom_file in dicom_files[:2]:
+                shutil.copy(os.path.join(test_data.GENERIC_ANATOMICAL, dicom_file), spool_directory)
+            self.assertEqual(watcher.poll(now=0), 2)
+            self.assertEqual(watcher.convert_completed_series(now=5), [])
+
+            # rest of the series arrives, the quiet period restarts
+            for dicom_file in dicom_files[2:]:
+                shutil.copy(os.path.join(test_data.GENERIC_ANATOMICAL, dicom_file), spool_directory)
+            self.assertEqual(watcher.poll(now=8), len(dicom_files) - 2)
+            self.assertEqual(watcher.convert_completed_series(now=12), [])
+
+            # already indexed files are not read again
+            self.assertEqual(watcher.poll(now=15), 0)
+            nifti_files = watcher.convert_completed_series(now=20)
+            self.assertEqual(nifti_files, [os.path.join(tmp_output_dir, '4_dicom2nifti.nii.gz')])
+            self.assertTrue(os.path.isfile(nifti_files[0]))
+
+            # nothing left to convert
+            self.assertEqual(watcher.convert_completed_series(now=40), [])
+        finally:
+            shutil.rmtree(spool_directory)
+            shutil.rmtree(tmp_output_dir)
+
+    def test_removed_files(self):
+        spool_directory = tempfile.mkdtemp()
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            dicom_files = sorted(os.listdir(test_data.GENERIC_ANATOMICAL))
+            watcher = DirectoryWatcher(spool_directory, tmp_output_dir, quiet_period=10, use_inotify=False)
+            for dicom_file in dicom_files:
+                shutil.copy(os.path.join(test_data.GENERIC_ANATOMICAL, dicom_file), spool_directory)
+            self.assertEqual(watcher.poll(now=0), len(dicom_files))
+
+            # a removed file is forgotten before the series is converted
+            os.remove(os.path.join(spool_directory, dicom_files[0]))
+            self.assertEqual(watcher.poll(now=1), 0)
+            self.assertEqual(len(watcher._files), len(dicom_files) - 1)
+            # (3 slices are too few to convert, the series is done all the same)
+            self.assertEqual(watcher.convert_completed_series(now=20), [])
+            # the file list of a converted series is not kept
+            self.assertEqual(watcher._series_files, {})
+            self.assertEqual(list(watcher._converted_series.values()), [len(dicom_files) - 1])
+
+            # a file arriving for a converted series converts it again with all its files
+            shutil.copy(os.path.join(test_data.GENERIC_ANATOMICAL, dicom_files[0]), spool_directory)
+            self.assertEqual(watcher.poll(now=30), 1)
+            self.assertEqual([len(series_files) for series_files in watcher._series_files.values()],
+                             [len(dicom_files)])
+            self.assertEqual(len(watcher.convert_completed_series(now=40)), 1)
+
+            # once the files of the series are removed nothing is left
+            for dicom_file in dicom_files:
+                os.remove(os.path.join(spool_directory, dicom_file))
+            self.assertEqual(watcher.poll(now=50), 0)
+            self.assertEqual((watcher._files, watcher._series_files, watcher._pending_series,
+                              watcher._converted_series), ({}, {}, {}, {}))
+        finally:
+            shutil.rmtree(spool_directory)
+            shutil.rmtree(tmp_output_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()